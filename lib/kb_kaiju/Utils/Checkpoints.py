@@ -0,0 +1,105 @@
+import os
+import re
+import sys
+import time
+import json
+import hashlib
+
+
+def checkpoint_key(params, input_files=None):
+    '''
+    md5 of the params (JSON serializable) and of the path, size and mtime of each input file
+    '''
+    key_hash = hashlib.md5(json.dumps(params, sort_keys=True).encode('utf-8'))
+    for input_file in sorted(input_files or []):
+        if os.path.exists(input_file):
+            input_stat = os.stat(input_file)
+            key_hash.update(str([input_file, input_stat.st_size, int(input_stat.st_mtime)]).encode('utf-8'))
+        else:
+            key_hash.update(str([input_file, None]).encode('utf-8'))
+    return key_hash.hexdigest()
+
+
+class Checkpoints(object):
+    '''
+    Completion manifests for the stages of a run, so a run that died part way can be
+    re-run with the same params and scratch and pick up at the first incomplete stage.
+
+        checkpoints = Checkpoints(checkpoint_dir)
+        key = checkpoints.key(stage_params, input_files)
+        result = checkpoints.run(stage, key, func, output_files)
+
+    A stage's key is a hash of its params and of the size and mtime of its input files.
+    Its manifest records the key, func's (JSON serializable) result and the size of its
+    output files.  The stage is skipped, and the recorded result returned, only if the
+    key matches and every output file is still there with the same size.
+    '''
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+
+    def key(self, params, input_files=None):
+        return checkpoint_key(params, input_files)
+
+
+    def completed(self, stage, key):
+        '''
+        The manifest of a stage completed with this key, or None
+        '''
+        manifest_path = self._manifest_path(stage)
+        if not os.path.isfile(manifest_path):
+            return None
+        try:
+            with open(manifest_path, 'r') as manifest_handle:
+                manifest = json.load(manifest_handle)
+        except ValueError:
+            return None
+        if manifest.get('key') != key:
+            return None
+        for (output_file, output_bytes) in manifest['output_files'].items():
+            if not os.path.isfile(output_file) or os.path.getsize(output_file) != output_bytes:
+                return None
+        return manifest
+
+
+    def complete(self, stage, key, result=None, output_files=None):
+        manifest = {'stage':        stage,
+                    'key':          key,
+                    'result':       result,
+                    'output_files': dict([(output_file, os.path.getsize(output_file)) for output_file in (output_files or [])]),
+                    'completed':    time.time()
+                    }
+        manifest_path = self._manifest_path(stage)
+        tmp_manifest_path = manifest_path + '.tmp'
+        with open(tmp_manifest_path, 'w') as manifest_handle:
+            json.dump(manifest, manifest_handle, indent=1, sort_keys=True)
+        os.rename(tmp_manifest_path, manifest_path)
+
+
+    def run(self, stage, key, func, output_files=None):
+        '''
+        func() unless the stage already completed with this key.  output_files is a list,
+        or a function of func's result returning one.
+        '''
+        manifest = self.completed(stage, key)
+        if manifest is not None:
+            self._log("checkpoint: "+stage+" already completed, skipping it")
+            return manifest['result']
+        result = func()
+        if callable(output_files):
+            output_files = output_files(result)
+        self.complete(stage, key, result, output_files)
+        return result
+
+
+    def _manifest_path(self, stage):
+        stage_hash = hashlib.md5(stage.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.checkpoint_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', stage) + '-' + stage_hash + '.json')
+
+
+    def _log(self, message):
+        print('{0:.2f}'.format(time.time()) + ': ' + str(message))
+        sys.stdout.flush()
@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+import mmap
+import ctypes
+import ctypes.util
+import threading
+
+import numpy as np
+
+
+# Linux values, for when os.posix_fadvise() isn't there (py2)
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+_libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int]
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+def page_cache_residency(path, window_bytes=1024**3):
+    '''
+    Returns (resident_bytes, file_bytes) for a file, going by mincore() on a
+    read-only mapping of it, one window at a time
+    '''
+    file_bytes = os.path.getsize(path)
+    resident_pages = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for offset in range(0, file_bytes, window_bytes):
+            length = min(window_bytes, file_bytes - offset)
+            addr = _libc.mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED, fd, offset)
+            if addr == MAP_FAILED:
+                raise OSError(ctypes.get_errno(), 'mmap failed for '+path)
+            try:
+                vec = (ctypes.c_ubyte * ((length + mmap.PAGESIZE - 1) // mmap.PAGESIZE))()
+                if _libc.mincore(addr, length, vec) != 0:
+                    raise OSError(ctypes.get_errno(), 'mincore failed for '+path)
+                resident_pages += int(np.count_nonzero(np.frombuffer(vec, dtype=np.uint8) & 1))
+            finally:
+                _libc.munmap(addr, length)
+    finally:
+        os.close(fd)
+    return (min(resident_pages * mmap.PAGESIZE, file_bytes), file_bytes)
+
+
+def fadvise(fd, offset, length, advice):
+    '''
+    posix_fadvise(), falling back on libc where the os module lacks it.  Advice only, so errors are ignored.
+    '''
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, offset, length, advice)
+        else:
+            _libc.posix_fadvise(fd, offset, length, advice)
+    except (OSError, AttributeError):
+        pass
+
+
+def drop_from_page_cache(path):
+    '''
+    Ask the kernel to drop a file's (clean) pages from the page cache once it has been
+    consumed, so streaming reads files don't push the kaiju index out
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class DBResidency(object):
+    '''
+    Reports how much of a kaiju database (the .fmi index plus nodes.dmp and names.dmp
+    under /data/kaijudb/<db_type>) is in the page cache, and warms it in a background
+    thread while reads are staged, so kaiju doesn't start on a cold index.
+
+        db_residency = DBResidency(db_dir)
+        db_residency.report()
+        db_residency.prewarm()
+        ...
+        db_residency.stop()
+
+    Files that don't fit in available memory are not warmed (it would only evict the rest).
+    '''
+
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.read_buf_size = 8*1024*1024
+        self.db_files = []
+        if os.path.isdir(db_dir):
+            for file_name in sorted(os.listdir(db_dir)):
+                if file_name.endswith('.fmi') or file_name in ['nodes.dmp', 'names.dmp']:
+                    self.db_files.append(os.path.join(db_dir, file_name))
+        self._stop = threading.Event()
+        self._warmer = None
+
+
+    def report(self):
+        '''
+        Logs and returns {path: (resident_bytes, file_bytes)}
+        '''
+        residency = dict()
+        for db_file in self.db_files:
+            try:
+                residency[db_file] = page_cache_residency(db_file)
+            except (OSError, IOError) as e:
+                self._log("unable to check page cache residency of "+db_file+": "+str(e))
+                continue
+            (resident_bytes, file_bytes) = residency[db_file]
+            self._log("DB RESIDENCY "+db_file+": "+self._gb(resident_bytes)+" of "+self._gb(file_bytes)+" in page cache")
+        return residency
+
+
+    def prewarm(self):
+        if self._warmer is not None or len(self.db_files) == 0:
+            return
+        self._warmer = threading.Thread(target=self._warm)
+        self._warmer.daemon = True
+        self._warmer.start()
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    def _warm(self):
+        start_time = time.time()
+        # small taxonomy files first, then the index
+        for db_file in sorted(self.db_files, key=os.path.getsize):
+            try:
+                (resident_bytes, file_bytes) = page_cache_residency(db_file)
+                if resident_bytes == file_bytes:
+                    continue
+                if file_bytes - resident_bytes > self._mem_available_bytes():
+                    self._log("not warming "+db_file+" ("+self._gb(file_bytes)+"): too large for available memory")
+                    continue
+                self._read_through(db_file)
+            except (OSError, IOError) as e:
+                self._log("unable to warm "+db_file+": "+str(e))
+            if self._stop.is_set():
+                return
+        self._log("DB warmed in "+'{0:.1f}'.format(time.time()-start_time)+"s")
+
+
+    def _read_through(self, db_file):
+        read_buf = bytearray(self.read_buf_size)
+        with open(db_file, 'rb', 0) as db_handle:
+            fadvise(db_handle.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+            while not self._stop.is_set():
+                if not db_handle.readinto(read_buf):
+                    break
+
+
+    def _mem_available_bytes(self):
+        try:
+            with open('/proc/meminfo', 'r') as meminfo_handle:
+                for line in meminfo_handle:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except IOError:
+            pass
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+    def _gb(self, n_bytes):
+        return '{0:.2f}'.format(float(n_bytes) / (1024**3)) + ' GB'
+
+
+    def _log(self, message):
+        print('{0:.2f}'.format(time.time()) + ': ' + str(message))
+        sys.stdout.flush()
@@ -2,13 +2,18 @@ import os
 import time
 import shutil
 import re
-import random
+from multiprocessing.pool import ThreadPool
 #import subprocess
 #import glob
 
 from Workspace.WorkspaceClient import Workspace
 from ReadsUtils.ReadsUtilsClient import ReadsUtils
 from SetAPI.SetAPIServiceClient import SetAPI
+from DataFileUtil.DataFileUtilClient import DataFileUtil
+
+from kb_kaiju.Utils.FastqReader import fastq_seq_len_at_least, compression_ext, starts_as_fastq, check_fastq
+from kb_kaiju.Utils.ReadSubsampler import ReadSubsampler, UnionReadReplicates
+from kb_kaiju.Utils.ReadsCache import ReadsCache
 
 
 class DataStagingUtils(object):
@@ -24,6 +29,15 @@ class DataStagingUtils(object):
 
         self.SE_flag = 'SE'
         self.PE_flag = 'PE'
+        self.set_expand_threads = 4
+
+        # cache of downloaded reads, by versioned ref (off unless reads_cache_dir is set and
+        # reads_cache_max_gb isn't 0: in per-job scratch it would only hold on to the downloads)
+        self.readsCache = None
+        reads_cache_max_bytes = int(float(config.get('reads_cache_max_gb', 0)) * 1024**3)
+        reads_cache_dir = config.get('reads_cache_dir')
+        if reads_cache_max_bytes > 0 and reads_cache_dir:
+            self.readsCache = ReadsCache(reads_cache_dir, reads_cache_max_bytes)
 
         SERVICE_VER = 'release'
 
@@ -33,6 +47,12 @@ class DataStagingUtils(object):
         except Exception as e:
             raise ValueError('Unable to instantiate readsUtils_Client with callbackURL: '+ self.callbackURL +' ERROR: ' + str(e))
 
+        # dataFileUtil_Client
+        try:
+            self.dataFileUtil_Client = DataFileUtil(self.callbackURL, token=self.ctx['token'])
+        except Exception as e:
+            raise ValueError('Unable to instantiate dataFileUtil_Client with callbackURL: '+ self.callbackURL +' ERROR: ' + str(e))
+
         # setAPI_Client
         try:
             #setAPI_Client = SetAPI (url=self.callbackURL, token=self.ctx['token'])  # for SDK local.  local doesn't work for SetAPI
@@ -59,18 +79,31 @@ class DataStagingUtils(object):
         PE_types = ['KBaseFile.PairedEndLibrary', 'KBaseAssembly.PairedEndLibrary']
 
         [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I, WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
-        for input_ref in input_refs:
-            input_info = ws.get_object_info3({'objects': [{'ref': input_ref}]})['infos'][0]
+        input_infos = ws.get_object_info3({'objects': [{'ref': input_ref} for input_ref in input_refs]})['infos']
+
+        # fetch the members of all sets up front, a few at a time
+        set_refs = []
+        for (input_ref, input_info) in zip(input_refs, input_infos):
+            if input_info[TYPE_I].split('-')[0] in ['KBaseSets.ReadsSet'] and input_ref not in set_refs:
+                set_refs.append(input_ref)
+        readsSet_objs = dict()
+        if len(set_refs) > 0:
+            pool = ThreadPool(min(self.set_expand_threads, len(set_refs)))
+            try:
+                for (set_ref, readsSet_obj) in zip(set_refs, pool.map(self._get_reads_set, set_refs)):
+                    readsSet_objs[set_ref] = readsSet_obj
+            finally:
+                pool.close()
+
+        for (input_ref, input_info) in zip(input_refs, input_infos):
             obj_name = input_info[NAME_I]
             type_name = input_info[TYPE_I].split('-')[0]
 
             # ReadsSet
             if type_name in ['KBaseSets.ReadsSet']:
-                try:
-                    input_readsSet_obj = self.setAPI_Client.get_reads_set_v1 ({'ref':input_ref,'include_item_info':1})
-
-                except Exception as e:
-                    raise ValueError('SetAPI FAILURE: Unable to get read library set object from workspace: (' + str(input_ref)+")\n" + str(e))
+                if 'error' in readsSet_objs[input_ref]:
+                    raise ValueError('SetAPI FAILURE: Unable to get read library set object from workspace: (' + str(input_ref)+")\n" + readsSet_objs[input_ref]['error'])
+                input_readsSet_obj = readsSet_objs[input_ref]
 
                 for readsLibrary_obj in input_readsSet_obj['data']['items']:
                     this_reads_ref = readsLibrary_obj['ref']
@@ -89,7 +122,8 @@ class DataStagingUtils(object):
                         raise ValueError ("Can't handle read item type '"+reads_item_type+"' obj_name: '"+this_reads_name+" in Set: '"+str(input_ref)+"'")
                     expanded_input.append({'ref':  this_reads_ref,
                                            'name': this_reads_name,
-                                           'type': this_reads_type
+                                           'type': this_reads_type,
+                                           'versioned_ref': self._versioned_ref_from_info(readsLibrary_obj['info'])
                                        })
             # SingleEnd Library
             elif type_name in SE_types:
@@ -101,7 +135,8 @@ class DataStagingUtils(object):
                 this_reads_type = self.SE_flag
                 expanded_input.append({'ref':  this_reads_ref,
                                        'name': this_reads_name,
-                                       'type': this_reads_type
+                                       'type': this_reads_type,
+                                       'versioned_ref': self._versioned_ref_from_info(input_info)
                                    })
             # PairedEnd Library
             elif type_name in PE_types:
@@ -113,7 +148,8 @@ class DataStagingUtils(object):
                 this_reads_type = self.PE_flag
                 expanded_input.append({'ref':  this_reads_ref,
                                        'name': this_reads_name,
-                                       'type': this_reads_type
+                                       'type': this_reads_type,
+                                       'versioned_ref': self._versioned_ref_from_info(input_info)
                                    })
             else:
                 raise ValueError ("Illegal type in input_refs: "+str(obj_name)+" ("+str(input_ref)+") is of type: '"+str(type_name)+"'")
@@ -122,26 +158,46 @@ class DataStagingUtils(object):
         return expanded_input
 
 
+    def _get_reads_set(self, set_ref):
+        '''
+        ThreadPool worker for expand_input(): errors are handed back rather than raised, so
+        they are reported for the first failing set in input order
+        '''
+        try:
+            return self.setAPI_Client.get_reads_set_v1 ({'ref':set_ref,'include_item_info':1})
+        except Exception as e:
+            return {'error': str(e)}
+
+
     def stage_input(self,
                     input_item=None,
                     subsample_percent=10,
                     subsample_replicates=1,
                     subsample_seed=1,
-                    fasta_file_extension='fastq'):
+                    fasta_file_extension='fastq',
+                    union_replicates=False):
         '''
         Stage input based on an input data reference for Kaiju
 
         input_refs can be a list of references to a PairedEndLibrary, a SingleEndLibrary, or a ReadsSet
 
         This method creates a directory in the scratch area with the set of Fasta/Fastq files, names
-        will have the fasta_file_extension parameter tacked on.
+        will have the fasta_file_extension parameter tacked on.  Reads stored gzip or bzip2 compressed
+        are kept compressed (with a .gz or .bz2 extension after fasta_file_extension).
+
+        With union_replicates, all subsample replicates are written to a single file (or pair of
+        files).  Every replicate item then points at those files and carries the 'union_name' to
+        classify them under, and the 'union_replicates_file' that tells the replicates apart
+        (see UnionReadReplicates).
 
             ex:
 
             staged_input = stage_input({'ref':<ref>,'name':<name>,'type':<type>}, subsample_percent, subsample_replicates, subsample_seed, 'fastq')
 
             staged_input
-            {"input_dir": '...'}
+            {"replicate_input": [{'fwd_file':..., 'rev_file':..., 'ref':..., 'type':..., 'name':...}, ...],
+             "download_bytes": <size of the downloaded reads files>,
+             "staged_bytes": <peak scratch use, downloaded reads plus subsample replicates>}
         '''
         # init
         staged_input = dict()
@@ -163,16 +219,23 @@ class DataStagingUtils(object):
 
         # Paired End Lib
         if input_item['type'] == self.PE_flag:
-            try:
-                readsLibrary = self.readsUtils_Client.download_reads ({'read_libraries': [input_item['ref']],
-                                                                       'interleaved': 'false'})
-            except Exception as e:
-                raise ValueError('Unable to get read library object from workspace: (' + str(input_item['ref']) +")\n" + str(e))
+            reads_files = self._fetch_cached_reads(input_item, input_dir)
+            cache_hit = reads_files is not None
+            if reads_files is None:
+                reads_files = self._download_compressed_reads(input_item, input_dir)
+            from_readsutils = reads_files is None
+            if reads_files is None:
+                try:
+                    readsLibrary = self.readsUtils_Client.download_reads ({'read_libraries': [input_item['ref']],
+                                                                           'interleaved': 'false'})
+                except Exception as e:
+                    raise ValueError('Unable to get read library object from workspace: (' + str(input_item['ref']) +")\n" + str(e))
+                reads_files = readsLibrary['files'][input_item['ref']]['files']
 
-            input_fwd_file_path = readsLibrary['files'][input_item['ref']]['files']['fwd']
-            input_rev_file_path = readsLibrary['files'][input_item['ref']]['files']['rev']
-            fwd_filename = os.path.join(input_dir, input_item['name'] + '.fwd.' + fasta_file_extension)
-            rev_filename = os.path.join(input_dir, input_item['name'] + '.rev.' + fasta_file_extension)
+            input_fwd_file_path = reads_files['fwd']
+            input_rev_file_path = reads_files['rev']
+            fwd_filename = os.path.join(input_dir, input_item['name'] + '.fwd.' + fasta_file_extension + compression_ext(input_fwd_file_path))
+            rev_filename = os.path.join(input_dir, input_item['name'] + '.rev.' + fasta_file_extension + compression_ext(input_rev_file_path))
             if input_fwd_file_path != fwd_filename:
                 shutil.move(input_fwd_file_path, fwd_filename)
             if input_rev_file_path != rev_filename:
@@ -186,20 +249,27 @@ class DataStagingUtils(object):
                 raise ValueError('Error generating reads file '+rev_filename)
             # make sure fasta file isn't empty
             min_fasta_len = 1
-            if not self._fasta_seq_len_at_least(fwd_filename, min_fasta_len):
+            if not fastq_seq_len_at_least(fwd_filename, min_fasta_len):
                 raise ValueError('Reads Library is empty in filename: '+str(fwd_filename))
-            if not self._fasta_seq_len_at_least(rev_filename, min_fasta_len):
+            if not fastq_seq_len_at_least(rev_filename, min_fasta_len):
                 raise ValueError('Reads Library is empty in filename: '+str(rev_filename))
 
         # Single End Lib
         elif input_item['type'] == self.SE_flag:
-            try:
-                readsLibrary = self.readsUtils_Client.download_reads ({'read_libraries': [input_item['ref']]})
-            except Exception as e:
-                raise ValueError('Unable to get read library object from workspace: (' + str(input_item['ref']) +")\n" + str(e))
+            reads_files = self._fetch_cached_reads(input_item, input_dir)
+            cache_hit = reads_files is not None
+            if reads_files is None:
+                reads_files = self._download_compressed_reads(input_item, input_dir)
+            from_readsutils = reads_files is None
+            if reads_files is None:
+                try:
+                    readsLibrary = self.readsUtils_Client.download_reads ({'read_libraries': [input_item['ref']]})
+                except Exception as e:
+                    raise ValueError('Unable to get read library object from workspace: (' + str(input_item['ref']) +")\n" + str(e))
+                reads_files = readsLibrary['files'][input_item['ref']]['files']
 
-            input_fwd_file_path = readsLibrary['files'][input_item['ref']]['files']['fwd']
-            fwd_filename = os.path.join(input_dir, input_item['name'] + '.fwd.' + fasta_file_extension)
+            input_fwd_file_path = reads_files['fwd']
+            fwd_filename = os.path.join(input_dir, input_item['name'] + '.fwd.' + fasta_file_extension + compression_ext(input_fwd_file_path))
             if input_fwd_file_path != fwd_filename:
                 shutil.move(input_fwd_file_path, fwd_filename)
             input_item['fwd_file'] = fwd_filename
@@ -208,311 +278,272 @@ class DataStagingUtils(object):
                 raise ValueError('Error generating reads file '+fwd_filename)
             # make sure fasta file isn't empty
             min_fasta_len = 1
-            if not self._fasta_seq_len_at_least(fwd_filename, min_fasta_len):
+            if not fastq_seq_len_at_least(fwd_filename, min_fasta_len):
                 raise ValueError('Reads Library is empty in filename: '+str(fwd_filename))
 
         else:
             raise ValueError ("No type set for input library "+str(input_item['name'])+" ("+str(input_item['ref'])+")")
 
 
+        if self.readsCache is not None and not cache_hit:
+            cache_files = {'fwd': input_item['fwd_file']}
+            if input_item['type'] == self.PE_flag:
+                cache_files['rev'] = input_item['rev_file']
+            self.readsCache.store(input_item['versioned_ref'], cache_files)
+
+
+        download_bytes = os.path.getsize(input_item['fwd_file'])
+        if input_item['type'] == self.PE_flag:
+            download_bytes += os.path.getsize(input_item['rev_file'])
+
+
         #
         # Subsample
         #
 
         if subsample_percent == 100:
+            # files as stored in Shock haven't been checked by ReadsUtils, and go to kaiju as they are
+            if not from_readsutils:
+                check_fastq(input_item['fwd_file'])
+                if input_item['type'] == self.PE_flag:
+                    check_fastq(input_item['rev_file'])
             replicate_input = [input_item]
         else:
             replicate_input = self._randomly_subsample_reads(input_item,
                                                              subsample_percent    = subsample_percent,
                                                              subsample_replicates = subsample_replicates,
-                                                             subsample_seed       = subsample_seed)
+                                                             subsample_seed       = subsample_seed,
+                                                             union_replicates     = union_replicates)
             # free up disk
             os.remove(input_item['fwd_file'])
             if input_item['type'] == self.PE_flag:
                 os.remove(input_item['rev_file'])
 
 
+        staged_bytes = download_bytes
+        if subsample_percent != 100:
+            for replicate_item in replicate_input[:1] if union_replicates else replicate_input:
+                staged_bytes += os.path.getsize(replicate_item['fwd_file'])
+                if replicate_item['type'] == self.PE_flag:
+                    staged_bytes += os.path.getsize(replicate_item['rev_file'])
+
+
         # return input file info
         #staged_input['input_dir'] = input_dir
         #staged_input['folder_suffix'] = suffix
         staged_input['replicate_input'] = replicate_input
+        staged_input['download_bytes'] = download_bytes
+        staged_input['staged_bytes'] = staged_bytes
         return staged_input
 
 
-    def _randomly_subsample_reads(self,
-                                  input_item=None,
-                                  subsample_percent=100,
-                                  subsample_replicates=1,
-                                  subsample_seed=1):
+    def estimate_staging_bytes(self,
+                               input_item=None,
+                               subsample_percent=10,
+                               subsample_replicates=1):
+        '''
+        Estimate the scratch space stage_input() and kaiju will need for a library, from the
+        file sizes and read/base counts stored in the reads object (no reads are downloaded)
 
-        replicate_files = []
-        split_num = subsample_replicates
+            {'staging_bytes': <downloaded reads + subsample replicates>,
+             'output_bytes':  <kaiju output for the replicates>}
 
-        # for now can only do percentage instead of raw cnt of reads per subsample
-        use_reads_num  = False
-        use_reads_perc = True
-        reads_num = 0  # not used.  subsample_percent used instead
+        Returns None if the object doesn't carry enough to go on (e.g. KBaseAssembly types)
+        '''
+        FASTQ_RECORD_OVERHEAD_BYTES = 64   # header and '+' lines, newlines
+        FASTQ_COMPRESSION_RATIO = 4        # typical gzip ratio for FASTQ
+        KAIJU_OUTPUT_BYTES_PER_READ = 160  # verbose (-v) kaiju output line
 
-        # init randomizer
-        random.seed(subsample_seed)
+        [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I, WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
+        ws = Workspace(self.ws_url, token=self.ctx['token'])
+        try:
+            reads_obj = ws.get_objects2({'objects': [{'ref': input_item['ref'],
+                                                      'included': ['/lib/size', '/lib1/size', '/lib2/size', '/interleaved',
+                                                                   '/read_count', '/total_bases']}]})['data'][0]
+        except Exception as e:
+            raise ValueError('Unable to get read library object from workspace: (' + str(input_item['ref']) +")\n" + str(e))
+
+        type_name = reads_obj['info'][TYPE_I].split('-')[0]
+        reads_data = reads_obj['data']
+        if not type_name.startswith('KBaseFile.'):
+            return None
+
+        file_sizes = [reads_data[lib]['size'] for lib in ['lib', 'lib1', 'lib2'] if 'size' in reads_data.get(lib, {})]
+        compressed_bytes = sum(file_sizes) if file_sizes else None
+        read_count = reads_data.get('read_count')
+        total_bases = reads_data.get('total_bases')
+
+        if read_count is not None and total_bases is not None:
+            fastq_bytes = 2*total_bases + read_count*FASTQ_RECORD_OVERHEAD_BYTES
+        elif compressed_bytes is not None:
+            fastq_bytes = compressed_bytes * FASTQ_COMPRESSION_RATIO
+            read_count = fastq_bytes // (2*150 + FASTQ_RECORD_OVERHEAD_BYTES)
+        else:
+            return None
 
+        # interleaved PE libraries come through ReadsUtils uncompressed (see _download_compressed_reads())
+        if compressed_bytes is None \
+           or (type_name == 'KBaseFile.PairedEndLibrary' and (reads_data.get('interleaved') or 'lib2' not in reads_data)):
+            download_bytes = fastq_bytes
+        else:
+            download_bytes = compressed_bytes
 
-        # Paired End
-        #
+        if int(subsample_percent) == 100:
+            subsample_frac = 1.0
+            replicate_bytes = 0
+        else:
+            subsample_frac = float(subsample_percent) * int(subsample_replicates) / 100.0
+            replicate_bytes = int(fastq_bytes * subsample_frac)
+
+        classified_reads = read_count * subsample_frac
         if input_item['type'] == self.PE_flag:
-            print ("SUBSAMPLING PE library "+input_item['name'])  # DEBUG
+            classified_reads /= 2  # one kaiju output line per pair
 
-            # file paths
-            input_fwd_path = re.sub ("\.fastq$", "", input_item['fwd_file'])
-            input_fwd_path = re.sub ("\.FASTQ$", "", input_fwd_path)
-            input_rev_path = re.sub ("\.fastq$", "", input_item['rev_file'])
-            input_rev_path = re.sub ("\.FASTQ$", "", input_rev_path)
-            output_fwd_paired_file_path_base   = input_fwd_path+"_fwd_paired"
-            output_rev_paired_file_path_base   = input_rev_path+"_rev_paired"
+        return {'staging_bytes': download_bytes + replicate_bytes,
+                'output_bytes':  int(classified_reads * KAIJU_OUTPUT_BYTES_PER_READ)
+                }
 
-            # set up for file io
-            total_paired_reads = 0
-            total_unpaired_fwd_reads = 0
-            total_unpaired_rev_reads = 0
-            total_paired_reads_by_set = []
-            fwd_ids = dict()
-            paired_ids = dict()
-            paired_ids_list = []
-            paired_lib_i = dict()
-            paired_buf_size = 100000
-            recs_beep_n = 1000000
-
-
-            # read fwd file to get fwd ids
-#            rec_cnt = 0  # DEBUG
-            print ("GETTING IDS")  # DEBUG
-            with open (input_item['fwd_file'], 'r', 0) as input_reads_file_handle:
-                rec_line_i = -1
-                for line in input_reads_file_handle:
-                    rec_line_i += 1
-                    if rec_line_i == 3:
-                        rec_line_i = -1
-                    elif rec_line_i == 0:
-                        if not line.startswith('@'):
-                            raise ValueError ("badly formatted rec line: '"+line+"'")
-                        read_id = line.rstrip('\n')
-                        read_id = re.sub ("[ \t]+.*$", "", read_id)
-                        # added below line to manage read_id edge case: e.g. @SRR5891520.1.1 (forward) & @SRR5891520.1.2 (reverse)
-                        read_id = ''.join(read_id.rsplit('.',1)) # replace last '.' with ''
-                        read_id = re.sub ("[\/\.\_\-\:\;][012lrLRfrFR53]\'*$", "", read_id)
-                        fwd_ids[read_id] = True
-
-                        # DEBUG
-#                        if rec_cnt % 100 == 0:
-#                            print ("read_id: '"+str(read_id)+"'")
-#                        rec_cnt += 1
-
-
-            # read reverse to determine paired
-            print ("DETERMINING PAIRED IDS")  # DEBUG
-            with open (input_item['rev_file'], 'r', 0) as input_reads_file_handle:
-                rec_line_i = -1
-                for line in input_reads_file_handle:
-                    rec_line_i += 1
-                    if rec_line_i == 3:
-                        rec_line_i = -1
-                    elif rec_line_i == 0:
-                        if not line.startswith('@'):
-                            raise ValueError ("badly formatted rec line: '"+line+"'")
-                        read_id = line.rstrip('\n')
-                        read_id = re.sub ("[ \t]+.*$", "", read_id)
-                        # added below line to manage read_id edge case: e.g. @SRR5891520.1.1 (forward) & @SRR5891520.1.2 (reverse)
-                        read_id = ''.join(read_id.rsplit('.',1)) # replace last '.' with ''
-                        read_id = re.sub ("[\/\.\_\-\:\;][012lrLRfrFR53]\'*$", "", read_id)
-                        if fwd_ids.get(read_id, False):
-                            paired_ids[read_id] = True
-                            paired_ids_list.append(read_id)
-
-                        # DEBUG
-#                        if rec_cnt % 100 == 0:
-#                            print ("read_id: '"+str(read_id)+"'")
-#                        rec_cnt += 1
-            total_paired_reads = len(paired_ids_list)
-            print ("TOTAL PAIRED READS CNT: "+str(total_paired_reads))  # DEBUG
-
-
-            # Determine sublibrary sizes
-            if use_reads_num:
-                reads_per_lib = reads_num
-                if reads_per_lib > total_paired_reads // split_num:
-                    raise ValueError ("must specify reads_num <= total_paired_reads_cnt / split_num.  You have reads_num:"+str(reads_num)+" > total_paired_reads_cnt:"+str(total_paired_reads)+" / split_num:"+str(split_num)+".  Instead try reads_num <= "+str(total_paired_reads // split_num))
-            elif use_reads_perc:
-                reads_per_lib = int ((subsample_percent/100.0) * total_paired_reads)
-                if reads_per_lib > total_paired_reads // split_num:
-                    raise ValueError ("must specify reads_perc <= 1 / split_num.  You have reads_perc:"+str(subsample_percent)+" > 1 / split_num:"+str(split_num)+".  Instead try reads_perc <= "+ str(int(100 * 1/split_num)))
-            else:
-                raise ValueError ("error in logic reads_num vs. reads_perc logic")
 
+    def _versioned_ref_from_info(self, obj_info):
+        [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I, WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
+        return str(obj_info[WSID_I])+'/'+str(obj_info[OBJID_I])+'/'+str(obj_info[VERSION_I])
 
-            # Determine random membership in each sublibrary
-            print ("GETTING RANDOM SUBSAMPLES")  # DEBUG
-            for i,read_id in enumerate(random.sample (paired_ids_list, reads_per_lib * split_num)):
-                lib_i = i % split_num
-                paired_lib_i[read_id] = lib_i
 
+    def _fetch_cached_reads(self, input_item, input_dir):
+        '''
+        Reads files of a library from the ReadsCache, linked into input_dir as by
+        _download_compressed_reads(), or None if the cache is off or doesn't have them
+        '''
+        if self.readsCache is None:
+            return None
+        if 'versioned_ref' not in input_item:
+            ws = Workspace(self.ws_url, token=self.ctx['token'])
+            try:
+                input_info = ws.get_object_info3({'objects': [{'ref': input_item['ref']}]})['infos'][0]
+            except Exception as e:
+                raise ValueError('Unable to get read library object info from workspace: (' + str(input_item['ref']) +")\n" + str(e))
+            input_item['versioned_ref'] = self._versioned_ref_from_info(input_info)
+        return self.readsCache.fetch(input_item['versioned_ref'], input_dir, input_item['name'])
 
-            # split fwd paired
-            print ("WRITING FWD SPLIT PAIRED")  # DEBUG
-            paired_output_reads_file_handles = []
-            for lib_i in range(split_num):
-                paired_output_reads_file_handles.append(open (output_fwd_paired_file_path_base+"-"+str(lib_i)+".fastq", 'w', paired_buf_size))
-                total_paired_reads_by_set.append(0)
-
-            rec_buf = []
-            last_read_id = None
-            paired_cnt = 0
-            capture_type_paired = False
-
-            with open (input_item['fwd_file'], 'r', 0) as input_reads_file_handle:
-                rec_line_i = -1
-                for line in input_reads_file_handle:
-                    rec_line_i += 1
-                    if rec_line_i == 3:
-                        rec_line_i = -1
-                    elif rec_line_i == 0:
-                        if not line.startswith('@'):
-                            raise ValueError ("badly formatted rec line: '"+line+"'")
-                        if last_read_id != None:
-                            if capture_type_paired:
-                                lib_i = paired_lib_i[last_read_id]
-                                paired_output_reads_file_handles[lib_i].writelines(rec_buf)
-                                paired_cnt += 1
-                                total_paired_reads_by_set[lib_i] += 1
-                                if paired_cnt != 0 and paired_cnt % recs_beep_n == 0:
-                                    print ("\t"+str(paired_cnt)+" recs processed")
-                            else:
-                                #unpaired_fwd_buf.extend(rec_buf)
-                                pass
-                            rec_buf = []
-                        read_id = line.rstrip('\n')
-                        read_id = re.sub ("[ \t]+.*$", "", read_id)
-                        # added below line to manage read_id edge case: e.g. @SRR5891520.1.1 (forward) & @SRR5891520.1.2 (reverse)
-                        read_id = ''.join(read_id.rsplit('.',1)) # replace last '.' with ''
-                        read_id = re.sub ("[\/\.\_\-\:\;][012lrLRfrFR53]\'*$", "", read_id)
-                        last_read_id = read_id
-                        try:
-                            found = paired_lib_i[read_id]
-                            capture_type_paired = True
-                        except:
-                            total_unpaired_fwd_reads += 1
-                            capture_type_paired = False
-                    rec_buf.append(line)
-                # last rec
-                if len(rec_buf) > 0:
-                    if capture_type_paired:
-                        lib_i = paired_lib_i[last_read_id]
-                        paired_output_reads_file_handles[lib_i].writelines(rec_buf)
-                        paired_cnt += 1
-                        if paired_cnt != 0 and paired_cnt % recs_beep_n == 0:
-                            print ("\t"+str(paired_cnt)+" recs processed")
-                    else:
-                        #unpaired_fwd_buf.extend(rec_buf)
-                        pass
-                    rec_buf = []
 
-            for output_handle in paired_output_reads_file_handles:
-                output_handle.close()
+    def _download_compressed_reads(self, input_item, input_dir):
+        '''
+        Fetch the reads files of a KBaseFile library from Shock as they are stored (usually gzipped),
+        rather than through ReadsUtils, which always writes uncompressed copies to scratch.
+
+        Returns {'fwd': <path>, 'rev': <path>} ('rev' only for PE), or None if the library needs
+        ReadsUtils (interleaved PE libraries, KBaseAssembly types, and files that aren't plain, gzip
+        or bzip2 FASTQ, which ReadsUtils converts).  Only the start of each file is checked here;
+        every record is checked as the reads are subsampled, or by stage_input() before kaiju.
+        '''
+        [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I, WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
+        ws = Workspace(self.ws_url, token=self.ctx['token'])
+        try:
+            reads_obj = ws.get_objects2({'objects': [{'ref': input_item['ref'],
+                                                      'included': ['/lib', '/lib1', '/lib2', '/interleaved']}]})['data'][0]
+        except Exception as e:
+            raise ValueError('Unable to get read library object from workspace: (' + str(input_item['ref']) +")\n" + str(e))
+
+        type_name = reads_obj['info'][TYPE_I].split('-')[0]
+        reads_data = reads_obj['data']
+        if type_name == 'KBaseFile.PairedEndLibrary':
+            if reads_data.get('interleaved') or 'lib2' not in reads_data:
+                return None
+            shock_ids = {'fwd': reads_data['lib1']['file']['id'],
+                         'rev': reads_data['lib2']['file']['id']}
+        elif type_name == 'KBaseFile.SingleEndLibrary':
+            shock_ids = {'fwd': reads_data['lib']['file']['id']}
+        else:
+            return None
+
+        reads_files = dict()
+        for direction in shock_ids.keys():
+            download_path = os.path.join(input_dir, input_item['name'] + '.' + direction + '.download')
+            try:
+                download_info = self.dataFileUtil_Client.shock_to_file({'shock_id': shock_ids[direction],
+                                                                        'file_path': download_path})
+            except Exception as e:
+                raise ValueError('Unable to download reads file from Shock for read library: (' + str(input_item['ref']) +")\n" + str(e))
+            reads_files[direction] = download_info['file_path']
 
-            print ("\t"+str(paired_cnt)+" FWD recs processed")
+        for direction in reads_files.keys():
+            if not starts_as_fastq(reads_files[direction]):
+                print ("Reads file of "+input_item['name']+" isn't stored as FASTQ, downloading it through ReadsUtils")
+                for reads_path in reads_files.values():
+                    os.remove(reads_path)
+                return None
+        return reads_files
 
 
-            # split rev paired
-            print ("WRITING REV SPLIT PAIRED")  # DEBUG
-            paired_output_reads_file_handles = []
-            for lib_i in range(split_num):
-                paired_output_reads_file_handles.append(open (output_rev_paired_file_path_base+"-"+str(lib_i)+".fastq", 'w', paired_buf_size))
-
-            rec_buf = []
-            last_read_id = None
-            paired_cnt = 0
-            capture_type_paired = False
-
-            with open (input_item['rev_file'], 'r', 0) as input_reads_file_handle:
-                rec_line_i = -1
-                for line in input_reads_file_handle:
-                    rec_line_i += 1
-                    if rec_line_i == 3:
-                        rec_line_i = -1
-                    elif rec_line_i == 0:
-                        if not line.startswith('@'):
-                            raise ValueError ("badly formatted rec line: '"+line+"'")
-                        if last_read_id != None:
-                            if capture_type_paired:
-                                lib_i = paired_lib_i[last_read_id]
-                                paired_output_reads_file_handles[lib_i].writelines(rec_buf)
-                                paired_cnt += 1
-                                if paired_cnt != 0 and paired_cnt % recs_beep_n == 0:
-                                    print ("\t"+str(paired_cnt)+" recs processed")
-                            else:
-                                #unpaired_fwd_buf.extend(rec_buf)
-                                pass
-                            rec_buf = []
-                        read_id = line.rstrip('\n')
-                        read_id = re.sub ("[ \t]+.*$", "", read_id)
-                        # added below line to manage read_id edge case: e.g. @SRR5891520.1.1 (forward) & @SRR5891520.1.2 (reverse)
-                        read_id = ''.join(read_id.rsplit('.',1)) # replace last '.' with ''
-                        read_id = re.sub ("[\/\.\_\-\:\;][012lrLRfrFR53]\'*$", "", read_id)
-                        last_read_id = read_id
-                        try:
-                            found = paired_lib_i[read_id]
-                            capture_type_paired = True
-                        except:
-                            total_unpaired_rev_reads += 1
-                            capture_type_paired = False
-                    rec_buf.append(line)
-                # last rec
-                if len(rec_buf) > 0:
-                    if capture_type_paired:
-                        lib_i = paired_lib_i[last_read_id]
-                        paired_output_reads_file_handles[lib_i].writelines(rec_buf)
-                        paired_cnt += 1
-                        if paired_cnt != 0 and paired_cnt % recs_beep_n == 0:
-                            print ("\t"+str(paired_cnt)+" recs processed")
-                    else:
-                        #unpaired_fwd_buf.extend(rec_buf)
-                        pass
-                    rec_buf = []
+    def _randomly_subsample_reads(self,
+                                  input_item=None,
+                                  subsample_percent=100,
+                                  subsample_replicates=1,
+                                  subsample_seed=1,
+                                  union_replicates=False):
+
+        replicate_files = []
+        split_num = subsample_replicates
+        union_replicates = union_replicates and split_num > 1
 
-            for output_handle in paired_output_reads_file_handles:
-                output_handle.close()
+        # membership is derived from (read_id, subsample_seed), so one pass per file
+        subsampler = ReadSubsampler(subsample_percent    = subsample_percent,
+                                    subsample_replicates = subsample_replicates,
+                                    subsample_seed       = subsample_seed)
+        read_replicates = UnionReadReplicates() if union_replicates else None
 
-            print ("\t"+str(paired_cnt)+" REV recs processed")
+
+        # Paired End
+        #
+        if input_item['type'] == self.PE_flag:
+            print ("SUBSAMPLING PE library "+input_item['name'])  # DEBUG
+
+            # file paths
+            input_fwd_path = re.sub ("\.(fastq|FASTQ)(\.gz|\.bz2)?$", "", input_item['fwd_file'])
+            input_rev_path = re.sub ("\.(fastq|FASTQ)(\.gz|\.bz2)?$", "", input_item['rev_file'])
+            output_fwd_paired_file_path_base   = input_fwd_path+"_fwd_paired"
+            output_rev_paired_file_path_base   = input_rev_path+"_rev_paired"
+            output_fwd_paired_file_paths = [output_fwd_paired_file_path_base+"-"+str(lib_i)+".fastq" for lib_i in range(split_num)]
+            output_rev_paired_file_paths = [output_rev_paired_file_path_base+"-"+str(lib_i)+".fastq" for lib_i in range(split_num)]
+            if union_replicates:
+                output_fwd_paired_file_paths = [output_fwd_paired_file_path_base+"-union.fastq"] * split_num
+                output_rev_paired_file_paths = [output_rev_paired_file_path_base+"-union.fastq"] * split_num
+                union_replicates_file_path = output_fwd_paired_file_path_base+"-union.replicates.npz"
+
+            # split paired
+            print ("WRITING SPLIT PAIRED")  # DEBUG
+            subsample_cnts = subsampler.subsample_paired_end(input_item['fwd_file'],
+                                                             input_item['rev_file'],
+                                                             output_fwd_paired_file_paths,
+                                                             output_rev_paired_file_paths,
+                                                             read_replicates)
+            total_paired_reads_by_set = subsample_cnts['reads_by_set']
+            if union_replicates:
+                read_replicates.save(union_replicates_file_path)
 
 
             # summary
             report = 'SUMMARY FOR SUBSAMPLE OF READ LIBRARY: '+input_item['name']+"\n"
-            report += "TOTAL PAIRED READS: "+str(total_paired_reads)+"\n"
-            report += "TOTAL UNPAIRED FWD READS (discarded): "+str(total_unpaired_fwd_reads)+"\n"
-            report += "TOTAL UNPAIRED REV READS (discarded): "+str(total_unpaired_rev_reads)+"\n"
+            report += "TOTAL FWD READS: "+str(subsample_cnts['total_fwd_reads'])+"\n"
+            report += "TOTAL REV READS: "+str(subsample_cnts['total_rev_reads'])+"\n"
+            report += "TOTAL SUBSAMPLED PAIRED READS: "+str(sum(total_paired_reads_by_set))+"\n"
+            report += "TOTAL SUBSAMPLED UNPAIRED FWD READS (discarded): "+str(subsample_cnts['unpaired_fwd_reads'])+"\n"
+            report += "TOTAL SUBSAMPLED UNPAIRED REV READS (discarded): "+str(subsample_cnts['unpaired_rev_reads'])+"\n"
             report += "\n"
             for lib_i in range(split_num):
                 report += "PAIRED READS IN SET "+str(lib_i)+": "+str(total_paired_reads_by_set[lib_i])+"\n"
             print (report)
 
 
-            # make replicate objects to return
-#        for replicate_i,replicate_item in enumerate(replicate_files):
-#            replicate_input.append({'fwd_file': replicate_item['fwd_file'],
-#                                    'type': input_item['type'],
-#                                    'name': input_item['name']+"-"+str(replicate_i)
-#                                })
-#            if input_item['type'] == self.PE_flag:
-#                replicate_input[replicate_i]['rev_file'] = replicate_item['rev_file']
-
             print ("MAKING REPLICATE OBJECT")  # DEBUG
-            paired_obj_refs = []
             for lib_i in range(split_num):
-                output_fwd_paired_file_path = output_fwd_paired_file_path_base+"-"+str(lib_i)+".fastq"
-                output_rev_paired_file_path = output_rev_paired_file_path_base+"-"+str(lib_i)+".fastq"
+                output_fwd_paired_file_path = output_fwd_paired_file_paths[lib_i]
+                output_rev_paired_file_path = output_rev_paired_file_paths[lib_i]
                 if not os.path.isfile (output_fwd_paired_file_path) \
                      or os.path.getsize (output_fwd_paired_file_path) == 0 \
                    or not os.path.isfile (output_rev_paired_file_path) \
-                     or os.path.getsize (output_rev_paired_file_path) == 0:
+                     or os.path.getsize (output_rev_paired_file_path) == 0 \
+                   or total_paired_reads_by_set[lib_i] == 0:
 
                     raise ValueError ("failed to create paired output")
                 else:
@@ -523,6 +554,9 @@ class DataStagingUtils(object):
                                             'type': input_item['type'],
                                             'name': input_item['name']+'-'+zero_pad+str(lib_i+1)
                                         })
+                    if union_replicates:
+                        replicate_files[-1]['union_name'] = input_item['name']+'-union'
+                        replicate_files[-1]['union_replicates_file'] = union_replicates_file_path
 
         # SingleEndLibrary
         #
@@ -530,129 +564,25 @@ class DataStagingUtils(object):
             print ("SUBSAMPLING SE library "+input_item['name'])
 
             # file paths
-            input_fwd_path = re.sub ("\.fastq$", "", input_item['fwd_file'])
-            input_fwd_path = re.sub ("\.FASTQ$", "", input_fwd_path)
+            input_fwd_path = re.sub ("\.(fastq|FASTQ)(\.gz|\.bz2)?$", "", input_item['fwd_file'])
             output_fwd_paired_file_path_base   = input_fwd_path+"_fwd_paired"
-
-            # get "paired" ids
-            print ("DETERMINING IDS")  # DEBUG
-            paired_ids = dict()
-            paired_ids_list = []
-            paired_lib_i = dict()
-            paired_buf_size = 100000
-            recs_beep_n = 100000
-
-            with open (input_item['fwd_file'], 'r', 0) as input_reads_file_handle:
-                rec_line_i = -1
-                for line in input_reads_file_handle:
-                    rec_line_i += 1
-                    if rec_line_i == 3:
-                        rec_line_i = -1
-                    elif rec_line_i == 0:
-                        if not line.startswith('@'):
-                            raise ValueError ("badly formatted rec line: '"+line+"'")
-                        read_id = line.rstrip('\n')
-                        read_id = re.sub ("[ \t]+.*$", "", read_id)
-                        # added below line to manage read_id edge case: e.g. @SRR5891520.1.1 (forward) & @SRR5891520.1.2 (reverse)
-                        read_id = ''.join(read_id.rsplit('.',1)) # replace last '.' with ''
-                        read_id = re.sub ("[\/\.\_\-\:\;][012lrLRfrFR53]\'*$", "", read_id)
-                        if read_id in paired_ids:
-                            raise ValueError ("repeat read_id: "+read_id)
-                        paired_ids[read_id] = True
-                        paired_ids_list.append(read_id)
-                        # DEBUG
-#                        if rec_cnt % 100 == 0:
-#                            print ("read_id: '"+str(read_id)+"'")
-#                        rec_cnt += 1
-            total_paired_reads = len(paired_ids_list)
-            print ("TOTAL READS CNT: "+str(total_paired_reads))  # DEBUG
-
-
-            # Determine sublibrary sizes
-            if use_reads_num:
-                reads_per_lib = reads_num
-                if reads_per_lib > total_paired_reads // split_num:
-                    raise ValueError ("must specify reads_num <= total_paired_reads_cnt / split_num.  You have reads_num:"+str(reads_num)+" > total_paired_reads_cnt:"+str(total_paired_reads)+" / split_num:"+str(split_num)+".  Instead try reads_num <= "+str(total_paired_reads // split_num))
-            elif use_reads_perc:
-                reads_per_lib = int ((subsample_percent/100.0) * total_paired_reads)
-                if reads_per_lib > total_paired_reads // split_num:
-                    raise ValueError ("must specify reads_perc <= 1 / split_num.  You have reads_perc:"+str(subsample_percent)+" > 1 / split_num:"+str(split_num)+".  Instead try reads_perc <= "+ str(int(100 * 1/split_num)))
-            else:
-                raise ValueError ("error in logic reads_num vs. reads_perc logic")
-
-
-            # Determine random membership in each sublibrary
-            print ("GETTING RANDOM SUBSAMPLES")  # DEBUG
-            for i,read_id in enumerate(random.sample (paired_ids_list, reads_per_lib * split_num)):
-                lib_i = i % split_num
-                paired_lib_i[read_id] = lib_i
-
-
-            # set up for file io
-            total_paired_reads = 0
-            total_paired_reads_by_set = []
-            paired_buf_size = 1000000
-
+            output_fwd_paired_file_paths = [output_fwd_paired_file_path_base+"-"+str(lib_i)+".fastq" for lib_i in range(split_num)]
+            if union_replicates:
+                output_fwd_paired_file_paths = [output_fwd_paired_file_path_base+"-union.fastq"] * split_num
+                union_replicates_file_path = output_fwd_paired_file_path_base+"-union.replicates.npz"
 
             # split reads
             print ("WRITING SPLIT SINGLE END READS")  # DEBUG
-            paired_output_reads_file_handles = []
-            for lib_i in range(split_num):
-                paired_output_reads_file_handles.append(open (output_fwd_paired_file_path_base+"-"+str(lib_i)+".fastq", 'w', paired_buf_size))
-                total_paired_reads_by_set.append(0)
-
-            rec_buf = []
-            last_read_id = None
-            paired_cnt = 0
-            recs_beep_n = 1000000
-            with open (input_item['fwd_file'], 'r', 0) as input_reads_file_handle:
-                rec_line_i = -1
-                for line in input_reads_file_handle:
-                    rec_line_i += 1
-                    if rec_line_i == 3:
-                        rec_line_i = -1
-                    elif rec_line_i == 0:
-                        if not line.startswith('@'):
-                            raise ValueError ("badly formatted rec line: '"+line+"'")
-                        total_paired_reads += 1
-                        if last_read_id != None:
-                            try:
-                                lib_i = paired_lib_i[last_read_id]
-                                total_paired_reads_by_set[lib_i] += 1
-                                paired_output_reads_file_handles[lib_i].writelines(rec_buf)
-                                paired_cnt += 1
-                            except:
-                                pass
-                            if paired_cnt != 0 and paired_cnt % recs_beep_n == 0:
-                                print ("\t"+str(paired_cnt)+" recs processed")
-                            rec_buf = []
-                        read_id = line.rstrip('\n')
-                        read_id = re.sub ("[ \t]+.*$", "", read_id)
-                        # added below line to manage read_id edge case: e.g. @SRR5891520.1.1 (forward) & @SRR5891520.1.2 (reverse)
-                        read_id = ''.join(read_id.rsplit('.',1)) # replace last '.' with ''
-                        read_id = re.sub ("[\/\.\_\-\:\;][012lrLRfrFR53]\'*$", "", read_id)
-                        last_read_id = read_id
-                    rec_buf.append(line)
-                # last rec
-                if len(rec_buf) > 0:
-                    if last_read_id != None:
-                        try:
-                            lib_i = paired_lib_i[last_read_id]
-                            total_paired_reads_by_set[lib_i] += 1
-                            paired_output_reads_file_handles[lib_i].writelines(rec_buf)
-                            paired_cnt += 1
-                        except:
-                            pass
-                    if paired_cnt != 0 and paired_cnt % recs_beep_n == 0:
-                        print ("\t"+str(paired_cnt)+" recs processed")
-                    rec_buf = []
-
-            for output_handle in paired_output_reads_file_handles:
-                output_handle.close()
+            subsample_cnts = subsampler.subsample_single_end(input_item['fwd_file'],
+                                                             output_fwd_paired_file_paths,
+                                                             read_replicates)
+            total_paired_reads_by_set = subsample_cnts['reads_by_set']
+            if union_replicates:
+                read_replicates.save(union_replicates_file_path)
 
             # summary
             report = 'SUMMARY FOR SUBSAMPLE OF READ LIBRARY: '+input_item['name']+"\n"
-            report += "TOTAL READS: "+str(total_paired_reads)+"\n"
+            report += "TOTAL READS: "+str(subsample_cnts['total_reads'])+"\n"
             for lib_i in range(split_num):
                 report += "SINGLE END READS IN SET "+str(lib_i)+": "+str(total_paired_reads_by_set[lib_i])+"\n"
             print (report)
@@ -660,11 +590,11 @@ class DataStagingUtils(object):
 
             # make replicate objects to return
             print ("MAKING REPLICATE OBJECTS")  # DEBUG
-            paired_obj_refs = []
             for lib_i in range(split_num):
-                output_fwd_paired_file_path = output_fwd_paired_file_path_base+"-"+str(lib_i)+".fastq"
+                output_fwd_paired_file_path = output_fwd_paired_file_paths[lib_i]
                 if not os.path.isfile (output_fwd_paired_file_path) \
-                     or os.path.getsize (output_fwd_paired_file_path) == 0:
+                     or os.path.getsize (output_fwd_paired_file_path) == 0 \
+                   or total_paired_reads_by_set[lib_i] == 0:
 
                     raise ValueError ("failed to create paired output")
                 else:
@@ -674,6 +604,9 @@ class DataStagingUtils(object):
                                             'type': input_item['type'],
                                             'name': input_item['name']+'-'+zero_pad+str(lib_i+1)
                                         })
+                    if union_replicates:
+                        replicate_files[-1]['union_name'] = input_item['name']+'-union'
+                        replicate_files[-1]['union_replicates_file'] = union_replicates_file_path
 
 
         else:
@@ -682,19 +615,3 @@ class DataStagingUtils(object):
 
         return replicate_files
 
-
-    def _fasta_seq_len_at_least(self, fasta_path, min_fasta_len=1):
-        '''
-        counts the number of non-header, non-whitespace characters in a FASTA file
-        '''
-        seq_len = 0
-        with open (fasta_path, 'r', 0) as fasta_handle:
-            for line in fasta_handle:
-                line = line.strip()
-                if line.startswith('>'):
-                    continue
-                line = line.replace(' ','')
-                seq_len += len(line)
-                if seq_len >= min_fasta_len:
-                    return True
-        return False
@@ -0,0 +1,335 @@
+import os
+import bz2
+import gzip
+import shutil
+import threading
+from itertools import repeat
+
+from kb_kaiju.Utils.DBResidency import fadvise, drop_from_page_cache, POSIX_FADV_DONTNEED
+
+
+# read id normalization (mate suffixes such as /1, .2, _R, -f, :3' are dropped)
+MATE_SUFFIX_SEPARATORS = b"/._-:;"
+MATE_SUFFIX_CHARS = b"012lrLRfrFR53"
+
+GZIP_MAGIC = b'\x1f\x8b'
+BZIP2_MAGIC = b'BZh'
+
+
+def reads_file_compression(reads_path):
+    '''
+    Returns 'gz', 'bz2' or None, going by the magic bytes of the file
+    '''
+    with open (reads_path, 'rb') as reads_handle:
+        magic = reads_handle.read(3)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gz'
+    if magic.startswith(BZIP2_MAGIC):
+        return 'bz2'
+    return None
+
+
+def compression_ext(reads_path):
+    '''
+    File extension matching the compression of a reads file ('.gz', '.bz2' or '')
+    '''
+    compression = reads_file_compression(reads_path)
+    if compression is None:
+        return ''
+    return '.'+compression
+
+
+def open_fastq(reads_path):
+    '''
+    Opens a plain, gzip or bzip2 reads file for binary reading, decompressing
+    on the fly
+    '''
+    compression = reads_file_compression(reads_path)
+    if compression == 'gz':
+        return gzip.open(reads_path, 'rb')
+    if compression == 'bz2':
+        return MultiStreamBZ2File(reads_path)
+    return open(reads_path, 'rb')
+
+
+class MultiStreamBZ2File(object):
+    '''
+    Reads a bzip2 file of one or more concatenated streams, as written by pbzip2
+    and other parallel compressors.  py2's bz2.BZ2File stops at the end of the
+    first stream, silently dropping the rest of the file.  As with py3's BZ2File,
+    anything after the last stream that isn't another stream is ignored.
+    '''
+
+    def __init__(self, path, raw_buf_size=1024*1024):
+        self.fileobj = open(path, 'rb')
+        self.raw_buf_size = raw_buf_size
+        self._decompressor = bz2.BZ2Decompressor()
+        self._stream_data_in = False  # the current stream has been fed data
+        self._buffer = b''
+        self._done = False
+
+
+    def read(self, size=-1):
+        while not self._done and (size is None or size < 0 or len(self._buffer) < size):
+            raw = self.fileobj.read(self.raw_buf_size)
+            if not raw:
+                if self._stream_data_in and not self._stream_ended():
+                    raise EOFError ("compressed file ended before the end-of-stream marker was reached: "+str(self.fileobj.name))
+                self._done = True
+                break
+            self._decompress(raw)
+        if size is None or size < 0 or size >= len(self._buffer):
+            (data, self._buffer) = (self._buffer, b'')
+        else:
+            (data, self._buffer) = (self._buffer[:size], self._buffer[size:])
+        return data
+
+
+    def _decompress(self, raw):
+        while raw and not self._done:
+            if not self._stream_data_in and not raw.startswith(BZIP2_MAGIC[:len(raw)]):
+                self._done = True  # trailing garbage
+                return
+            self._buffer += self._decompressor.decompress(raw)
+            self._stream_data_in = True
+            raw = self._decompressor.unused_data
+            # the next stream starts in what's left, or (stream ended with the raw block) in the next block
+            if raw or self._stream_ended():
+                self._decompressor = bz2.BZ2Decompressor()
+                self._stream_data_in = False
+
+
+    def _stream_ended(self):
+        # py2's decompressor has no eof attribute, but raises once the end of stream is reached.
+        # With no new input it may still hand back output it held on to
+        try:
+            self._buffer += self._decompressor.decompress(b'')
+        except EOFError:
+            return True
+        return False
+
+
+    def tell_raw(self):
+        return self.fileobj.tell()
+
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+
+    def close(self):
+        self.fileobj.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def normalize_read_id(header_line):
+    '''
+    Reduce a FASTQ header line to the read id shared by both mates of a pair
+    (same rules that have always been used for pairing fwd and rev reads)
+    '''
+    # string methods rather than re: this runs once per read and dominates parsing time
+    read_id = header_line.rstrip(b'\r\n').split(b' ', 1)[0].split(b'\t', 1)[0]
+    # added below line to manage read_id edge case: e.g. @SRR5891520.1.1 (forward) & @SRR5891520.1.2 (reverse)
+    last_dot = read_id.rfind(b'.')  # replace last '.' with ''
+    if last_dot >= 0:
+        read_id = read_id[:last_dot] + read_id[last_dot+1:]
+    # mate suffix: [/._-:;][012lrLRfrFR53] followed by any number of "'"
+    suffix_start = len(read_id.rstrip(b"'")) - 2
+    if suffix_start >= 0 \
+       and read_id[suffix_start:suffix_start+1] in MATE_SUFFIX_SEPARATORS \
+       and read_id[suffix_start+1:suffix_start+2] in MATE_SUFFIX_CHARS:
+        read_id = read_id[:suffix_start]
+    return read_id
+
+
+class FastqReader(object):
+    '''
+    Iterates over the records of a FASTQ file, reading it in large binary
+    blocks rather than line by line.  gzip and bzip2 files are decompressed
+    as they are read.
+
+        for (read_id, rec) in FastqReader(path):
+            ...
+
+    read_id is the normalized id (see normalize_read_id()) and rec the full
+    4-line record as bytes, including the trailing newline.  Records are
+    checked for 4-line framing ('@' header, '+' separator, sequence and
+    quality of equal length) and a ValueError is raised on the first bad one.
+
+    Pages of the file that have been read are dropped from the page cache as it
+    goes (reads are streamed once), so they don't evict the kaiju index.
+    '''
+
+    def __init__(self, fastq_path, buf_size=4*1024*1024):
+        self.fastq_path = fastq_path
+        self.buf_size = buf_size
+        self.drop_cache_bytes = 64*1024*1024
+        self.n_records = 0
+
+
+    def __iter__(self):
+        self.n_records = 0
+        pending_lines = []
+        tail = b''
+        dropped_offset = 0
+        with open_fastq(self.fastq_path) as fastq_handle:
+            while True:
+                block = fastq_handle.read(self.buf_size)
+                if not block:
+                    break
+                read_offset = self._raw_offset(fastq_handle)
+                if read_offset is not None and read_offset - dropped_offset >= self.drop_cache_bytes:
+                    fadvise(fastq_handle.fileno(), 0, read_offset, POSIX_FADV_DONTNEED)
+                    dropped_offset = read_offset
+                lines = (tail + block).split(b'\n')
+                tail = lines.pop()
+                if pending_lines:
+                    lines = pending_lines + lines
+                full_lines_n = len(lines) - len(lines) % 4
+                for id_and_rec in self._records(lines[:full_lines_n]):
+                    yield id_and_rec
+                pending_lines = lines[full_lines_n:]
+        drop_from_page_cache(self.fastq_path)
+
+        # last line may lack a newline, and files may end with blank lines
+        if tail:
+            pending_lines.append(tail)
+        while pending_lines and not pending_lines[-1].strip():
+            pending_lines.pop()
+        if len(pending_lines) % 4 != 0:
+            raise ValueError ("truncated FASTQ record "+str(self.n_records+1)+" at end of file: "+str(self.fastq_path))
+        for id_and_rec in self._records(pending_lines):
+            yield id_and_rec
+
+
+    def _raw_offset(self, fastq_handle):
+        '''
+        How far into the (compressed) file a handle from open_fastq() has read, where that can be told
+        '''
+        if isinstance(fastq_handle, gzip.GzipFile):
+            return fastq_handle.fileobj.tell()
+        if isinstance(fastq_handle, MultiStreamBZ2File):
+            return fastq_handle.tell_raw()
+        return fastq_handle.tell()
+
+
+    def _records(self, lines):
+        '''
+        (normalized read id, record) for each 4 lines, checked and built a
+        block at a time with joins and maps rather than a Python loop per record
+        '''
+        headers = lines[0::4]
+        seqs = lines[1::4]
+        seps = lines[2::4]
+        quals = lines[3::4]
+        # lines never contain '\n', so every header starts with '@' if '\n@' occurs once per header
+        if (b'\n'+b'\n'.join(headers)).count(b'\n@') != len(headers) \
+           or (b'\n'+b'\n'.join(seps)).count(b'\n+') != len(seps) \
+           or list(map(len, seqs)) != list(map(len, quals)) \
+           or b'\r' in b''.join(seqs):
+            self._check_records(headers, seqs, seps, quals)
+        self.n_records += len(headers)
+        return zip(map(normalize_read_id, headers),
+                   map(b'\n'.join, zip(headers, seqs, seps, quals, repeat(b''))))
+
+
+    def _check_records(self, headers, seqs, seps, quals):
+        '''
+        Record by record check, raising on the first bad record
+        '''
+        for rec_i in range(len(headers)):
+            if not headers[rec_i].startswith(b'@') \
+               or not seps[rec_i].startswith(b'+') \
+               or len(seqs[rec_i].rstrip(b'\r')) != len(quals[rec_i].rstrip(b'\r')):
+                raise ValueError ("badly formatted FASTQ record "+str(self.n_records+rec_i+1)+" in "+str(self.fastq_path)+": '"+headers[rec_i].decode('utf-8', 'replace')+"'")
+
+
+def fastq_seq_len_at_least(fastq_path, min_seq_len=1):
+    '''
+    True if the sequences of a FASTQ file add up to at least min_seq_len bases
+    '''
+    seq_len = 0
+    for (read_id, rec) in FastqReader(fastq_path):
+        seq_len += len(rec.split(b'\n', 2)[1].rstrip(b'\r'))
+        if seq_len >= min_seq_len:
+            return True
+    return False
+
+
+def starts_as_fastq(fastq_path):
+    '''
+    True if a plain, gzip or bzip2 reads file is empty or its first block holds
+    well formed FASTQ records (False for FASTA, other formats or corrupt compression)
+    '''
+    records = iter(FastqReader(fastq_path))
+    try:
+        next(records)
+    except StopIteration:
+        pass
+    except (ValueError, IOError, EOFError):
+        return False
+    finally:
+        records.close()
+    return True
+
+
+def check_fastq(fastq_path):
+    '''
+    Reads a whole FASTQ file through, raising a ValueError on the first badly
+    formatted record.  Returns the number of records.
+    '''
+    reader = FastqReader(fastq_path)
+    for (read_id, rec) in reader:
+        pass
+    return reader.n_records
+
+
+class DecompressingFifo(object):
+    '''
+    Presents a compressed reads file as a named pipe, fed by a background
+    thread, to programs that can't read that compression themselves.
+
+        fifo = DecompressingFifo(bz2_path, fifo_path).start()
+        try:
+            run(['kaiju', '-i', fifo.fifo_path, ...])
+        finally:
+            fifo.close()
+    '''
+
+    def __init__(self, reads_path, fifo_path):
+        self.reads_path = reads_path
+        self.fifo_path = fifo_path
+        self.copy_buf_size = 1024*1024
+        self._feeder = None
+
+
+    def start(self):
+        os.mkfifo(self.fifo_path)
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.daemon = True
+        self._feeder.start()
+        return self
+
+
+    def close(self):
+        # if the reader never showed up (or quit early), stand in for it so the feeder can exit
+        while self._feeder.is_alive():
+            unblock_fd = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(unblock_fd)
+            self._feeder.join(1.0)
+        os.remove(self.fifo_path)
+
+
+    def _feed(self):
+        try:
+            with open_fastq(self.reads_path) as reads_handle, open(self.fifo_path, 'wb') as fifo_handle:
+                shutil.copyfileobj(reads_handle, fifo_handle, self.copy_buf_size)
+        except (IOError, OSError):
+            pass  # reader closed the pipe
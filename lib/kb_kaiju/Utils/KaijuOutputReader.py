@@ -0,0 +1,104 @@
+import numpy as np
+
+from kb_kaiju.Utils.DBResidency import drop_from_page_cache
+
+
+NEWLINE = ord('\n')
+TAB = ord('\t')
+CR = ord('\r')
+UNCLASSIFIED_FLAG = ord('U')
+ZERO = ord('0')
+
+
+def count_kaiju_classifications(classification_file, n_ids=0, buf_size=4*1024*1024):
+    '''
+    Count the reads by taxid (and the unclassified reads) in a kaiju classification file:
+
+        (taxid_cnts, unclassified_cnt) = count_kaiju_classifications(path, largest_id+1)
+
+    taxid_cnts is an int64 array of at least n_ids.  The file is read in buf_size blocks,
+    and the status flag and taxid columns of each block pulled out with NumPy rather than
+    split line by line, so memory stays bounded by the block size however big the file.
+    '''
+    taxid_cnts = np.zeros(n_ids, dtype=np.int64)
+    unclassified_cnt = 0
+    tail = b''
+    with open(classification_file, 'rb') as class_handle:
+        while True:
+            block = class_handle.read(buf_size)
+            if not block:
+                break
+            block = tail + block
+            last_newline = block.rfind(b'\n')
+            if last_newline < 0:
+                tail = block
+                continue
+            tail = block[last_newline+1:]
+            (taxid_cnts, block_unclassified_cnt) = _count_block(block[:last_newline+1], taxid_cnts, classification_file)
+            unclassified_cnt += block_unclassified_cnt
+    if tail:  # last line without a newline
+        (taxid_cnts, block_unclassified_cnt) = _count_block(tail + b'\n', taxid_cnts, classification_file)
+        unclassified_cnt += block_unclassified_cnt
+    drop_from_page_cache(classification_file)
+    return (taxid_cnts, unclassified_cnt)
+
+
+def _count_block(block, taxid_cnts, classification_file):
+    '''
+    Add the reads in a block of whole lines to taxid_cnts.  Columns are the status flag
+    ('C' or 'U'), the read id and the taxid, then whatever kaiju -v adds.
+    '''
+    buf = np.frombuffer(block, dtype=np.uint8)
+    line_ends = np.nonzero(buf == NEWLINE)[0]
+    line_starts = np.empty_like(line_ends)
+    line_starts[0] = 0
+    line_starts[1:] = line_ends[:-1] + 1
+    line_lens = line_ends - line_starts
+    not_blank = (line_lens > 1) | ((line_lens == 1) & (buf[line_starts] != CR))
+    (line_starts, line_ends) = (line_starts[not_blank], line_ends[not_blank])
+
+    unclassified = (buf[line_starts] == UNCLASSIFIED_FLAG)
+    unclassified_cnt = int(unclassified.sum())
+    (line_starts, line_ends) = (line_starts[~unclassified], line_ends[~unclassified])
+    if len(line_starts) == 0:
+        return (taxid_cnts, unclassified_cnt)
+
+    # taxid runs from the second tab of the line to the next tab or the end of the line
+    tabs = np.nonzero(buf == TAB)[0]
+    tabs = np.append(tabs, len(buf))  # so every line has a "next" tab to look at
+    second_tab_i = np.searchsorted(tabs, line_starts) + 1
+    second_tab_i = np.minimum(second_tab_i, len(tabs) - 1)
+    bad_lines = (tabs[second_tab_i] >= line_ends)
+    if np.any(bad_lines):
+        _raise_bad_line(block, line_starts, line_ends, bad_lines, classification_file)
+    taxid_starts = tabs[second_tab_i] + 1
+    taxid_ends = np.minimum(tabs[np.minimum(second_tab_i + 1, len(tabs) - 1)], line_ends)
+    taxid_ends -= (buf[taxid_ends - 1] == CR).astype(taxid_ends.dtype)
+
+    taxid_lens = taxid_ends - taxid_starts
+    bad_lines = (taxid_lens <= 0)
+    if np.any(bad_lines):
+        _raise_bad_line(block, line_starts, line_ends, bad_lines, classification_file)
+    taxids = np.zeros(len(taxid_starts), dtype=np.int64)
+    for digit_i in range(int(taxid_lens.max())):
+        in_taxid = (taxid_lens > digit_i)
+        digits = buf[taxid_starts[in_taxid] + digit_i].astype(np.int64) - ZERO
+        bad_digits = (digits < 0) | (digits > 9)
+        if np.any(bad_digits):
+            bad_lines = np.zeros(len(taxid_starts), dtype=bool)
+            bad_lines[np.nonzero(in_taxid)[0][bad_digits]] = True
+            _raise_bad_line(block, line_starts, line_ends, bad_lines, classification_file)
+        taxids[in_taxid] = taxids[in_taxid] * 10 + digits
+
+    block_taxid_cnts = np.bincount(taxids, minlength=len(taxid_cnts))
+    if len(block_taxid_cnts) > len(taxid_cnts):
+        block_taxid_cnts[:len(taxid_cnts)] += taxid_cnts
+        return (block_taxid_cnts, unclassified_cnt)
+    taxid_cnts += block_taxid_cnts
+    return (taxid_cnts, unclassified_cnt)
+
+
+def _raise_bad_line(block, line_starts, line_ends, bad_lines, classification_file):
+    bad_line_i = np.nonzero(bad_lines)[0][0]
+    bad_line = block[line_starts[bad_line_i]:line_ends[bad_line_i]]
+    raise ValueError ("badly formatted line in kaiju classification file "+str(classification_file)+": '"+bad_line.decode('utf-8', 'replace')+"'")
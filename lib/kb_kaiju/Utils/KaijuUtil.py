@@ -2,13 +2,31 @@
 import time
 import os
 import uuid
+import json
 import subprocess
 import sys
+import itertools
+import threading
+import traceback
+try:
+    import queue  # py3
+except ImportError:
+    import Queue as queue  # py2
 
 from KBaseReport.KBaseReportClient import KBaseReport
 
 from kb_kaiju.Utils.DataStagingUtils import DataStagingUtils
 from kb_kaiju.Utils.OutputBuilder import OutputBuilder
+from kb_kaiju.Utils.FastqReader import DecompressingFifo, reads_file_compression
+from kb_kaiju.Utils.ReadSubsampler import UnionReadReplicates
+from kb_kaiju.Utils.StagingScheduler import StagingScheduler
+from kb_kaiju.Utils.DBResidency import DBResidency, drop_from_page_cache
+from kb_kaiju.Utils.ProcScheduler import ProcScheduler, available_cpus
+from kb_kaiju.Utils.ProcUsage import wait_proc
+from kb_kaiju.Utils.MemoryPlanner import MemoryPlanner
+from kb_kaiju.Utils.TaskGraph import TaskGraph
+from kb_kaiju.Utils.Checkpoints import Checkpoints, checkpoint_key
+from kb_kaiju.Utils.TaxonomyIndex import set_taxonomy_registry_max_bytes, taxonomy_registry_stats
 
 
 def log(message, prefix_newline=False):
@@ -19,13 +37,35 @@ def log(message, prefix_newline=False):
 
 class KaijuUtil:
 
+    # threads each tool runs with, for the ProcScheduler (kaiju uses self.threads)
+    TOOL_THREADS = {'ktImportText': 1}
+
     def __init__(self, config, ctx):
         self.config = config
         self.ctx = ctx
         self.callback_url = config['SDK_CALLBACK_URL']
         self.workspace_url = config['workspace-url']
         self.scratch = config['scratch']
-        self.threads = config['threads']
+        self.cpu_budget = available_cpus()
+        if str(config.get('threads', 'auto')).strip() == 'auto':
+            self.threads = self.cpu_budget
+        else:
+            self.threads = min(int(config['threads']), self.cpu_budget)
+        self.proc_scheduler = ProcScheduler(self.cpu_budget, self.run_proc)  # shared by kaiju and the krona charts
+        self.prefetch_depth = int(config.get('prefetch_depth', 1))
+        self.scratch_headroom_bytes = int(float(config.get('scratch_headroom_gb', 1)) * 1024**3)
+        self.union_replicates = int(config.get('union_replicates', 0)) == 1
+        self.kaiju_multi_batch_size = max(1, int(config.get('kaiju_multi_batch_size', 1)))
+        self.max_kaiju_instances = max(1, int(config.get('max_kaiju_instances', 1)))
+        self.kaiju_instances = 1  # kaiju runs at once, as planned by the MemoryPlanner
+        self.db_prewarm = int(config.get('db_prewarm', 0)) == 1
+        self.krona_combine_min_samples = int(config.get('krona_combine_min_samples', 0))
+        self.checkpoint_resume = int(config.get('checkpoint_resume', 0)) == 1
+        self.checkpoints = None  # Checkpoints of the current run, with checkpoint_resume
+        set_taxonomy_registry_max_bytes(int(float(config.get('taxonomy_registry_max_gb', 4)) * 1024**3))
+        self.predicted_kaiju_rss_bytes = None
+        self.proc_records = []  # resource accounting for each run_proc() command
+        self.proc_records_lock = threading.Lock()
         self.suffix = str(int(time.time() * 1000))
         self.SE_flag = 'SE'
         self.PE_flag = 'PE'
@@ -41,17 +81,40 @@ class KaijuUtil:
         '''
 
         # 0) validate basic parameters and set defaults
+        seed_given = params.get('subsample_seed') not in [None, '']
         params = self.validate_run_kaiju_with_krona_params(params)
-
-        # 1) expand input members that are sets
+        kaiju_db_dir = os.path.join(os.path.sep, 'data', 'kaijudb', params['db_type'])
+        memory_planner = MemoryPlanner(kaiju_db_dir, self.threads)
+        self.predicted_kaiju_rss_bytes = memory_planner.check_kaiju_fits(params['db_type'])
+        self.kaiju_instances = memory_planner.kaiju_instances(min(self.max_kaiju_instances, max(1, self.cpu_budget // self.threads)))
+
+        # 1) expand input members that are sets (and warm the kaiju db in the page cache meanwhile)
+        db_residency = DBResidency(kaiju_db_dir)
+        db_residency.report()
+        if self.db_prewarm:
+            db_residency.prewarm()
         expanded_input = self.dsu_client.expand_input(params['input_refs'])
 
 
-        # 2) establish output folders
-        output_dir = os.path.join(self.scratch, 'output_' + str(self.suffix))
+        # 2) establish output folders (with checkpoint_resume, in a run dir named by a hash of the
+        #    params and input versions, where a re-run of the same job picks up where this one stops)
+        if self.checkpoint_resume:
+            run_params = dict(params)
+            if not seed_given:
+                run_params.pop('subsample_seed')  # drawn for this run, kept in its 'run' checkpoint
+            run_params['input_versioned_refs'] = [item.get('versioned_ref', item['ref']) for item in expanded_input]
+            run_key = checkpoint_key(run_params)
+            run_dir = os.path.join(self.scratch, 'kaiju_run_' + run_key[:16])
+            self.checkpoints = Checkpoints(os.path.join(run_dir, 'checkpoints'))
+            run_state = self.checkpoints.run('run', run_key, lambda: {'subsample_seed': params['subsample_seed']})
+            params['subsample_seed'] = run_state['subsample_seed']
+            output_dir = os.path.join(run_dir, 'output')
+            html_dir = os.path.join(run_dir, 'html')
+        else:
+            output_dir = os.path.join(self.scratch, 'output_' + str(self.suffix))
+            html_dir = os.path.join(self.scratch, 'html_' + str(self.suffix))
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-        html_dir = os.path.join(self.scratch, 'html_' + str(self.suffix))
         if not os.path.exists(html_dir):
             os.makedirs(html_dir)
 
@@ -111,7 +174,9 @@ class KaijuUtil:
         self.outputBuilder_client = OutputBuilder(output_folders, self.scratch, self.callback_url, self.workspace_url)
 
 
-        # 4) run Kaiju in batch (download happens one-by-one and then deleted to save space)
+        # 4-10) run Kaiju in batch, then the summaries, plots, Krona charts and packaging, as a task graph.
+        #       Each sample's summary tables and Krona input are made as soon as it is classified,
+        #       while the next samples are still being downloaded and classified.
         kaiju_options = {'input_reads':               expanded_input,
                          'out_folder':                kaiju_output_folder,
                          'subsample_percent':         params['subsample_percent'],
@@ -126,12 +191,7 @@ class KaijuUtil:
                          'greedy_min_match_score':    params['greedy_min_match_score'],
                          'threads':                   self.threads
                         }
-        expanded_input = self.run_kaiju_batch (kaiju_options)  # revise expanded input with subsamples
-
-
-        # 5) create Summary Reports in batch
-        kaijuReport_options = {'input_reads':               expanded_input,
-                               'in_folder':                 kaiju_output_folder,
+        kaijuReport_options = {'in_folder':                 kaiju_output_folder,
                                'out_folder':                kaijuReport_output_folder,
                                'tax_levels':                params['tax_levels'],
                                'db_type':                   params['db_type'],
@@ -139,12 +199,7 @@ class KaijuUtil:
                                'filter_unclassified':       params['filter_unclassified'],
                                'full_tax_path':             params['full_tax_path']
                            }
-        self.run_kaijuReport_batch (kaijuReport_options)
-
-
-        # 6) create Summary Report plots in batch
-        kaijuReportPlots_options = {'input_reads':                   expanded_input,
-                                    'in_folder':                     kaijuReport_output_folder,
+        kaijuReportPlots_options = {'in_folder':                     kaijuReport_output_folder,
                                     'stacked_bar_plots_out_folder':  kaijuReport_StackedBarPlots_output_folder,
                                     #'per_sample_plots_out_folder':   kaijuReport_PerSamplePlots_output_folder,
                                     'tax_levels':                    params['tax_levels'],
@@ -155,49 +210,134 @@ class KaijuUtil:
                                 }
         if build_area_plots_flag:
             kaijuReportPlots_options['stacked_area_plots_out_folder'] = kaijuReport_StackedAreaPlots_output_folder
-        kaijuReport_plot_files = self.run_kaijuReportPlots_batch (kaijuReportPlots_options)
-
-
-        # 7) create HTML Summary Reports in batch
-        kaijuReportPlotsHTML_options = {'input_reads':             expanded_input,
-                                        'summary_folder':          kaijuReport_output_folder,
-                                        'stacked_bar_plot_files':  kaijuReport_plot_files['stacked_bar_plot_files'],
-                                        #'per_sample_plot_files':   kaijuReport_plot_files['per_sample_plot_files'],
-                                        'out_folder':              html_dir,
-                                        'tax_levels':              params['tax_levels']
-        }
-        if build_area_plots_flag:
-            kaijuReportPlotsHTML_options['stacked_area_plot_files'] = kaijuReport_plot_files['stacked_area_plot_files']
-        html_plot_pages = self.run_kaijuReportPlotsHTML_batch (kaijuReportPlotsHTML_options)
-
-
-        # 8) create Krona plots
-        krona_options = {'input_reads':               expanded_input,
-                         'in_folder':                 kaiju_output_folder,
+        krona_options = {'in_folder':                 kaiju_output_folder,
                          'out_folder':                krona_output_folder,
                          'html_folder':               html_dir,
                          'db_type':                   params['db_type']
                      }
-        html_krona_pages = self.run_krona_batch (krona_options)
-
-
-        # 9) Package results
-        output_packages = self._build_output_packages(params, self.outputBuilder_client)
-
-
-        # 10) add top nav to html pages and build the HTML report
-        html_pages = []
-        html_pages.extend(html_plot_pages['bar'])
-        if build_area_plots_flag:
-            html_pages.extend(html_plot_pages['area'])
-        #html_pages.extend(html_plot_pages['per_sample'])
-        html_pages.extend(html_krona_pages)
-        self.outputBuilder_client.add_top_nav(html_pages)
-        #report_html_file = 'kaiju_html_plots.zip'  # fails
-        #report_html_file = 'kaiju_plots.html'  # fails
-        report_html_file = html_pages[0]['local_path']  # works
-        report_html_desc = 'Kaiju abundance and Krona plots'
-        html_zipped = self.outputBuilder_client.package_folder(html_dir, report_html_file, report_html_desc)
+        n_samples = len(expanded_input)
+        if int(params['subsample_percent']) != 100:
+            n_samples *= int(params['subsample_replicates'])
+        combine_krona = self._combine_krona(n_samples)
+
+        graph = TaskGraph(max(2, self.cpu_budget))
+
+        def kaiju_file(input_reads_item):
+            return os.path.join(kaiju_output_folder, input_reads_item['name']+'.kaiju')
+
+        def report_files(input_reads_item):
+            return [os.path.join(kaijuReport_output_folder, input_reads_item['name']+'-'+tax_level+'.kaijuReport') for tax_level in params['tax_levels']]
+
+        def krona_files(input_reads_item):
+            return [os.path.join(krona_output_folder, input_reads_item['name']+'.krona')]  # (add_top_nav rewrites the html)
+
+        def add_sample_tasks(classified_items):
+            for input_reads_item in classified_items:
+                # 5) create Summary Reports
+                graph.add('report '+input_reads_item['name'],
+                          lambda item=input_reads_item: self._checkpointed('report '+item['name'], [kaijuReport_options, item['name']], [kaiju_file(item)],
+                                                                           lambda: self.run_kaijuReport_batch(dict(kaijuReport_options, input_reads=[item])),
+                                                                           report_files(item)))
+                # 8) create Krona plots (all together once every sample is classified if combined)
+                if combine_krona:
+                    krona_func = lambda item: self._write_krona_input(krona_options, item)
+                else:
+                    krona_func = lambda item: self.run_krona_batch(dict(krona_options, input_reads=[item]))
+                graph.add('krona '+input_reads_item['name'],
+                          lambda report, item=input_reads_item: self._checkpointed('krona '+item['name'], [krona_options, combine_krona, item['name']], [kaiju_file(item)],
+                                                                                   lambda: krona_func(item),
+                                                                                   krona_files(item)),
+                          inputs=['report '+input_reads_item['name']])  # reuses the taxid counts of the report
+
+        def add_batch_tasks(classified_input):
+            report_tasks = ['report '+input_reads_item['name'] for input_reads_item in classified_input]
+            krona_tasks = ['krona '+input_reads_item['name'] for input_reads_item in classified_input]
+
+            all_report_files = []
+            for input_reads_item in classified_input:
+                all_report_files.extend(report_files(input_reads_item))
+            sample_names = [input_reads_item['name'] for input_reads_item in classified_input]
+
+            # 6) create Summary Report plots in batch
+            graph.add('plots',
+                      lambda *reports: self._checkpointed('plots', [kaijuReportPlots_options, sample_names], all_report_files,
+                                                          lambda: self.run_kaijuReportPlots_batch(dict(kaijuReportPlots_options, input_reads=classified_input))),
+                      inputs=report_tasks, main_thread=True)
+
+            # 7) create HTML Summary Reports in batch
+            def build_plots_html(kaijuReport_plot_files):
+                kaijuReportPlotsHTML_options = {'input_reads':             classified_input,
+                                                'summary_folder':          kaijuReport_output_folder,
+                                                'stacked_bar_plot_files':  kaijuReport_plot_files['stacked_bar_plot_files'],
+                                                #'per_sample_plot_files':   kaijuReport_plot_files['per_sample_plot_files'],
+                                                'out_folder':              html_dir,
+                                                'tax_levels':              params['tax_levels']
+                }
+                if build_area_plots_flag:
+                    kaijuReportPlotsHTML_options['stacked_area_plot_files'] = kaijuReport_plot_files['stacked_area_plot_files']
+                return self._checkpointed('plots html', [kaijuReportPlotsHTML_options], all_report_files,
+                                          lambda: self.run_kaijuReportPlotsHTML_batch (kaijuReportPlotsHTML_options))
+            graph.add('plots html', build_plots_html, inputs=['plots'])
+
+            # 8) Krona chart of all samples
+            if combine_krona:
+                all_krona_files = []
+                for input_reads_item in classified_input:
+                    all_krona_files.extend(krona_files(input_reads_item))
+                graph.add('krona',
+                          lambda *krona_inputs: self._checkpointed('krona', [krona_options, sample_names], all_krona_files,
+                                                                   lambda: self._run_krona_charts(dict(krona_options, input_reads=classified_input), combine=True)),
+                          inputs=krona_tasks)
+                krona_tasks = ['krona']
+
+            # 9) Package results
+            def build_output_packages(*done):
+                output_files = []
+                for output_folder in self.outputBuilder_client.output_folders:
+                    for (dir_path, dir_names, file_names) in os.walk(output_folder['path']):
+                        output_files.extend([os.path.join(dir_path, file_name) for file_name in file_names])
+                return self._checkpointed('package', [params, sample_names], output_files,
+                                          lambda: self._build_output_packages(params, self.outputBuilder_client))
+            graph.add('package', build_output_packages, inputs=report_tasks+krona_tasks+['plots'])
+
+            # 10) add top nav to html pages and build the HTML report
+            def build_html_report(html_plot_pages, output_packages, *html_krona_pages):
+                return self._checkpointed('html report', [html_plot_pages, output_packages, html_krona_pages], [],
+                                          lambda: package_html_report(html_plot_pages, html_krona_pages))
+
+            def package_html_report(html_plot_pages, html_krona_pages):
+                html_pages = []
+                html_pages.extend(html_plot_pages['bar'])
+                if build_area_plots_flag:
+                    html_pages.extend(html_plot_pages['area'])
+                #html_pages.extend(html_plot_pages['per_sample'])
+                for krona_pages in html_krona_pages:
+                    html_pages.extend(krona_pages)
+                proc_records = self._write_proc_records([os.path.join(output_dir, 'process_accounting.json'),
+                                                         os.path.join(html_dir, 'process_accounting.json')])
+                html_pages.extend(self.outputBuilder_client.build_html_for_process_accounting(html_dir, proc_records, 'process_accounting.json'))
+                self.outputBuilder_client.add_top_nav(html_pages)
+                #report_html_file = 'kaiju_html_plots.zip'  # fails
+                #report_html_file = 'kaiju_plots.html'  # fails
+                report_html_file = html_pages[0]['local_path']  # works
+                report_html_desc = 'Kaiju abundance and Krona plots'
+                return self.outputBuilder_client.package_folder(html_dir, report_html_file, report_html_desc)
+            graph.add('html report', build_html_report, inputs=['plots html', 'package']+krona_tasks)
+
+        def classify():
+            kaiju_options['on_classified'] = add_sample_tasks
+            try:
+                classified_input = self.run_kaiju_batch (kaiju_options)  # revise expanded input with subsamples
+            finally:
+                db_residency.stop()
+            add_batch_tasks(classified_input)
+            return classified_input
+
+        graph.add('kaiju', classify)
+        pipeline_outputs = graph.run()
+        expanded_input = pipeline_outputs['kaiju']
+        output_packages = pipeline_outputs['package']
+        html_zipped = pipeline_outputs['html report']
 
 
         """
@@ -237,33 +377,76 @@ class KaijuUtil:
         kr = KBaseReport(self.callback_url)
         report_output = kr.create_extended_report(report_params)
 
+        log("taxonomy registry: "+str(taxonomy_registry_stats()))
         returnVal = {'report_name': report_output['name'],
                      'report_ref':  report_output['ref']}
         return returnVal
 
 
-    def run_proc(self, command, log_output_file=None):
+    def run_proc(self, command, log_output_file=None, predicted_rss_bytes=None):
         log('Running: ' + ' '.join(command))
 
+        start_time = time.time()
         if log_output_file:  # if output is too chatty for STDOUT
-            open (log_output_file, 'w')
-            p = subprocess.Popen(command, cwd=self.scratch, shell=False, stdout=log_output_file, stderr=subprocess.STDOUT)
+            log_output_handle = open (log_output_file, 'w')
+            p = subprocess.Popen(command, cwd=self.scratch, shell=False, stdout=log_output_handle, stderr=subprocess.STDOUT)
         else:
             p = subprocess.Popen(command, cwd=self.scratch, shell=False)
-        exitCode = p.wait()
+        (exitCode, rusage, proc_io) = wait_proc(p)
+        wall_secs = time.time() - start_time
 
         if log_output_file:
-            log_output_file.close()
+            log_output_handle.close()
+
+        peak_rss_bytes = rusage.ru_maxrss * 1024  # KB on Linux
+        proc_record = {'tool':                os.path.basename(command[0]),
+                       'command':             command,
+                       'start_time':          start_time,
+                       'wall_secs':           wall_secs,
+                       'user_cpu_secs':       rusage.ru_utime,
+                       'sys_cpu_secs':        rusage.ru_stime,
+                       'peak_rss_bytes':      peak_rss_bytes,
+                       'predicted_rss_bytes': predicted_rss_bytes,
+                       'read_bytes':          proc_io.get('read_bytes'),
+                       'write_bytes':         proc_io.get('write_bytes'),
+                       'rchar':               proc_io.get('rchar'),
+                       'wchar':               proc_io.get('wchar'),
+                       'exit_code':           exitCode
+                       }
+        with self.proc_records_lock:
+            self.proc_records.append(proc_record)
+        log('Wall {0:.1f}s, user {1:.1f}s, sys {2:.1f}s, read {3} B, written {4} B'.format(wall_secs, rusage.ru_utime, rusage.ru_stime,
+                                                                                             proc_io.get('rchar'), proc_io.get('wchar')))
+        if predicted_rss_bytes:
+            log('Peak RSS: {0:.2f} GB (predicted {1:.2f} GB)'.format(float(peak_rss_bytes) / 1024**3, float(predicted_rss_bytes) / 1024**3))
+        else:
+            log('Peak RSS: {0:.2f} GB'.format(float(peak_rss_bytes) / 1024**3))
 
         if (exitCode == 0):
             log('Executed command: ' + ' '.join(command) + '\n' +
                 'Exit Code: ' + str(exitCode))
+        elif exitCode == -9 and predicted_rss_bytes:
+            raise ValueError('Error running command: ' + ' '.join(command) + '\n' +
+                             'Exit Code: ' + str(exitCode) + ' (killed, most likely out of memory: peak RSS ' +
+                             '{0:.2f} GB, predicted {1:.2f} GB)'.format(float(peak_rss_bytes) / 1024**3, float(predicted_rss_bytes) / 1024**3))
         else:
             raise ValueError('Error running command: ' + ' '.join(command) + '\n' +
                              'Exit Code: ' + str(exitCode))
         return exitCode
 
 
+    def _write_proc_records(self, out_paths):
+        '''
+        Resource accounting for the commands run so far, as JSON
+        '''
+        with self.proc_records_lock:
+            proc_records = list(self.proc_records)
+        for out_path in out_paths:
+            with open(out_path, 'w') as out_handle:
+                json.dump(proc_records, out_handle, indent=1, sort_keys=True)
+        return proc_records
+
+
     def validate_run_kaiju_with_krona_params(self, params):
         method = 'run_kaiju_with_krona'
 
@@ -342,57 +525,357 @@ class KaijuUtil:
 
 
     def run_kaiju_batch(self, options, dropOutput=False):
+        '''
+        Download, subsample and classify each library.  Staging runs in a background
+        thread up to prefetch_depth libraries ahead of the ones kaiju is classifying, as
+        far as the StagingScheduler finds room for them in scratch.  Libraries are
+        classified kaiju_multi_batch_size at a time, in one kaiju-multi run per batch,
+        so the index is loaded once per batch rather than once per library, and up to
+        kaiju_instances batches (as many as fit in memory) are classified at once.
+        '''
+        # libraries already classified by an earlier run of this job (see Checkpoints)
+        classified_by_input = dict()  # input_i: replicate items
+        todo_input_i = []
+        for (input_i, input_reads_item) in enumerate(options['input_reads']):
+            manifest = None
+            if self.checkpoints is not None:
+                manifest = self.checkpoints.completed('kaiju '+input_reads_item['name'], self._kaiju_checkpoint_key(options, input_reads_item))
+            if manifest is None:
+                todo_input_i.append(input_i)
+                continue
+            log("checkpoint: "+input_reads_item['name']+" already classified, skipping it")
+            classified_by_input[input_i] = manifest['result']
+            if options.get('on_classified'):
+                options['on_classified'](manifest['result'])
+        options = dict(options)
+        options['all_input_reads'] = options['input_reads']
+        options['input_reads'] = [options['input_reads'][input_i] for input_i in todo_input_i]
+
+        prefetch = {'staged': queue.Queue(),
+                    'slots': threading.Semaphore(self.prefetch_depth + self.kaiju_instances * self.kaiju_multi_batch_size),  # classifying + prefetched
+                    'scheduler': StagingScheduler(self.scratch, self.scratch_headroom_bytes),
+                    'stop': threading.Event()
+                    }
+        stager = threading.Thread(target=self._stage_kaiju_batch_input, args=(options, prefetch))
+        stager.daemon = True
+        stager.start()
+        kaiju_runs = {'slots':   threading.Semaphore(self.kaiju_instances),
+                      'threads': [],
+                      'errors':  []
+                      }
+
+        try:
+            input_reads = options['input_reads']
+            batch = []  # [(input_i, staged_input), ...] waiting to be classified
+            for (input_i, input_reads_item) in enumerate(input_reads):
+                while True:
+                    try:
+                        staged_input = prefetch['staged'].get(True, 5)
+                        break
+                    except queue.Empty:
+                        self._raise_kaiju_run_error(kaiju_runs)
+                        if not stager.is_alive() and prefetch['staged'].empty():
+                            raise ValueError ("staging stopped before "+input_reads_item['name']+" was staged")
+                        # no room to stage the rest of the batch: classify what we have to free it up
+                        if len(batch) > 0 and prefetch['scheduler'].waiting:
+                            self._start_kaiju_batch(options, batch, prefetch, kaiju_runs, dropOutput)
+                            batch = []
+                if 'error' in staged_input:
+                    raise staged_input['error']
+
+                classified_by_input[todo_input_i[input_i]] = staged_input['replicate_input']  # revise expanded input to replicates
+                batch.append((input_i, staged_input))
+                if len(batch) >= self.kaiju_multi_batch_size or input_i == len(input_reads)-1:
+                    self._start_kaiju_batch(options, batch, prefetch, kaiju_runs, dropOutput)
+                    batch = []
+        finally:
+            for kaiju_run in kaiju_runs['threads']:
+                kaiju_run.join()
+            prefetch['stop'].set()
+            prefetch['slots'].release()
+            prefetch['scheduler'].close()
+
+        self._raise_kaiju_run_error(kaiju_runs)
+
         new_expanded_input = []
+        for input_i in range(len(options['all_input_reads'])):
+            new_expanded_input.extend(classified_by_input[input_i])
+        return new_expanded_input
 
-        input_reads = options['input_reads']
-        for input_reads_item in input_reads:
 
-            # download and subsample reads
+    def _start_kaiju_batch(self, options, batch, prefetch, kaiju_runs, dropOutput=False):
+        '''
+        Classify a batch right away with a single kaiju instance, otherwise in a thread of its
+        own once fewer than kaiju_instances batches are being classified
+        '''
+        if self.kaiju_instances == 1:
+            self._classify_kaiju_batch(options, batch, prefetch, dropOutput)
+            return
+
+        kaiju_runs['slots'].acquire()
+        try:
+            self._raise_kaiju_run_error(kaiju_runs)
+        except Exception:
+            kaiju_runs['slots'].release()
+            raise
+
+        def classify():
+            try:
+                self._classify_kaiju_batch(options, batch, prefetch, dropOutput)
+            except Exception as e:
+                log('Error classifying reads:\n'+traceback.format_exc())
+                kaiju_runs['errors'].append(e)
+            finally:
+                kaiju_runs['slots'].release()
+
+        kaiju_run = threading.Thread(target=classify)
+        kaiju_run.daemon = True
+        kaiju_run.start()
+        kaiju_runs['threads'].append(kaiju_run)
+
+
+    def _raise_kaiju_run_error(self, kaiju_runs):
+        if len(kaiju_runs['errors']) > 0:
+            raise kaiju_runs['errors'][0]
+
+
+    def _classify_kaiju_batch(self, options, batch, prefetch, dropOutput=False):
+        '''
+        Classify a batch of staged libraries, then let the stager fetch the next ones.
+        Subsample replicates written as a union (see DataStagingUtils.stage_input()) are
+        classified together and split afterwards.
+        '''
+        kaiju_items = []
+        union_splits = []
+        for (input_i, staged_input) in batch:
+            replicate_input = staged_input['replicate_input']
+            if 'union_name' in replicate_input[0]:
+                union_item = {'fwd_file': replicate_input[0]['fwd_file'],
+                              'ref':      replicate_input[0]['ref'],
+                              'type':     replicate_input[0]['type'],
+                              'name':     replicate_input[0]['union_name']
+                              }
+                if union_item['type'] == self.PE_flag:
+                    union_item['rev_file'] = replicate_input[0]['rev_file']
+                print ("REPLICATES UNION: "+str(union_item))
+                kaiju_items.append(union_item)
+                union_splits.append((union_item, replicate_input))
+            else:
+                for input_reads_item_replicate in replicate_input:
+                    print ("REPLICATE: "+str(input_reads_item_replicate))
+                    kaiju_items.append(input_reads_item_replicate)
+
+        # kaiju-multi needs all SE or all PE inputs, and comma free paths (they are passed as comma separated lists)
+        for reads_type in [self.SE_flag, self.PE_flag]:
+            multi_items = []
+            for kaiju_item in kaiju_items:
+                if kaiju_item['type'] != reads_type:
+                    continue
+                if ',' in kaiju_item['name']+kaiju_item['fwd_file']+kaiju_item.get('rev_file', ''):
+                    self._run_kaiju(options, [kaiju_item], dropOutput)
+                else:
+                    multi_items.append(kaiju_item)
+            if len(multi_items) > 0:
+                self._run_kaiju(options, multi_items, dropOutput)
+
+        for (union_item, replicate_input) in union_splits:
+            self._split_union_kaiju_output(options, union_item, replicate_input)
+
+        for (input_i, staged_input) in batch:
+            prefetch['scheduler'].release(input_i)
+            prefetch['slots'].release()
+
+        # record them as done, and hand the classified samples on (see run_kaiju_with_krona())
+        classified_items = []
+        for (input_i, staged_input) in batch:
+            classified_items.extend(staged_input['replicate_input'])
+            if self.checkpoints is not None:
+                input_reads_item = options['input_reads'][input_i]
+                self.checkpoints.complete('kaiju '+input_reads_item['name'], self._kaiju_checkpoint_key(options, input_reads_item),
+                                          staged_input['replicate_input'],
+                                          [os.path.join(options['out_folder'], replicate_item['name']+'.kaiju') for replicate_item in staged_input['replicate_input']])
+        if options.get('on_classified'):
+            options['on_classified'](classified_items)
+
+
+    def _stage_kaiju_batch_input(self, options, prefetch):
+        '''
+        Background half of run_kaiju_batch(): stages libraries in order and queues them for kaiju.
+        A library is only fetched once there is a free prefetch slot and the StagingScheduler
+        admits its estimated footprint.  Any error is queued for run_kaiju_batch() to raise.
+        '''
+        try:
+            self._stage_kaiju_batch_inputs(options, prefetch)
+        except Exception as e:
+            log('Error staging reads:\n'+traceback.format_exc())
+            prefetch['staged'].put({'error': e})
+
+
+    def _stage_kaiju_batch_inputs(self, options, prefetch):
+        for (input_i, input_reads_item) in enumerate(options['input_reads']):
+            prefetch['slots'].acquire()
+            if prefetch['stop'].is_set():
+                return
+
+            try:
+                estimate = self.dsu_client.estimate_staging_bytes(input_item =           input_reads_item,
+                                                                  subsample_percent =    int(options['subsample_percent']),
+                                                                  subsample_replicates = int(options['subsample_replicates']))
+            except Exception as e:
+                log('Unable to estimate scratch needed for '+input_reads_item['name']+': '+str(e))
+                estimate = None
+            if not prefetch['scheduler'].admit(input_i, input_reads_item['name'], estimate):
+                return
+
             staged_input = self.dsu_client.stage_input(input_item =           input_reads_item,
                                                        subsample_percent =    int(options['subsample_percent']),
                                                        subsample_replicates = int(options['subsample_replicates']),
                                                        subsample_seed =       int(options['subsample_seed']),
-                                                       fasta_file_extension = 'fastq')
-            #input_dir = staged_input['input_dir']
-            replicate_input = staged_input['replicate_input']
-            new_expanded_input.extend(replicate_input)  # revise expanded input to replicates
-
-            # run for each replicate
-            for input_reads_item_replicate in replicate_input:
-                single_kaiju_run_options = options
-                single_kaiju_run_options['input_item'] = input_reads_item_replicate
-
-                print ("REPLICATE: "+str(input_reads_item_replicate))
-
-                log_output_file = None
-                if dropOutput:  # if output is too chatty for STDOUT
-                    log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '.kaiju' + '.stdout')
-
-                command = self._build_kaiju_command(single_kaiju_run_options)
-                self.run_proc (command, log_output_file)
+                                                       fasta_file_extension = 'fastq',
+                                                       union_replicates =     self.union_replicates)
+            prefetch['scheduler'].staged(input_i, staged_input['staged_bytes'])
+            prefetch['staged'].put(staged_input)
+
+
+    def _kaiju_checkpoint_key(self, options, input_reads_item):
+        kaiju_params = dict([(opt, options.get(opt)) for opt in ['out_folder',
+                                                                 'subsample_percent',
+                                                                 'subsample_replicates',
+                                                                 'subsample_seed',
+                                                                 'db_type',
+                                                                 'seg_filter',
+                                                                 'min_match_length',
+                                                                 'greedy_run_mode',
+                                                                 'greedy_allowed_mismatches',
+                                                                 'greedy_min_match_score']])
+        kaiju_params['input_item'] = [input_reads_item.get('versioned_ref', input_reads_item['ref']), input_reads_item['name'], input_reads_item['type']]
+        kaiju_db_dir = os.path.join(os.path.sep, 'data', 'kaijudb', options['db_type'])
+        db_files = [os.path.join(kaiju_db_dir, 'nodes.dmp')]
+        if os.path.isdir(kaiju_db_dir):
+            db_files.extend([os.path.join(kaiju_db_dir, file_name) for file_name in os.listdir(kaiju_db_dir) if file_name.endswith('.fmi')])
+        return checkpoint_key(kaiju_params, db_files)
+
+
+    def _checkpointed(self, stage, stage_params, input_files, func, output_files=None):
+        '''
+        func(), skipped if this stage of the run already completed with the same params and inputs (with checkpoint_resume)
+        '''
+        if self.checkpoints is None:
+            return func()
+        return self.checkpoints.run(stage, self.checkpoints.key(stage_params, input_files), func, output_files)
 
-                # remove input file to free up disk
-                os.remove(input_reads_item_replicate['fwd_file'])
-                if input_reads_item_replicate['type'] == self.PE_flag:
-                    os.remove(input_reads_item_replicate['rev_file'])
 
-        return new_expanded_input
+    def _run_kaiju(self, options, input_items, dropOutput=False):
+        '''
+        Classify staged reads items into out_folder/<name>.kaiju, with kaiju for a single item
+        and kaiju-multi for several, then remove their reads files
+        '''
+        kaiju_run_options = dict(options)  # batches may be classified at once
+        if len(input_items) == 1:
+            kaiju_run_options['input_item'] = input_items[0]
+        else:
+            kaiju_run_options['input_items'] = input_items
+
+        log_output_file = None
+        if dropOutput:  # if output is too chatty for STDOUT
+            log_output_file = os.path.join(self.scratch, input_items[0]['name'] + '.kaiju' + '.stdout')
+
+        command = self._build_kaiju_command(kaiju_run_options)
+        input_fifos = []
+        try:
+            for input_item in input_items:
+                input_fifos.extend(self._open_kaiju_input_fifos(input_item))
+            fifo_paths = dict([(fifo.reads_path, fifo.fifo_path) for fifo in input_fifos])
+            command = [','.join([fifo_paths.get(path, path) for path in arg.split(',')]) for arg in command]
+            kaiju_cpus = self.proc_scheduler.acquire(self.threads)  # krona charts of earlier samples may be running
+            try:
+                self.run_proc (command, log_output_file, self.predicted_kaiju_rss_bytes)
+            finally:
+                self.proc_scheduler.release(kaiju_cpus)
+        finally:
+            for fifo in input_fifos:
+                fifo.close()
+
+        # remove input file to free up disk (and page cache, in case the file lives on as a reads cache link)
+        for input_item in input_items:
+            drop_from_page_cache(input_item['fwd_file'])
+            os.remove(input_item['fwd_file'])
+            if input_item['type'] == self.PE_flag:
+                drop_from_page_cache(input_item['rev_file'])
+                os.remove(input_item['rev_file'])
+
+
+    def _split_union_kaiju_output(self, options, union_item, replicate_input, batch_size=100000):
+        '''
+        Splits the kaiju output for a union of subsample replicates into one .kaiju file per
+        replicate, looking up each read name kaiju reports in the replicates recorded as the
+        union was written (see UnionReadReplicates)
+        '''
+        read_replicates = UnionReadReplicates.load(replicate_input[0]['union_replicates_file'])
+        union_path = os.path.join(options['out_folder'], union_item['name']+'.kaiju')
+        replicate_paths = [os.path.join(options['out_folder'], replicate_item['name']+'.kaiju') for replicate_item in replicate_input]
+
+        out_handles = [open(path, 'wb', 1000000) for path in replicate_paths]
+        try:
+            with open(union_path, 'rb', 4*1024*1024) as union_handle:
+                line_i = 0
+                while True:
+                    lines = list(itertools.islice(union_handle, batch_size))
+                    if len(lines) == 0:
+                        break
+                    read_names = [line.split(b'\t', 2)[1] for line in lines]
+                    lib_is = read_replicates.replicates_of(read_names)
+                    for (rec_i, line) in enumerate(lines):
+                        if lib_is[rec_i] == UnionReadReplicates.UNKNOWN:
+                            raise ValueError ("read '"+read_names[rec_i].decode('utf-8', 'replace')+"' at line "+str(line_i+rec_i+1)+" of "+union_path+" is in none of the subsample replicates.  Set union_replicates = 0 in deploy.cfg to classify replicates one by one.")
+                        out_handles[lib_is[rec_i]].write(line)
+                    line_i += len(lines)
+        finally:
+            for out_handle in out_handles:
+                out_handle.close()
+        os.remove(union_path)
+        os.remove(replicate_input[0]['union_replicates_file'])
+
+
+    def _open_kaiju_input_fifos(self, input_item):
+        '''
+        kaiju reads plain and gzipped FASTQ itself.  bzip2 files are handed to it
+        through named pipes so they never have to be decompressed to disk.
+        '''
+        input_fifos = []
+        for file_key in ['fwd_file', 'rev_file']:
+            if file_key not in input_item:
+                continue
+            reads_path = input_item[file_key]
+            if reads_file_compression(reads_path) == 'bz2':
+                fifo_path = reads_path + '.fifo'
+                input_fifos.append(DecompressingFifo(reads_path, fifo_path).start())
+        return input_fifos
 
 
     def run_kaijuReport_batch(self, options, dropOutput=False):
+        '''
+        kaiju2table summary of each sample for all tax levels, from a single pass over its
+        classifications (the taxonomy is parsed once for the whole batch)
+        '''
         input_reads = options['input_reads']
         for input_reads_item in input_reads:
+            single_kaijuReport_run_options = dict(options)
+            single_kaijuReport_run_options['input_item'] = input_reads_item
+            self._set_kaiju_db_files(single_kaijuReport_run_options)
+            self._validate_kaijuReport_options(single_kaijuReport_run_options)
+
+            start_time = time.time()
+            in_path = os.path.join(options['in_folder'], input_reads_item['name']+'.kaiju')
+            report_files = dict()
             for tax_level in options['tax_levels']:
-                single_kaijuReport_run_options = options
-                single_kaijuReport_run_options['input_item'] = input_reads_item
-                single_kaijuReport_run_options['tax_level'] = tax_level
-
-                log_output_file = None
-                if dropOutput:  # if output is too chatty for STDOUT
-                    log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '.kaijuReport' + '.stdout')
-
-                command = self._build_kaijuReport_command(single_kaijuReport_run_options)
-                self.run_proc (command, log_output_file)
+                out_file = input_reads_item['name']+'-'+tax_level+'.kaijuReport'
+                report_files[tax_level] = os.path.join(options['out_folder'], out_file)
+            self.outputBuilder_client.write_kaijuReports(in_path, report_files, options['db_type'],
+                                                         filter_percent=options.get('filter_percent'),
+                                                         filter_unclassified=options.get('filter_unclassified'),
+                                                         full_tax_path=options.get('full_tax_path'))
+            log("kaiju reports for "+input_reads_item['name']+" ("+", ".join(options['tax_levels'])+") written in "+'{0:.1f}'.format(time.time()-start_time)+"s")
 
 
     def run_kaijuReportPlots_batch(self, options):
@@ -472,48 +955,88 @@ class KaijuUtil:
 
 
     def run_krona_batch(self, options, dropOutput=False):
-        out_html_files = []
-        input_reads = options['input_reads']
-        for input_reads_item in input_reads:
+        '''
+        Krona input for each sample written from its taxid counts (kept from the summary
+        tables), then ktImportText, samples side by side within the CPU budget.  With at
+        least krona_combine_min_samples samples, one Krona chart holds them all as datasets.
+        '''
+        for input_reads_item in options['input_reads']:
+            self._write_krona_input(options, input_reads_item)
+        return self._run_krona_charts(options, self._combine_krona(len(options['input_reads'])), dropOutput)
 
-            # kaiju2krona
-            single_kaiju2krona_run_options = options
-            single_kaiju2krona_run_options['input_item'] = input_reads_item
 
-            log_output_file = None
-            if dropOutput:  # if output is too chatty for STDOUT
-                log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '.kaiju2krona' + '.stdout')
+    def _combine_krona(self, n_samples):
+        return self.krona_combine_min_samples > 0 and n_samples >= self.krona_combine_min_samples
 
-            command = self._build_kaiju2krona_command(single_kaiju2krona_run_options)
-            self.run_proc (command, log_output_file)
 
-            # kronaImport
-            single_kronaImport_run_options = options
-            single_kronaImport_run_options['input_item'] = input_reads_item
+    def _write_krona_input(self, options, input_reads_item):
+        '''
+        out_folder/<name>.krona (in place of kaiju2krona)
+        '''
+        single_krona_run_options = dict(options)
+        single_krona_run_options['input_item'] = input_reads_item
+        self._set_kaiju_db_files(single_krona_run_options)
+        self._validate_krona_options(single_krona_run_options)
+        in_path = os.path.join(options['in_folder'], input_reads_item['name']+'.kaiju')
+        krona_path = os.path.join(options['out_folder'], input_reads_item['name']+'.krona')
+        self.outputBuilder_client.write_krona_text(in_path, krona_path, options['db_type'])
 
+
+    def _run_krona_charts(self, options, combine=False, dropOutput=False):
+        '''
+        ktImportText on the Krona input of the samples, a chart per sample or one for all.  Returns the html pages
+        '''
+        jobs = []
+        out_html_files = []
+        input_reads = options['input_reads']
+        if combine:
+            krona_charts = [{'name':        'all samples',
+                             'input_items': input_reads,
+                             'html_file':   'kaiju_samples.krona.html',
+                             'page_name':   'Krona'
+                             }]
+        else:
+            krona_charts = []
+            for input_reads_item in input_reads:
+                krona_charts.append({'name':        input_reads_item['name'],
+                                     'input_items': [input_reads_item],
+                                     'html_file':   input_reads_item['name']+'.krona.html',
+                                     'page_name':   input_reads_item['name']+' Krona'
+                                     })
+
+        for krona_chart in krona_charts:
             log_output_file = None
             if dropOutput:  # if output is too chatty for STDOUT
-                log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '.kronaImport' + '.stdout')
+                log_output_file = os.path.join(self.scratch, krona_chart['html_file'] + '.stdout')
 
-            command = self._build_kronaImport_command(single_kronaImport_run_options)
-            self.run_proc (command, log_output_file)
+            # kronaImport
+            kronaImport_run_options = dict(options)
+            kronaImport_run_options['input_items'] = krona_chart['input_items']
+            kronaImport_run_options['html_file'] = krona_chart['html_file']
+
+            jobs.append({'name':            krona_chart['name']+' krona',
+                         'threads':         self.TOOL_THREADS['ktImportText'],
+                         'steps':           [self._build_kronaImport_command(kronaImport_run_options)],
+                         'log_output_file': log_output_file
+                         })
 
             # return file info
-            local_html_path = input_reads_item['name']+'.krona.html'
-            html_path = os.path.join (options['html_folder'], local_html_path)
+            html_path = os.path.join (options['html_folder'], krona_chart['html_file'])
             out_html_files.append({'type': 'krona',
-                                   'name': input_reads_item['name']+' Krona',
-                                   'local_path': local_html_path,
+                                   'name': krona_chart['page_name'],
+                                   'local_path': krona_chart['html_file'],
                                    'abs_path': html_path
                                })
 
+        self.proc_scheduler.run(jobs)
         return out_html_files
 
 
     def _validate_kaiju_options(self, options):
         # 1st order required
         func_name = 'kaiju'
-        required_opts = [ 'input_item',
+        input_item_opt = 'input_items' if 'input_items' in options else 'input_item'  # kaiju-multi or kaiju
+        required_opts = [ input_item_opt,
                           'out_folder',
                           'db_type',
                           'min_match_length',
@@ -530,11 +1053,15 @@ class KaijuUtil:
                 raise ValueError ("Must define required opt: '"+opt+"' for func: '"+str(func_name)+"()' if running in greedy_run_mode")
 
         # input file validation
-        if not os.path.getsize(options['input_item']['fwd_file']) > 0:
-            raise ValueError ('missing or empty fwd reads file: '+options['input_item']['fwd_file'])
-        if options['input_item']['type'] == self.PE_flag:
-            if not os.path.getsize(options['input_item']['rev_file']) > 0:
-                raise ValueError ('missing or empty rev reads file: '+options['input_item']['rev_file'])
+        input_items = options.get('input_items', [options.get('input_item')])
+        for input_item in input_items:
+            if not os.path.getsize(input_item['fwd_file']) > 0:
+                raise ValueError ('missing or empty fwd reads file: '+input_item['fwd_file'])
+            if input_item['type'] == self.PE_flag:
+                if not os.path.getsize(input_item['rev_file']) > 0:
+                    raise ValueError ('missing or empty rev reads file: '+input_item['rev_file'])
+            if input_item['type'] != input_items[0]['type']:
+                raise ValueError ("can't mix SE and PE reads in one kaiju-multi run: "+input_item['name']+" is "+input_item['type']+", "+input_items[0]['name']+" is "+input_items[0]['type'])
 
         # db validation
         DB = 'KAIJU_DB_PATH'
@@ -552,17 +1079,21 @@ class KaijuUtil:
         if options.get('KAIJU_DB_PATH'):
             command_list.append('-f')
             command_list.append(str(options.get('KAIJU_DB_PATH')))
-        if options['input_item'].get('fwd_file'):
+        # kaiju-multi takes comma separated lists of inputs and outputs
+        input_items = options.get('input_items', [options.get('input_item')])
+        if input_items[0].get('fwd_file'):
             command_list.append('-i')
-            command_list.append(str(options['input_item'].get('fwd_file')))
-        if options['input_item'].get('type') == self.PE_flag:
+            command_list.append(','.join([str(input_item.get('fwd_file')) for input_item in input_items]))
+        if input_items[0].get('type') == self.PE_flag:
             command_list.append('-j')
-            command_list.append(str(options['input_item'].get('rev_file')))
+            command_list.append(','.join([str(input_item.get('rev_file')) for input_item in input_items]))
         if options.get('out_folder'):
-            out_file = options['input_item']['name']+'.kaiju'
-            out_path = os.path.join (str(options.get('out_folder')), out_file)
+            out_paths = []
+            for input_item in input_items:
+                out_file = input_item['name']+'.kaiju'
+                out_paths.append(os.path.join (str(options.get('out_folder')), out_file))
             command_list.append('-o')
-            command_list.append(out_path)
+            command_list.append(','.join(out_paths))
         if int(options.get('seg_filter')) == 1:
             command_list.append('-x')
         if options.get('min_match_length'):
@@ -588,6 +1119,8 @@ class KaijuUtil:
     def _build_kaiju_command(self, options, verbose=True):
         KAIJU_BIN_DIR  = os.path.join(os.path.sep, 'kb', 'module', 'kaiju', 'bin')
         KAIJU_BIN      = os.path.join(KAIJU_BIN_DIR, 'kaiju')
+        if 'input_items' in options:
+            KAIJU_BIN  = os.path.join(KAIJU_BIN_DIR, 'kaiju-multi')
         KAIJU_DB_DIR   = os.path.join(os.path.sep, 'data', 'kaijudb', options['db_type'])
 
         options['verbose'] = verbose
@@ -615,12 +1148,12 @@ class KaijuUtil:
 
     def _validate_kaijuReport_options(self, options):
         # 1st order required
-        func_name = 'kaiju2table'
+        func_name = 'write_kaijuReports'
         required_opts = [ 'in_folder',
                           'input_item',
                           'out_folder',
                           'db_type',
-                          'tax_level'
+                          'tax_levels'
                       ]
         for opt in required_opts:
             if opt not in options or options[opt] == None or options[opt] == '':
@@ -640,50 +1173,15 @@ class KaijuUtil:
             raise ValueError ('missing or empty '+DB+' file: '+options[DB])
 
 
-    def _process_kaijuReport_options(self, command_list, options):
-        if options.get('KAIJU_DB_NODES'):
-            command_list.append('-t')
-            command_list.append(str(options.get('KAIJU_DB_NODES')))
-        if options.get('KAIJU_DB_NAMES'):
-            command_list.append('-n')
-            command_list.append(str(options.get('KAIJU_DB_NAMES')))
-        if options.get('tax_level'):
-            command_list.append('-r')
-            command_list.append(str(options.get('tax_level')))
-        if options.get('out_folder'):
-            out_file = options['input_item']['name']+'-'+str(options.get('tax_level'))+'.kaijuReport'
-            out_path = os.path.join (str(options.get('out_folder')), out_file)
-            command_list.append('-o')
-            command_list.append(out_path)
-        if options.get('filter_percent'):
-            command_list.append('-m')
-            command_list.append(str(options.get('filter_percent')))
-        if int(options.get('filter_unclassified')) == 1:
-            command_list.append('-u')
-        if int(options.get('full_tax_path')) == 1:
-            command_list.append('-p')
-        if options.get('in_folder'):
-            in_file = options['input_item']['name']+'.kaiju'
-            in_path = os.path.join(options['in_folder'], in_file)
-            command_list.append(in_path)
-
-    def _build_kaijuReport_command(self, options):
-        KAIJU_BIN_DIR    = os.path.join(os.path.sep, 'kb', 'module', 'kaiju', 'bin')
-        KAIJU_REPORT_BIN = os.path.join(KAIJU_BIN_DIR, 'kaiju2table')
-        KAIJU_DB_DIR     = os.path.join(os.path.sep, 'data', 'kaijudb', options['db_type'])
-
+    def _set_kaiju_db_files(self, options):
+        KAIJU_DB_DIR = os.path.join(os.path.sep, 'data', 'kaijudb', options['db_type'])
         options['KAIJU_DB_NODES'] = os.path.join(KAIJU_DB_DIR, 'nodes.dmp')
         options['KAIJU_DB_NAMES'] = os.path.join(KAIJU_DB_DIR, 'names.dmp')
 
-        self._validate_kaijuReport_options(options)
-        command = [KAIJU_REPORT_BIN]
-        self._process_kaijuReport_options(command, options)
-        return command
 
-
-    def _validate_kaiju2krona_options(self, options):
+    def _validate_krona_options(self, options):
         # 1st order required
-        func_name = 'kaiju2krona'
+        func_name = 'write_krona_text'
         required_opts = [ 'in_folder',
                           'input_item',
                           'out_folder',
@@ -707,44 +1205,12 @@ class KaijuUtil:
             raise ValueError ('missing or empty '+DB+' file: '+options[DB])
 
 
-    def _process_kaiju2krona_options(self, command_list, options):
-        if options.get('KAIJU_DB_NODES'):
-            command_list.append('-t')
-            command_list.append(str(options.get('KAIJU_DB_NODES')))
-        if options.get('KAIJU_DB_NAMES'):
-            command_list.append('-n')
-            command_list.append(str(options.get('KAIJU_DB_NAMES')))
-        if options.get('in_folder'):
-            in_file = options['input_item']['name']+'.kaiju'
-            in_path = os.path.join(options['in_folder'], in_file)
-            command_list.append('-i')
-            command_list.append(in_path)
-        if options.get('out_folder'):
-            out_file = options['input_item']['name']+'.krona'
-            out_path = os.path.join (str(options.get('out_folder')), out_file)
-            command_list.append('-o')
-            command_list.append(out_path)
-
-
-    def _build_kaiju2krona_command(self, options):
-        KAIJU_BIN_DIR     = os.path.join(os.path.sep, 'kb', 'module', 'kaiju', 'bin')
-        KAIJU_2_KRONA_BIN = os.path.join(KAIJU_BIN_DIR, 'kaiju2krona')
-        KAIJU_DB_DIR      = os.path.join(os.path.sep, 'data', 'kaijudb', options['db_type'])
-
-        options['KAIJU_DB_NODES'] = os.path.join(KAIJU_DB_DIR, 'nodes.dmp')
-        options['KAIJU_DB_NAMES'] = os.path.join(KAIJU_DB_DIR, 'names.dmp')
-
-        self._validate_kaiju2krona_options(options)
-        command = [KAIJU_2_KRONA_BIN]
-        self._process_kaiju2krona_options(command, options)
-        return command
-
-
     def _validate_kronaImport_options(self, options):
         # 1st order required
         func_name = 'kronaImport'
         required_opts = [ 'html_folder',
-                          'input_item',
+                          'html_file',
+                          'input_items',
                           'out_folder',
                           'db_type'
                       ]
@@ -753,21 +1219,23 @@ class KaijuUtil:
                 raise ValueError ("Must define required opt: '"+opt+"' for func: '"+str(func_name)+"()'")
 
         # input file validation
-        in_file = os.path.join(options['out_folder'], options['input_item']['name']+'.krona')
-        if not os.path.getsize(in_file) > 0:
-            raise ValueError ('missing or empty krona input file: '+in_file)
+        for input_item in options['input_items']:
+            in_file = os.path.join(options['out_folder'], input_item['name']+'.krona')
+            if not os.path.getsize(in_file) > 0:
+                raise ValueError ('missing or empty krona input file: '+in_file)
 
 
     def _process_kronaImport_options(self, command_list, options):
         if options.get('html_folder'):
-            html_file = options['input_item']['name']+'.krona.html'
-            html_path = os.path.join (str(options.get('html_folder')), html_file)
+            html_path = os.path.join (str(options.get('html_folder')), options['html_file'])
             command_list.append('-o')
             command_list.append(html_path)
         if options.get('out_folder'):
-            in_file = options['input_item']['name']+'.krona'
-            in_path = os.path.join(options['out_folder'], in_file)
-            command_list.append(in_path)
+            # one dataset per input, named by sample (ktImportText <file>,<name>)
+            for input_item in options['input_items']:
+                in_file = input_item['name']+'.krona'
+                in_path = os.path.join(options['out_folder'], in_file)
+                command_list.append(in_path+','+input_item['name'])
 
 
     def _build_kronaImport_command(self, options):
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+
+
+MEMINFO_PATH = '/proc/meminfo'
+CGROUP_DIR = '/sys/fs/cgroup'
+
+
+def memory_available_bytes():
+    '''
+    Memory this job can still use: MemAvailable, capped by what is left under the
+    cgroup limit (v2 memory.max or v1 memory.limit_in_bytes), not counting the
+    cgroup's inactive page cache, which the kernel will reclaim
+    '''
+    available_bytes = _meminfo_bytes('MemAvailable')
+    if available_bytes is None:
+        available_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+    for (limit_file, usage_file, stat_file, inactive_key) in [
+            ('memory.max', 'memory.current', 'memory.stat', 'inactive_file'),
+            ('memory/memory.limit_in_bytes', 'memory/memory.usage_in_bytes', 'memory/memory.stat', 'total_inactive_file')]:
+        (limit_file, usage_file, stat_file) = [os.path.join(CGROUP_DIR, cgroup_file) for cgroup_file in (limit_file, usage_file, stat_file)]
+        try:
+            with open(limit_file, 'r') as limit_handle:
+                limit = limit_handle.read().strip()
+            if limit == 'max' or int(limit) >= 2**60:  # no limit
+                break
+            with open(usage_file, 'r') as usage_handle:
+                usage = int(usage_handle.read())
+            inactive_file = 0
+            with open(stat_file, 'r') as stat_handle:
+                for line in stat_handle:
+                    (key, value) = line.split()[:2]
+                    if key == inactive_key:
+                        inactive_file = int(value)
+            available_bytes = min(available_bytes, int(limit) - usage + inactive_file)
+            break
+        except (IOError, OSError, ValueError):
+            continue
+
+    return max(0, available_bytes)
+
+
+def _meminfo_bytes(field):
+    try:
+        with open(MEMINFO_PATH, 'r') as meminfo_handle:
+            for line in meminfo_handle:
+                if line.startswith(field+':'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+class MemoryPlanner(object):
+    '''
+    Predicts the peak RSS of a kaiju run on a database and checks it against the
+    memory available to the job, before any reads are downloaded, and decides
+    how many kaiju runs can go at once.
+
+    kaiju (and kaiju-multi, once for all its inputs) reads the whole .fmi index into
+    memory, and builds a parent map from nodes.dmp, so the peak RSS is about the size
+    of the index, plus the taxonomy, plus some working memory per thread.
+    '''
+
+    BASE_OVERHEAD_BYTES = 512*1024*1024
+    THREAD_OVERHEAD_BYTES = 64*1024*1024
+    NODES_DMP_FACTOR = 2
+
+    def __init__(self, db_dir, threads=1):
+        self.db_dir = db_dir
+        self.threads = max(1, int(threads))
+
+
+    def fmi_bytes(self):
+        fmi_bytes = 0
+        if os.path.isdir(self.db_dir):
+            for file_name in os.listdir(self.db_dir):
+                if file_name.endswith('.fmi'):
+                    fmi_bytes += os.path.getsize(os.path.join(self.db_dir, file_name))
+        return fmi_bytes
+
+
+    def predicted_kaiju_rss_bytes(self):
+        nodes_bytes = 0
+        nodes_path = os.path.join(self.db_dir, 'nodes.dmp')
+        if os.path.isfile(nodes_path):
+            nodes_bytes = os.path.getsize(nodes_path)
+        return self.fmi_bytes() \
+            + self.NODES_DMP_FACTOR * nodes_bytes \
+            + self.BASE_OVERHEAD_BYTES \
+            + self.THREAD_OVERHEAD_BYTES * self.threads
+
+
+    def max_kaiju_instances(self):
+        '''
+        How many kaiju runs on this database fit in memory side by side
+        '''
+        return int(memory_available_bytes() // self.predicted_kaiju_rss_bytes())
+
+
+    def kaiju_instances(self, max_instances=1):
+        '''
+        How many kaiju runs to let go at once: as many as fit in memory, up to max_instances (at least 1)
+        '''
+        fit_instances = self.max_kaiju_instances()
+        kaiju_instances = max(1, min(int(max_instances), fit_instances))
+        self._log("MEMORY PLAN: room for "+str(fit_instances)+" kaiju run(s) at once, running up to "+str(kaiju_instances))
+        return kaiju_instances
+
+
+    def check_kaiju_fits(self, db_type):
+        '''
+        Raises a ValueError, before anything is downloaded, if a single kaiju run won't fit in memory
+        '''
+        predicted_bytes = self.predicted_kaiju_rss_bytes()
+        available_bytes = memory_available_bytes()
+        self._log("MEMORY PLAN: kaiju on "+db_type+" needs an estimated "+self._gb(predicted_bytes)+
+                  " ("+self._gb(self.fmi_bytes())+" index, "+str(self.threads)+" threads); "+self._gb(available_bytes)+" available")
+        if available_bytes < predicted_bytes:
+            raise ValueError ("Not enough memory to run kaiju with the '"+db_type+"' database: it needs an estimated "+self._gb(predicted_bytes)+
+                              " (the "+self._gb(self.fmi_bytes())+" index is loaded whole), but only "+self._gb(available_bytes)+
+                              " is available to this job (MemAvailable / cgroup memory limit).  Choose a smaller db_type"+
+                              " (e.g. 'refseq' or 'progenomes' rather than 'nr' or 'nr_euk') or run on a node with more memory.")
+        return predicted_bytes
+
+
+    def _gb(self, n_bytes):
+        return '{0:.2f}'.format(float(n_bytes) / (1024**3)) + ' GB'
+
+
+    def _log(self, message):
+        print('{0:.2f}'.format(time.time()) + ': ' + str(message))
+        sys.stdout.flush()
@@ -17,6 +17,9 @@ from biokbase.workspace.client import Workspace as workspaceService
 #from Workspace.WorkspaceClient import Workspace as workspaceService
 from DataFileUtil.DataFileUtilClient import DataFileUtil
 
+from kb_kaiju.Utils.TaxonomyIndex import get_taxonomy
+from kb_kaiju.Utils.KaijuOutputReader import count_kaiju_classifications
+
 
 def log(message, prefix_newline=False):
     """Logging function, provides a hook to suppress or redirect log messages."""
@@ -39,11 +42,11 @@ class OutputBuilder(object):
         self.wsClient = None
 
         # store Kaiju DBs
-        self.NODES_DB = None
-        self.NAMES_DB = None
+        self.taxonomy = None  # TaxonomyIndex of the DB, from the process wide registry
 
-        # store species counts by sample
+        # store species counts by sample, as sparse (taxids, counts) uint32 arrays
         self.species_abundance_by_sample = dict()
+        self.unclassified_cnt_by_sample = dict()
 
         # store parsed info
         self.parsed_summary = dict()
@@ -482,8 +485,71 @@ class OutputBuilder(object):
         return out_html_files
 
 
+    def build_html_for_process_accounting(self, out_html_folder, proc_records, json_local_path):
+        out_html_buf = []
+
+        # add header
+        out_html_buf.extend (self._build_plot_html_header('KBase Kaiju Resource Usage'))
+
+        # totals by tool
+        tools = []
+        totals = dict()
+        for proc_record in proc_records:
+            tool = proc_record['tool']
+            if tool not in totals:
+                tools.append(tool)
+                totals[tool] = {'runs': 0, 'wall_secs': 0.0, 'cpu_secs': 0.0, 'peak_rss_bytes': 0, 'rchar': 0, 'wchar': 0}
+            totals[tool]['runs'] += 1
+            totals[tool]['wall_secs'] += proc_record['wall_secs']
+            totals[tool]['cpu_secs'] += proc_record['user_cpu_secs'] + proc_record['sys_cpu_secs']
+            totals[tool]['peak_rss_bytes'] = max(totals[tool]['peak_rss_bytes'], proc_record['peak_rss_bytes'])
+            totals[tool]['rchar'] += proc_record['rchar'] or 0
+            totals[tool]['wchar'] += proc_record['wchar'] or 0
+
+        out_html_buf.append('<h3>Resource Usage by Tool</h3>')
+        out_html_buf.append('<table>')
+        out_html_buf.append('<tr><th>Tool</th><th>Runs</th><th>Wall Time (s)</th><th>CPU Time (s)</th><th>Max Peak RSS (GB)</th><th>Read (GB)</th><th>Written (GB)</th></tr>')
+        for tool in tools:
+            out_html_buf.append('<tr><td>'+tool+'</td><td>'+str(totals[tool]['runs'])+'</td>'+
+                                '<td>{0:.1f}</td><td>{1:.1f}</td><td>{2:.2f}</td><td>{3:.2f}</td><td>{4:.2f}</td></tr>'.format(
+                                    totals[tool]['wall_secs'], totals[tool]['cpu_secs'], float(totals[tool]['peak_rss_bytes']) / 1024**3,
+                                    float(totals[tool]['rchar']) / 1024**3, float(totals[tool]['wchar']) / 1024**3))
+        out_html_buf.append('</table>')
+
+        # each run
+        out_html_buf.append('<h3>Resource Usage by Run</h3>')
+        out_html_buf.append('<p>Also as JSON: <a href="'+json_local_path+'">'+json_local_path+'</a></p>')
+        out_html_buf.append('<table>')
+        out_html_buf.append('<tr><th>Tool</th><th>Output</th><th>Wall Time (s)</th><th>User CPU (s)</th><th>Sys CPU (s)</th><th>Peak RSS (GB)</th><th>Read (GB)</th><th>Written (GB)</th><th>Exit Code</th></tr>')
+        for proc_record in proc_records:
+            target = ''
+            if '-o' in proc_record['command'] and proc_record['command'].index('-o') + 1 < len(proc_record['command']):
+                target = ', '.join([os.path.basename(path) for path in proc_record['command'][proc_record['command'].index('-o') + 1].split(',')])
+            out_html_buf.append('<tr><td>'+proc_record['tool']+'</td><td>'+target+'</td>'+
+                                '<td>{0:.1f}</td><td>{1:.1f}</td><td>{2:.1f}</td><td>{3:.2f}</td><td>{4:.2f}</td><td>{5:.2f}</td><td>{6}</td></tr>'.format(
+                                    proc_record['wall_secs'], proc_record['user_cpu_secs'], proc_record['sys_cpu_secs'],
+                                    float(proc_record['peak_rss_bytes']) / 1024**3, float(proc_record['rchar'] or 0) / 1024**3,
+                                    float(proc_record['wchar'] or 0) / 1024**3, proc_record['exit_code']))
+        out_html_buf.append('</table>')
+
+        # add footer
+        out_html_buf.extend (self._build_plot_html_footer())
+
+        # write file
+        out_local_path = 'process_accounting.html'
+        out_html_path = os.path.join (out_html_folder, out_local_path)
+        self._write_buf_to_file(out_html_path, out_html_buf)
+
+        return [{'type': 'accounting',
+                 'name': 'Resource Usage',
+                 'local_path': out_local_path,
+                 'abs_path': out_html_path
+                 }]
+
+
     def add_top_nav(self, html_pages):
         min_downshift = 25
+        top_nav_marker = '<!-- top nav -->'  # so a page isn't given two (re-run after a checkpoint)
 
         for html_page in html_pages:
             html_type = html_page['type']
@@ -519,6 +585,8 @@ class OutputBuilder(object):
             with open (abs_path, 'r') as html_handle:
                 for line in html_handle.readlines():
                     line_copy = line.lstrip()
+                    if line_copy.startswith(top_nav_marker):
+                        continue
 
                     # pad top of krona plot
                     if html_type == 'krona' and line_copy.startswith('options.style.top ='):
@@ -528,7 +596,7 @@ class OutputBuilder(object):
                         downshift = int(downshift_scale_per_char*len(top_nav_str))
                         if downshift < min_downshift:
                             downshift = min_downshift
-                        new_buf.append("\t options.style.top = '"+str(downshift)+"px';")
+                        new_buf.append("\t options.style.top = '"+str(downshift)+"px';\n")
                         continue
 
                     # capture original html
@@ -536,7 +604,7 @@ class OutputBuilder(object):
 
                     # add top nav str
                     if line_copy.startswith('<body'):
-                        new_buf.append(top_nav_str+"\n")
+                        new_buf.append(top_nav_marker+top_nav_str+"\n")
 
             with open (abs_path, 'w') as html_handle:
                 for line_buf in new_buf:
@@ -573,7 +641,7 @@ class OutputBuilder(object):
                     elif lineage.startswith('cannot be assigned'):
                         unassigned_perc = perc
                     elif lineage.startswith('belong to a'):
-                        chopped_str = re.sub(r'belong to a \S+ with less than ', '', lineage)
+                        chopped_str = re.sub(r'belong to a (\(non-viral\) )?\S+ with less than ', '', lineage)
                         tail_cutoff = re.sub(r'% of all reads', '', chopped_str)
                         tail_perc = perc
                     elif lineage.startswith('Viruses'):
@@ -607,151 +675,168 @@ class OutputBuilder(object):
         return (abundance, lineage_order, classified_frac)
 
 
-    def _parse_kaiju_classification_file (self, classification_file, tax_level, db_type):
-        KAIJU_DB_DIR   = os.path.join(os.path.sep, 'data', 'kaijudb', db_type)
-        KAIJU_DB_NODES = os.path.join(KAIJU_DB_DIR, 'nodes.dmp')
-        KAIJU_DB_NAMES = os.path.join(KAIJU_DB_DIR, 'names.dmp')
+    def _load_kaiju_taxonomy (self, db_type):
+        '''
+        Get the taxonomy index of a kaiju DB, opened once per process (see TaxonomyRegistry)
+        '''
+        self.taxonomy = get_taxonomy(db_type, self.scratch)
+        return self.taxonomy.largest_id
 
-        abundance_cnts = dict()
-        lineage_order = []
-        classified_cnt = 0
-        unclassified_cnt = 0
 
-        # store names db
-        if self.NAMES_DB != None:
-            largest_id = len(self.NAMES_DB)
-        else:
-            ID_I   = 0
-            NAME_I = 1
-            CAT_I  = 3
-            largest_id = 0
-            with open (KAIJU_DB_NAMES, 'r') as names_handle:
-                for names_line in names_handle.readlines():
-                    names_line = names_line.rstrip()
-                    names_line_info = names_line.split("\t|")
-                    name_category = names_line_info[CAT_I].strip()
-                    if name_category != 'scientific name':
-                        continue
-                    name_id = int(names_line_info[ID_I].strip())
-                    if name_id > largest_id:
-                        largest_id = name_id
-            self.NAMES_DB = []
-            for name_i in range(largest_id+1):
-                self.NAMES_DB.append(None)
-            with open (KAIJU_DB_NAMES, 'r') as names_handle:
-                for names_line in names_handle.readlines():
-                    names_line = names_line.rstrip()
-                    names_line_info = names_line.split("\t|")
-                    name_category = names_line_info[CAT_I].strip()
-                    if name_category != 'scientific name':
-                        continue
-                    name_id = int(names_line_info[ID_I].strip())
-                    self.NAMES_DB[name_id] = names_line_info[NAME_I].strip()
-
-        # store nodes db
-        all_tax_levels = ['class',
-                          'cohort',
-                          'family',
-                          'forma',
-                          'genus',
-                          'infraclass',
-                          'infraorder',
-                          'kingdom',
-                          'no rank',
-                          'order',
-                          'parvorder',
-                          'phylum',
-                          'species',
-                          'subclass',
-                          'subfamily',
-                          'subgenus',
-                          'subkingdom',
-                          'suborder',
-                          'subphylum',
-                          'subspecies',
-                          'subtribe',
-                          'superclass',
-                          'superfamily',
-                          'superkingdom',
-                          'superorder',
-                          'superphylum',
-                          'tribe',
-                          'varietas']
-        tax_level_id2str = []
-        tax_level_str2id = dict()
-        for tax_level_id,tax_level_str in enumerate(all_tax_levels):
-            tax_level_id2str.append(tax_level_str)
-            tax_level_str2id[tax_level_str] = tax_level_id
-
-        # store [PAR_ID, TAX_LEVEL_I]
-        if self.NODES_DB == None:
-            NODE_ID_I = 0
-            PAR_ID_I  = 1
-            LEVEL_I   = 2
-            self.NODES_DB = []
-            for node_i in range(largest_id+1):
-                self.NODES_DB.append(None)
-            with open (KAIJU_DB_NODES, 'r') as nodes_handle:
-                for nodes_line in nodes_handle.readlines():
-                    nodes_line = nodes_line.rstrip()
-                    nodes_line_info = nodes_line.split("\t|")
-                    node_id = int(nodes_line_info[NODE_ID_I].strip())
-                    par_id = int(nodes_line_info[PAR_ID_I].strip())
-                    tax_level_str = nodes_line_info[LEVEL_I].strip()
-                    if tax_level_str == 'species group' or tax_level_str == 'species subgroup':
-                        tax_level_str = 'species'
-                    tax_level_id = tax_level_str2id[tax_level_str]
-
-                    self.NODES_DB[node_id] = [par_id, tax_level_id]
+    def _count_kaiju_classifications (self, classification_file, db_type):
+        '''
+        Count reads by taxid (and unclassified reads) in a kaiju classification file.  Done once per file.
 
-        # parse species from kaiju read classification
+            (taxids, cnts, unclassified_cnt) = self._count_kaiju_classifications(classification_file, db_type)
+
+        taxids and cnts are uint32 arrays of the taxids with reads, in taxid order, and their
+        read counts.  Only these are kept per sample, not a count for every taxid in the DB.
+        '''
         if classification_file not in self.species_abundance_by_sample:
-            species_abundance_cnts = []
-            for node_i in range(largest_id+1):
-                species_abundance_cnts.append(0)
-            CLASS_FLAG_I = 0
-            READ_ID_I    = 1
-            NODE_ID_I    = 2
-            with open (classification_file, 'r') as class_handle:
-                for class_line in class_handle.readlines():
-                    class_line.rstrip()
-                    class_info = class_line.split("\t")
-                    if class_info[CLASS_FLAG_I] == 'U':
-                        continue
-                    node_id = int(class_info[NODE_ID_I])
-                    species_abundance_cnts[node_id] += 1
-            self.species_abundance_by_sample[classification_file] = species_abundance_cnts
+            largest_id = self._load_kaiju_taxonomy(db_type)
+            (species_abundance_cnts, unclassified_cnt) = count_kaiju_classifications(classification_file, largest_id+1)
+            taxids = np.flatnonzero(species_abundance_cnts)
+            self.species_abundance_by_sample[classification_file] = (taxids.astype(np.uint32),
+                                                                     species_abundance_cnts[taxids].astype(np.uint32))
+            self.unclassified_cnt_by_sample[classification_file] = unclassified_cnt
+
+        (taxids, cnts) = self.species_abundance_by_sample[classification_file]
+        return (taxids, cnts, self.unclassified_cnt_by_sample[classification_file])
 
 
-        # navigate up tax hierarchy until reach desired level and store abundance by name
+    def _parse_kaiju_classification_file (self, classification_file, tax_level, db_type):
+        self._load_kaiju_taxonomy(db_type)
+
+        # parse species from kaiju read classification
+        (node_ids, node_cnts, unclassified_cnt) = self._count_kaiju_classifications(classification_file, db_type)
+
+
+        # roll up to the desired level and store abundance by name
+        # ('species group' and 'species subgroup' count as species)
+        (level_ids, level_cnts, unassigned_cnt) = self.taxonomy.rollup(node_ids, node_cnts, tax_level, species_groups=True)
         abundance_cnts = dict()
-        PAR_ID_I       = 0
-        TAX_LEVEL_ID_I = 1
-        level_limit = 100
-        for node_id,species_cnt in enumerate(self.species_abundance_by_sample[classification_file]):
-            if species_cnt > 0:
-                this_par_id       = self.NODES_DB[node_id][PAR_ID_I]
-                this_tax_level_id = self.NODES_DB[node_id][TAX_LEVEL_ID_I]
-                level_lim_i = 0
-                while level_lim_i < level_limit:
-                    level_lim_i += 1
-                    if tax_level_id2str[this_tax_level_id] == tax_level:
-                        node_name = self.NAMES_DB[node_id]
-                        if node_name not in abundance_cnts:
-                            abundance_cnts[node_name] = 0
-                        abundance_cnts[node_name] += species_cnt
-                        break
-                    else:
-                        node_id = this_par_id
-                        this_par_id       = self.NODES_DB[node_id][PAR_ID_I]
-                        this_tax_level_id = self.NODES_DB[node_id][TAX_LEVEL_ID_I]
-                        if this_par_id == 1:
-                            break
+        for (level_id, level_cnt) in zip(level_ids, level_cnts):
+            node_name = self.taxonomy.name(level_id)
+            if node_name not in abundance_cnts:
+                abundance_cnts[node_name] = 0
+            abundance_cnts[node_name] += int(level_cnt)
 
         lineage_order = abundance_cnts.keys()
         return (abundance_cnts, lineage_order)
 
 
+    def write_kaijuReports (self, classification_file, report_files, db_type,
+                            filter_percent=0, filter_unclassified=0, full_tax_path=0):
+        '''
+        Write the kaiju2table summary of a kaiju classification file for several tax levels
+        at once, reading the classifications (and the taxonomy) only once.
+
+            report_files = {tax_level: out_path, ...}
+
+        Same table as kaiju2table -r <tax_level> [-m filter_percent] [-u] [-p]: reads of viruses
+        are counted in a single 'Viruses' row, and taxa under filter_percent % of the reads are
+        lumped together.
+        '''
+        VIRUSES_ID = 10239
+
+        self._load_kaiju_taxonomy(db_type)
+        (node_ids, node_cnts, unclassified_cnt) = self._count_kaiju_classifications(classification_file, db_type)
+        tax_levels = list(report_files.keys())
+        filter_percent = float(filter_percent or 0)
+        filter_unclassified = (int(filter_unclassified) == 1)
+        full_tax_path = (int(full_tax_path) == 1)
+
+        # reads of viruses are counted once, the rest rolled up to each level (see TaxonomyIndex)
+        classified_cnt = int(node_cnts.sum())
+        viral = self.taxonomy.is_viral(node_ids)
+        virus_cnt = int(node_cnts[viral].sum())
+        taxon_cnts = dict()
+        unassigned_cnts = dict()
+        for tax_level in tax_levels:
+            (level_ids, level_cnts, unassigned_cnts[tax_level]) = self.taxonomy.rollup(node_ids[~viral], node_cnts[~viral], tax_level)
+            taxon_cnts[tax_level] = dict(zip([int(level_id) for level_id in level_ids],
+                                             [int(level_cnt) for level_cnt in level_cnts]))
+
+        total_cnt = classified_cnt
+        if not filter_unclassified:
+            total_cnt += unclassified_cnt
+
+        def perc_str(cnt):
+            if total_cnt == 0:
+                return '{0:.6f}'.format(0)
+            return '{0:.6f}'.format(100.0 * cnt / total_cnt)
+
+        def report_line(perc, cnt, taxon_id, taxon_name):
+            return "\t".join([classification_file, perc, str(cnt), str(taxon_id), taxon_name])
+
+        for tax_level in tax_levels:
+            below_filter_cnt = 0
+            report_buf = ["\t".join(['file', 'percent', 'reads', 'taxon_id', 'taxon_name'])]
+            for (taxon_id, cnt) in sorted(taxon_cnts[tax_level].items(), key=lambda item: (-item[1], item[0])):
+                if total_cnt > 0 and 100.0 * cnt / total_cnt < filter_percent:
+                    below_filter_cnt += cnt
+                    continue
+                if full_tax_path:
+                    taxon_name = self._get_kaiju_tax_path(taxon_id)
+                else:
+                    taxon_name = str(self.taxonomy.name(taxon_id))
+                report_buf.append(report_line(perc_str(cnt), cnt, taxon_id, taxon_name))
+            if unassigned_cnts[tax_level] > 0:
+                report_buf.append(report_line(perc_str(unassigned_cnts[tax_level]), unassigned_cnts[tax_level],
+                                              'NA', 'cannot be assigned to a (non-viral) '+tax_level))
+            if virus_cnt > 0:
+                report_buf.append(report_line(perc_str(virus_cnt), virus_cnt, VIRUSES_ID, 'Viruses'))
+            if below_filter_cnt > 0:
+                report_buf.append(report_line(perc_str(below_filter_cnt), below_filter_cnt,
+                                              'NA', 'belong to a (non-viral) '+tax_level+' with less than '+'{0:g}'.format(filter_percent)+'% of all reads'))
+            if not filter_unclassified:
+                report_buf.append(report_line(perc_str(unclassified_cnt), unclassified_cnt, 'NA', 'unclassified'))
+
+            self._write_buf_to_file(report_files[tax_level], report_buf)
+
+
+    def write_krona_text (self, classification_file, out_path, db_type):
+        '''
+        Write the ktImportText input for a kaiju classification file (as kaiju2krona does):
+        one line per taxid, the read count and then the names down its lineage, tab separated
+        '''
+        self._load_kaiju_taxonomy(db_type)
+        (node_ids, node_cnts, unclassified_cnt) = self._count_kaiju_classifications(classification_file, db_type)
+
+        krona_buf = []
+        for (node_id, species_cnt) in zip(node_ids, node_cnts):
+            lineage = self._get_kaiju_lineage(int(node_id))
+            if len(lineage) == 0:
+                continue
+            krona_buf.append("\t".join([str(species_cnt)] + [str(self.taxonomy.name(lineage_id)) for lineage_id in lineage]))
+        self._write_buf_to_file(out_path, krona_buf)
+
+
+    def _get_kaiju_lineage (self, node_id):
+        '''
+        Taxids from the top of the tree (below root) down to node_id
+        '''
+        level_limit = 100
+        lineage = []
+        level_lim_i = 0
+        while level_lim_i < level_limit and node_id != 1 and self.taxonomy.has_node(node_id):
+            level_lim_i += 1
+            lineage.append(node_id)
+            par_id = int(self.taxonomy.parents[node_id])
+            if par_id == node_id:
+                break
+            node_id = par_id
+        lineage.reverse()
+        return lineage
+
+
+    def _get_kaiju_tax_path (self, node_id):
+        '''
+        Names from the top of the tree (below root) down to node_id, each followed by ';' (as kaiju2table -p)
+        '''
+        return ''.join([str(self.taxonomy.name(lineage_id))+';' for lineage_id in self._get_kaiju_lineage(node_id)])
+
+
     def _create_bar_plots (self, out_folder=None,
                            out_file_basename=None,
                            vals=None,
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import threading
+import traceback
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+def available_cpus():
+    '''
+    CPUs this process may actually use: the CPU affinity mask, capped by the
+    cgroup CPU quota (cgroup v2 cpu.max or v1 cpu.cfs_quota_us), if any
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = cpu_count()
+
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as cpu_max_handle:
+            (quota_us, period_us) = cpu_max_handle.read().split()[:2]
+        if quota_us != 'max':
+            quota = float(quota_us) / float(period_us)
+    except (IOError, OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as quota_handle:
+                quota_us = int(quota_handle.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as period_handle:
+                period_us = int(period_handle.read())
+            if quota_us > 0 and period_us > 0:
+                quota = float(quota_us) / float(period_us)
+        except (IOError, OSError, ValueError):
+            pass
+
+    if quota is not None:
+        n_cpus = min(n_cpus, int(quota + 0.999))
+    return max(1, n_cpus)
+
+
+class ProcScheduler(object):
+    '''
+    Runs independent subprocess jobs concurrently within a CPU budget.  Each job holds
+    as many CPUs as its tool uses threads while it runs (capped at the budget), so
+    single threaded tools like ktImportText fill the idle cores.
+
+        jobs = [{'name': ..., 'threads': 1, 'steps': [command, ...], 'log_output_file': None}, ...]
+        ProcScheduler(cpu_budget, self.run_proc).run(jobs)
+
+    The steps of a job run in order; a step is a command list, or a function returning
+    one when it can only be built once the previous step has run.  After a failure no
+    more jobs of that run() are started, and the first error is raised once the running
+    ones finish.
+
+    One scheduler can be shared by the whole pipeline: run() may be called from several
+    threads at once, and processes started outside of it take their CPUs with acquire()
+    and release(), so together they never use more than the budget.  CPUs are handed
+    out in the order asked for, so a many threaded kaiju isn't starved by a stream of
+    single threaded jobs.
+    '''
+
+    def __init__(self, cpu_budget, run_proc):
+        self.cpu_budget = max(1, int(cpu_budget))
+        self.run_proc = run_proc
+        self._free_cpus = self.cpu_budget
+        self._waiting = []  # one entry per acquire() waiting, in the order asked
+        self._cond = threading.Condition()
+
+
+    def run(self, jobs):
+        if len(jobs) == 0:
+            return
+        errors = []
+        pool = ThreadPool(min(self.cpu_budget, len(jobs)))
+        try:
+            pool.map(lambda job: self._run_job(job, errors), jobs)
+        finally:
+            pool.close()
+            pool.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+
+    def acquire(self, threads, errors=None):
+        '''
+        Waits for and takes threads CPUs (capped at the budget).  Returns the number taken,
+        to pass to release(), or 0 without taking any if errors gets an entry while waiting
+        '''
+        threads = min(self.cpu_budget, max(1, int(threads)))
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while (self._waiting[0] is not ticket or self._free_cpus < threads) and not errors:
+                    self._cond.wait()
+                if errors:
+                    return 0
+                self._free_cpus -= threads
+                return threads
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+
+    def release(self, threads):
+        with self._cond:
+            self._free_cpus += threads
+            self._cond.notify_all()
+
+
+    def _run_job(self, job, errors):
+        threads = self.acquire(job.get('threads', 1), errors)
+        if threads == 0:
+            return
+        try:
+            for step in job['steps']:
+                command = step() if callable(step) else step
+                self.run_proc (command, job.get('log_output_file'))
+        except Exception as e:
+            self._log("Error running job "+str(job.get('name'))+":\n"+traceback.format_exc())
+            with self._cond:
+                errors.append(e)
+        finally:
+            self.release(threads)
+
+
+    def _log(self, message):
+        print('{0:.2f}'.format(time.time()) + ': ' + str(message))
+        sys.stdout.flush()
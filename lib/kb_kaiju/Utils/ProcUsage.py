@@ -0,0 +1,98 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+import threading
+
+
+# waitid() arguments, for Pythons whose os module lacks waitid (py2); values are Linux's
+P_PID = getattr(os, 'P_PID', 1)
+WEXITED = getattr(os, 'WEXITED', 4)
+WNOWAIT = getattr(os, 'WNOWAIT', 0x01000000)
+SIGINFO_BYTES = 128
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.waitid.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+except (OSError, AttributeError):
+    _libc = None
+
+
+def wait_proc(p, io_interval=0.1):
+    '''
+    Reap a Popen process with wait4(), for its resource usage, reading its
+    /proc/<pid>/io counters once it has exited but before it is reaped, so
+    they are final.  Where a process can't be waited for without reaping it,
+    the counters are sampled every io_interval seconds while it runs.
+    Sets p.returncode.
+
+    Returns (exit code, rusage, io counters dict).
+    '''
+    if wait_exited(p.pid):
+        proc_io = read_proc_io(p.pid)  # exited but not reaped, so /proc/<pid> is still there
+        (pid, status, rusage) = os.wait4(p.pid, 0)
+    else:
+        (status, rusage, proc_io) = _wait_sampling_io(p.pid, io_interval)
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return (p.returncode, rusage, proc_io)
+
+
+def wait_exited(pid):
+    '''
+    Blocks until a child process has exited, leaving it unreaped (waitid()
+    with WNOWAIT).  Returns False if that can't be done here.
+    '''
+    if hasattr(os, 'waitid'):
+        os.waitid(P_PID, pid, WEXITED | WNOWAIT)
+        return True
+    if _libc is None:
+        return False
+    siginfo = ctypes.create_string_buffer(SIGINFO_BYTES)
+    while _libc.waitid(P_PID, pid, siginfo, WEXITED | WNOWAIT) != 0:
+        if ctypes.get_errno() != errno.EINTR:
+            return False
+    return True
+
+
+def read_proc_io(pid):
+    '''
+    /proc/<pid>/io counters (rchar, wchar, read_bytes, write_bytes, ...), or {} if unreadable
+    '''
+    proc_io = dict()
+    try:
+        with open('/proc/'+str(pid)+'/io', 'r') as io_handle:
+            for line in io_handle:
+                (key, value) = line.split(':')
+                proc_io[key.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return proc_io
+
+
+def _wait_sampling_io(pid, io_interval):
+    '''
+    wait4() in a waiter thread, sampling /proc/<pid>/io until it returns.
+    Misses at most the last io_interval seconds of IO.
+    '''
+    reaped = []
+
+    def reap():
+        try:
+            reaped.append(os.wait4(pid, 0))
+        except OSError as e:
+            reaped.append(e)
+
+    waiter = threading.Thread(target=reap)
+    waiter.daemon = True
+    waiter.start()
+    proc_io = dict()
+    while waiter.is_alive():
+        proc_io = read_proc_io(pid) or proc_io
+        waiter.join(io_interval)
+    if isinstance(reaped[0], OSError):
+        raise reaped[0]
+    (reaped_pid, status, rusage) = reaped[0]
+    return (status, rusage, proc_io)
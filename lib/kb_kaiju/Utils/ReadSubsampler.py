@@ -0,0 +1,562 @@
+import os
+import struct
+import hashlib
+
+import numpy as np
+
+from kb_kaiju.Utils.FastqReader import FastqReader
+
+
+# 64-bit arithmetic for the seed mixing below
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+GOLDEN_GAMMA_64 = 0x9E3779B97F4A7C15
+
+
+def read_id_hash(read_id):
+    '''
+    Stable 64-bit hash of a normalized read id
+    '''
+    return struct.unpack('<Q', hashlib.md5(read_id).digest()[:8])[0]
+
+
+def read_id_check(read_id):
+    '''
+    Second 64-bit hash of a normalized read id, independent of read_id_hash(), that
+    tells apart reads of the fwd and rev files whose read_id_hash() is the same
+    '''
+    return struct.unpack('<Q', hashlib.sha1(read_id).digest()[:8])[0]
+
+
+def read_name_key(read_name):
+    '''
+    Key of a read name as kaiju reports it (FASTQ header up to the first whitespace, without
+    the '@'): the name less a trailing /1 or /2, which kaiju may or may not have dropped
+    '''
+    if read_name[-2:] in (b'/1', b'/2'):
+        return read_name[:-2]
+    return read_name
+
+
+class ReadSubsampler(object):
+    '''
+    Streaming, deterministic random subsampler for FASTQ read libraries.
+
+    Membership of a read in a subsample replicate is a pure function of
+    (read_id, subsample_seed), so every file is read exactly once and no
+    global list of read ids has to be held in memory.  Each replicate covers
+    a disjoint slice of the hash space, so replicates never overlap.
+
+    Output paths may repeat: passing the same path for every replicate
+    writes their union to a single file.  Pass a UnionReadReplicates to record
+    which replicate each read written went to, to tell them apart later.
+    '''
+
+    def __init__(self, subsample_percent=100, subsample_replicates=1, subsample_seed=1):
+        self.subsample_percent = subsample_percent
+        self.subsample_replicates = subsample_replicates
+        self.subsample_seed = subsample_seed
+
+        self.subsample_frac = subsample_percent / 100.0
+        if self.subsample_frac * subsample_replicates > 1.0:
+            raise ValueError ("must specify reads_perc <= 1 / split_num.  You have reads_perc:"+str(subsample_percent)+" > 1 / split_num:"+str(subsample_replicates)+".  Instead try reads_perc <= "+ str(int(100 * 1/subsample_replicates)))
+
+        self.seed_mix = (int(subsample_seed) * GOLDEN_GAMMA_64) & MASK_64
+        self.in_buf_size = 4*1024*1024
+        self.out_buf_size = 1000000
+        self.recs_beep_n = 1000000
+
+
+    def replicate_of(self, read_id):
+        '''
+        Returns the replicate index a normalized read id belongs to, or None if
+        it isn't part of any subsample
+        '''
+        return self.replicate_of_hash(read_id_hash(read_id))
+
+
+    def replicate_of_hash(self, read_hash):
+        '''
+        Same as replicate_of(), for an already computed read_id_hash()
+        '''
+        # splitmix64 finalizer over the seeded read id hash
+        x = read_hash ^ self.seed_mix
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK_64
+        x ^= x >> 31
+        lib_i = int((x / 18446744073709551616.0) / self.subsample_frac)
+        if lib_i < self.subsample_replicates:
+            return lib_i
+        return None
+
+
+    def subsample_single_end(self, input_fwd_file, output_fwd_file_paths, read_replicates=None):
+        '''
+        Splits a single end library into its replicates in one pass
+
+        Returns {'total_reads': <int>, 'reads_by_set': [<int>, ...]}
+        '''
+        total_reads = 0
+        reads_by_set = [0] * self.subsample_replicates
+        out_handles = self._open_outputs(output_fwd_file_paths)
+        try:
+            for (read_id, rec) in self._iter_fastq_records(input_fwd_file):
+                total_reads += 1
+                lib_i = self.replicate_of(read_id)
+                if lib_i is not None:
+                    out_handles[lib_i].write(rec)
+                    reads_by_set[lib_i] += 1
+                    if read_replicates is not None:
+                        read_replicates.add(rec, lib_i)
+                if total_reads % self.recs_beep_n == 0:
+                    print ("\t"+str(total_reads)+" recs processed")
+        finally:
+            for out_handle in out_handles:
+                out_handle.close()
+
+        return {'total_reads': total_reads,
+                'reads_by_set': reads_by_set}
+
+
+    def subsample_paired_end(self, input_fwd_file, input_rev_file, output_fwd_file_paths, output_rev_file_paths, read_replicates=None):
+        '''
+        Splits a paired end library into its replicates, keeping only reads
+        whose mate is also present.  Files whose mates are in the same order
+        are walked in lockstep; otherwise pairing goes through an index.
+        read_replicates records the fwd reads written.
+
+        Returns {'total_fwd_reads': <int>, 'total_rev_reads': <int>,
+                 'unpaired_fwd_reads': <int>, 'unpaired_rev_reads': <int>,
+                 'reads_by_set': [<int>, ...]}
+        '''
+        subsample_cnts = self._subsample_synchronized_pairs(input_fwd_file,
+                                                            input_rev_file,
+                                                            output_fwd_file_paths,
+                                                            output_rev_file_paths,
+                                                            read_replicates)
+        if subsample_cnts is None:
+            if read_replicates is not None:
+                read_replicates.clear()
+            subsample_cnts = self._subsample_indexed_pairs(input_fwd_file,
+                                                           input_rev_file,
+                                                           output_fwd_file_paths,
+                                                           output_rev_file_paths,
+                                                           read_replicates)
+        return subsample_cnts
+
+
+    def _subsample_synchronized_pairs(self, input_fwd_file, input_rev_file, output_fwd_file_paths, output_rev_file_paths, read_replicates):
+        '''
+        Walks fwd and rev files together, in constant memory.  Gives up and
+        returns None at the first record whose ids don't match.
+        '''
+        print ("SAMPLING SYNCHRONIZED PAIRS")  # DEBUG
+        total_reads = 0
+        reads_by_set = [0] * self.subsample_replicates
+        in_sync = True
+        fwd_recs = self._iter_fastq_records(input_fwd_file)
+        rev_recs = self._iter_fastq_records(input_rev_file)
+        fwd_out_handles = self._open_outputs(output_fwd_file_paths)
+        rev_out_handles = self._open_outputs(output_rev_file_paths)
+        try:
+            while True:
+                fwd_rec = next(fwd_recs, None)
+                rev_rec = next(rev_recs, None)
+                if fwd_rec is None and rev_rec is None:
+                    break
+                if fwd_rec is None or rev_rec is None or fwd_rec[0] != rev_rec[0]:
+                    in_sync = False
+                    break
+                total_reads += 1
+                lib_i = self.replicate_of(fwd_rec[0])
+                if lib_i is not None:
+                    fwd_out_handles[lib_i].write(fwd_rec[1])
+                    rev_out_handles[lib_i].write(rev_rec[1])
+                    reads_by_set[lib_i] += 1
+                    if read_replicates is not None:
+                        read_replicates.add(fwd_rec[1], lib_i)
+                if total_reads % self.recs_beep_n == 0:
+                    print ("\t"+str(total_reads)+" recs processed")
+        finally:
+            fwd_recs.close()
+            rev_recs.close()
+            for out_handle in fwd_out_handles + rev_out_handles:
+                out_handle.close()
+
+        if not in_sync:
+            print ("FWD AND REV READS NOT SYNCHRONIZED AT RECORD "+str(total_reads+1)+".  Pairing by read id instead.")
+            for path in self._unique_paths(output_fwd_file_paths + output_rev_file_paths):
+                os.remove(path)
+            return None
+
+        return {'total_fwd_reads': total_reads,
+                'total_rev_reads': total_reads,
+                'unpaired_fwd_reads': 0,
+                'unpaired_rev_reads': 0,
+                'reads_by_set': reads_by_set}
+
+
+    def _subsample_indexed_pairs(self, input_fwd_file, input_rev_file, output_fwd_file_paths, output_rev_file_paths, read_replicates):
+        '''
+        Pairs reads in any order.  Each input file is read once; sampled fwd
+        reads are remembered in a ReadPairingIndex (16 bytes per read).
+        read_replicates gets every sampled fwd read, mate or not; the extra
+        entries are never looked up.
+        '''
+        tmp_fwd_file_paths = [path+'.unpaired' for path in output_fwd_file_paths]
+
+        # fwd: write sampled reads and index their ids
+        print ("SAMPLING FWD READS")  # DEBUG
+        total_fwd_reads = 0
+        fwd_index = ReadPairingIndex()
+        out_handles = self._open_outputs(tmp_fwd_file_paths)
+        try:
+            for (read_id, rec) in self._iter_fastq_records(input_fwd_file):
+                total_fwd_reads += 1
+                read_hash = read_id_hash(read_id)
+                lib_i = self.replicate_of_hash(read_hash)
+                if lib_i is not None:
+                    out_handles[lib_i].write(rec)
+                    fwd_index.add(read_hash, read_id_check(read_id))
+                    if read_replicates is not None:
+                        read_replicates.add(rec, lib_i)
+        finally:
+            for out_handle in out_handles:
+                out_handle.close()
+        fwd_index.freeze()
+
+        # rare: distinct sampled ids sharing a hash are resolved by exact id
+        if fwd_index.has_collisions():
+            print ("RESOLVING READ ID HASH COLLISIONS")  # DEBUG
+            for tmp_path in self._unique_paths(tmp_fwd_file_paths):
+                for (read_id, rec) in self._iter_fastq_records(tmp_path):
+                    fwd_index.add_collision_id(read_id_hash(read_id), read_id)
+
+        # rev: keep sampled reads that have a sampled fwd mate
+        print ("SAMPLING REV READS")  # DEBUG
+        total_rev_reads = 0
+        unpaired_rev_reads = 0
+        reads_by_set = [0] * self.subsample_replicates
+        out_handles = self._open_outputs(output_rev_file_paths)
+        try:
+            for batch in self._iter_sampled_batches(input_rev_file):
+                total_rev_reads += batch['total_reads']
+                found = fwd_index.mark_paired(batch['hashes'], batch['checks'], batch['read_ids'])
+                for (rec_i, rec) in enumerate(batch['recs']):
+                    if found[rec_i]:
+                        lib_i = batch['lib_i'][rec_i]
+                        out_handles[lib_i].write(rec)
+                        reads_by_set[lib_i] += 1
+                    else:
+                        unpaired_rev_reads += 1
+        finally:
+            for out_handle in out_handles:
+                out_handle.close()
+
+        # fwd: drop sampled reads without a mate (only rewritten if there are any)
+        paired_cnt = sum(reads_by_set)
+        unpaired_fwd_reads = fwd_index.n_reads - paired_cnt
+        if unpaired_fwd_reads == 0:
+            for out_path in self._unique_paths(output_fwd_file_paths):
+                os.rename(out_path+'.unpaired', out_path)
+        else:
+            print ("REMOVING UNPAIRED FWD READS")  # DEBUG
+            out_handles = self._open_outputs(output_fwd_file_paths)
+            try:
+                for out_path in self._unique_paths(output_fwd_file_paths):
+                    lib_i = output_fwd_file_paths.index(out_path)
+                    tmp_path = out_path+'.unpaired'
+                    for batch in self._iter_sampled_batches(tmp_path):
+                        paired = fwd_index.is_paired(batch['hashes'], batch['checks'], batch['read_ids'])
+                        for (rec_i, rec) in enumerate(batch['recs']):
+                            if paired[rec_i]:
+                                out_handles[lib_i].write(rec)
+                    os.remove(tmp_path)
+            finally:
+                for out_handle in out_handles:
+                    out_handle.close()
+
+        return {'total_fwd_reads': total_fwd_reads,
+                'total_rev_reads': total_rev_reads,
+                'unpaired_fwd_reads': unpaired_fwd_reads,
+                'unpaired_rev_reads': unpaired_rev_reads,
+                'reads_by_set': reads_by_set}
+
+
+    def _iter_sampled_batches(self, fastq_path, batch_size=100000):
+        '''
+        Groups the sampled records of a FASTQ file into batches for vectorized
+        index lookups.  total_reads counts sampled and unsampled records read.
+        '''
+        batch = self._new_batch()
+        for (read_id, rec) in self._iter_fastq_records(fastq_path):
+            batch['total_reads'] += 1
+            read_hash = read_id_hash(read_id)
+            lib_i = self.replicate_of_hash(read_hash)
+            if lib_i is None:
+                continue
+            batch['hashes'].append(read_hash)
+            batch['checks'].append(read_id_check(read_id))
+            batch['read_ids'].append(read_id)
+            batch['recs'].append(rec)
+            batch['lib_i'].append(lib_i)
+            if len(batch['recs']) >= batch_size:
+                batch['hashes'] = np.array(batch['hashes'], dtype=np.uint64)
+                batch['checks'] = np.array(batch['checks'], dtype=np.uint64)
+                yield batch
+                batch = self._new_batch()
+        if batch['total_reads'] > 0:
+            batch['hashes'] = np.array(batch['hashes'], dtype=np.uint64)
+            batch['checks'] = np.array(batch['checks'], dtype=np.uint64)
+            yield batch
+
+
+    def _new_batch(self):
+        return {'total_reads': 0, 'hashes': [], 'checks': [], 'read_ids': [], 'recs': [], 'lib_i': []}
+
+
+    def _open_outputs(self, output_file_paths):
+        '''
+        One handle per replicate; replicates given the same path share a handle
+        '''
+        handles_by_path = dict()
+        for path in self._unique_paths(output_file_paths):
+            handles_by_path[path] = open(path, 'wb', self.out_buf_size)
+        return [handles_by_path[path] for path in output_file_paths]
+
+
+    def _unique_paths(self, file_paths):
+        unique_paths = []
+        for path in file_paths:
+            if path not in unique_paths:
+                unique_paths.append(path)
+        return unique_paths
+
+
+    def _iter_fastq_records(self, fastq_path):
+        '''
+        Yields (normalized read id, full 4-line record) for each FASTQ record
+        '''
+        return iter(FastqReader(fastq_path, self.in_buf_size))
+
+
+class ReadPairingIndex(object):
+    '''
+    Set of read ids held as a sorted NumPy array of 64-bit read_id_hash()
+    values, with a read_id_check() value and a paired flag per entry.
+
+    A read looked up is in the set only if both its hash and its check match
+    an entry, so a rev read whose hash merely collides with that of another
+    fwd read isn't taken for its mate.  Hashes shared by more than one added
+    read fall back to exact read id comparison (add_collision_id()).
+    '''
+
+    def __init__(self):
+        self.chunk_size = 1000000
+        self._chunks = []
+        self._chunk = []
+        self.n_reads = 0
+        self.hashes = None
+        self.checks = None
+        self.paired = None
+        self.collision_hashes = None
+        self.collision_ids = dict()
+
+
+    def add(self, read_hash, read_check):
+        self._chunk.append((read_hash, read_check))
+        if len(self._chunk) >= self.chunk_size:
+            self._chunks.append(np.array(self._chunk, dtype=np.uint64).reshape(-1, 2))
+            self._chunk = []
+
+
+    def freeze(self):
+        '''
+        Sorts the added hashes.  Must be called once, after the last add()
+        '''
+        if len(self._chunk) > 0:
+            self._chunks.append(np.array(self._chunk, dtype=np.uint64).reshape(-1, 2))
+        self._chunk = []
+        if len(self._chunks) > 0:
+            entries = np.concatenate(self._chunks)
+        else:
+            entries = np.zeros((0, 2), dtype=np.uint64)
+        self._chunks = []
+        order = np.argsort(entries[:, 0], kind='mergesort')
+        hashes = entries[order, 0]
+        checks = entries[order, 1]
+        del entries
+
+        self.n_reads = len(hashes)
+        repeat_mask = hashes[1:] == hashes[:-1]
+        self.collision_hashes = np.unique(hashes[1:][repeat_mask])
+        if len(self.collision_hashes) > 0:
+            first_mask = np.concatenate(([True], ~repeat_mask))
+            (hashes, checks) = (hashes[first_mask], checks[first_mask])
+        self.hashes = hashes
+        self.checks = checks
+        self.paired = np.zeros(len(hashes), dtype=bool)
+
+
+    def has_collisions(self):
+        return len(self.collision_hashes) > 0
+
+
+    def add_collision_id(self, read_hash, read_id):
+        '''
+        Registers the exact id of an added read if its hash is ambiguous
+        '''
+        if self._in_collisions(np.array([read_hash], dtype=np.uint64))[0]:
+            self.collision_ids[read_id] = False
+
+
+    def mark_paired(self, read_hashes, read_checks, read_ids):
+        '''
+        Returns a bool array telling which of the given reads are in the index
+        and flags those as paired
+        '''
+        (found, pos, in_collisions) = self._lookup(read_hashes, read_checks)
+        for rec_i in np.flatnonzero(in_collisions):
+            if read_ids[rec_i] in self.collision_ids:
+                self.collision_ids[read_ids[rec_i]] = True
+                found[rec_i] = True
+        self.paired[pos[found & ~in_collisions]] = True
+        return found
+
+
+    def is_paired(self, read_hashes, read_checks, read_ids):
+        '''
+        Returns a bool array telling which of the given reads were flagged by
+        mark_paired()
+        '''
+        (found, pos, in_collisions) = self._lookup(read_hashes, read_checks)
+        paired = found & self.paired[pos]
+        for rec_i in np.flatnonzero(in_collisions):
+            paired[rec_i] = self.collision_ids.get(read_ids[rec_i], False)
+        return paired
+
+
+    def _lookup(self, read_hashes, read_checks):
+        '''
+        (found: hash and check match an entry whose hash is unique,
+         pos: where the hash is, in_collisions: hash is shared by several entries,
+                                                 to be resolved by exact id)
+        '''
+        n_recs = len(read_hashes)
+        if len(self.hashes) == 0:
+            return (np.zeros(n_recs, dtype=bool), np.zeros(n_recs, dtype=np.intp), np.zeros(n_recs, dtype=bool))
+        pos = np.searchsorted(self.hashes, read_hashes)
+        pos = np.minimum(pos, len(self.hashes)-1)
+        hash_found = self.hashes[pos] == read_hashes
+        in_collisions = hash_found & self._in_collisions(read_hashes)
+        found = hash_found & ~in_collisions & (self.checks[pos] == read_checks)
+        return (found, pos, in_collisions)
+
+
+    def _in_collisions(self, read_hashes):
+        if len(self.collision_hashes) == 0:
+            return np.zeros(len(read_hashes), dtype=bool)
+        return np.isin(read_hashes, self.collision_hashes)
+
+
+class UnionReadReplicates(object):
+    '''
+    The replicate of each read written to a union of subsample replicates, by a 64-bit
+    hash of its read_name_key(), so kaiju output for the union can be split by the read
+    names kaiju reports (9 bytes per read).  Replicates can't be derived again from those
+    names: kaiju may have trimmed them, and normalizing a trimmed name can strip more.
+
+        read_replicates = UnionReadReplicates()
+        subsampler.subsample_single_end(fwd_path, [union_path] * n, read_replicates)
+        read_replicates.save(union_path + '.replicates.npz')
+        ...
+        lib_is = UnionReadReplicates.load(replicates_path).replicates_of(read_names)
+    '''
+
+    UNKNOWN = -1
+    AMBIGUOUS = 255  # names of reads in different replicates with the same key hash
+
+    def __init__(self):
+        self.chunk_size = 1000000
+        self.clear()
+
+
+    def clear(self):
+        self._chunks = []
+        self._chunk = []
+        self.hashes = None
+        self.lib_is = None
+
+
+    def add(self, rec, lib_i):
+        '''
+        Records the replicate of a FASTQ record written to the union
+        '''
+        read_name = rec[1:rec.index(b'\n')].split(None, 1)[0]
+        self._chunk.append((read_id_hash(read_name_key(read_name)), lib_i))
+        if len(self._chunk) >= self.chunk_size:
+            self._chunks.append(np.array(self._chunk, dtype=np.uint64).reshape(-1, 2))
+            self._chunk = []
+
+
+    def save(self, path):
+        '''
+        Sorts the added reads by hash and saves them.  Must be called once, after the last add()
+        '''
+        if len(self._chunk) > 0:
+            self._chunks.append(np.array(self._chunk, dtype=np.uint64).reshape(-1, 2))
+        if len(self._chunks) > 0:
+            entries = np.concatenate(self._chunks)
+        else:
+            entries = np.zeros((0, 2), dtype=np.uint64)
+        self._chunks = []
+        self._chunk = []
+        order = np.argsort(entries[:, 0], kind='mergesort')
+        hashes = entries[order, 0]
+        lib_is = entries[order, 1].astype(np.uint8)
+        del entries
+
+        # keep one entry per hash (a read name may repeat), flagging hashes whose replicates differ
+        first_mask = np.concatenate(([True], hashes[1:] != hashes[:-1])) if len(hashes) > 0 else np.zeros(0, dtype=bool)
+        group_i = np.cumsum(first_mask) - 1
+        lib_differs = np.zeros(int(first_mask.sum()), dtype=bool)
+        lib_differs[group_i[1:][(lib_is[1:] != lib_is[:-1]) & ~first_mask[1:]]] = True
+        self.hashes = hashes[first_mask]
+        self.lib_is = lib_is[first_mask]
+        self.lib_is[lib_differs] = self.AMBIGUOUS
+
+        with open(path, 'wb') as out_handle:
+            np.savez(out_handle, hashes=self.hashes, lib_is=self.lib_is)
+
+
+    @classmethod
+    def load(cls, path):
+        read_replicates = cls()
+        with np.load(path) as saved:
+            read_replicates.hashes = saved['hashes']
+            read_replicates.lib_is = saved['lib_is']
+        return read_replicates
+
+
+    def replicates_of(self, read_names):
+        '''
+        Returns an int array with the replicate of each of the read names kaiju reported,
+        UNKNOWN for names of no read recorded (or of reads with clashing hashes).  A name
+        is looked up as is first, as kaiju may already have dropped its /1 or /2.
+        '''
+        replicates = self._lookup([read_id_hash(read_name) for read_name in read_names])
+        retry_i = [name_i for name_i in np.flatnonzero(replicates == self.UNKNOWN)
+                   if read_name_key(read_names[name_i]) != read_names[name_i]]
+        if len(retry_i) > 0:
+            replicates[retry_i] = self._lookup([read_id_hash(read_name_key(read_names[name_i])) for name_i in retry_i])
+        return replicates
+
+
+    def _lookup(self, read_hashes):
+        read_hashes = np.array(read_hashes, dtype=np.uint64)
+        replicates = np.full(len(read_hashes), self.UNKNOWN, dtype=np.int64)
+        if len(self.hashes) == 0 or len(read_hashes) == 0:
+            return replicates
+        pos = np.minimum(np.searchsorted(self.hashes, read_hashes), len(self.hashes)-1)
+        found = (self.hashes[pos] == read_hashes) & (self.lib_is[pos] != self.AMBIGUOUS)
+        replicates[found] = self.lib_is[pos[found]]
+        return replicates
@@ -0,0 +1,192 @@
+import os
+import sys
+import time
+import json
+import errno
+import fcntl
+import shutil
+import hashlib
+
+
+class ReadsCache(object):
+    '''
+    On-disk cache of downloaded read library files, keyed by the fully versioned workspace
+    ref (wsid/objid/ver) of the reads object, so re-running on the same libraries (another
+    db_type, other tax levels, ...) doesn't download them again.
+
+        reads_files = cache.fetch(versioned_ref, input_dir, name)  # None on a miss
+        ...
+        cache.store(versioned_ref, {'fwd': fwd_path, 'rev': rev_path})
+
+    Files are hardlinked in and out of the cache where possible (copied otherwise) and
+    must be treated as read-only.  Each entry records the size and a sampled digest of
+    its files, checked on every hit; entries that fail the check are dropped.  The least
+    recently used entries are evicted to keep the cache under max_bytes.  The manifest
+    is guarded by a lock file, so a cache dir can be shared between jobs.
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.lock_path = os.path.join(cache_dir, 'manifest.lock')
+        self.digest_sample_bytes = 1024*1024
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+
+    def fetch(self, versioned_ref, input_dir, name):
+        '''
+        Link the cached files of a library into input_dir as <name>.<direction>.download
+        Returns {'fwd': <path>, 'rev': <path>} ('rev' only for PE), or None if not cached
+        '''
+        with self._locked():
+            manifest = self._read_manifest()
+            entry = manifest.get(versioned_ref)
+            if entry is None:
+                return None
+
+            entry_dir = self._entry_dir(versioned_ref)
+            for (direction, file_info) in entry['files'].items():
+                cached_path = os.path.join(entry_dir, file_info['name'])
+                if not os.path.isfile(cached_path) \
+                   or os.path.getsize(cached_path) != file_info['size'] \
+                   or self._sampled_digest(cached_path) != file_info['digest']:
+                    self._log("reads cache entry for "+versioned_ref+" failed its integrity check.  Dropping it.")
+                    self._remove_entry(manifest, versioned_ref)
+                    self._write_manifest(manifest)
+                    return None
+
+            reads_files = dict()
+            for (direction, file_info) in entry['files'].items():
+                download_path = os.path.join(input_dir, name + '.' + direction + '.download')
+                self._link_or_copy(os.path.join(entry_dir, file_info['name']), download_path)
+                reads_files[direction] = download_path
+
+            entry['last_used'] = time.time()
+            self._write_manifest(manifest)
+
+        self._log("reads cache hit for "+versioned_ref+" ("+name+")")
+        return reads_files
+
+
+    def store(self, versioned_ref, reads_files):
+        '''
+        Add the files of a library ({'fwd': <path>, 'rev': <path>}) to the cache, evicting
+        least recently used entries to make room.  Libraries larger than the cache are skipped.
+        '''
+        entry_bytes = sum([os.path.getsize(reads_files[direction]) for direction in reads_files])
+        if entry_bytes > self.max_bytes:
+            return
+
+        with self._locked():
+            manifest = self._read_manifest()
+            if versioned_ref in manifest:
+                self._remove_entry(manifest, versioned_ref)
+
+            cached_bytes = sum([manifest[ref]['bytes'] for ref in manifest])
+            for ref in sorted(manifest.keys(), key=lambda ref: manifest[ref]['last_used']):
+                if cached_bytes + entry_bytes <= self.max_bytes:
+                    break
+                self._log("evicting "+ref+" from reads cache")
+                cached_bytes -= manifest[ref]['bytes']
+                self._remove_entry(manifest, ref)
+
+            # built in a temp dir and moved into place, replacing anything left by a run that died part way
+            entry_dir = self._entry_dir(versioned_ref)
+            tmp_entry_dir = entry_dir + '.tmp'
+            shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+            os.makedirs(tmp_entry_dir)
+            entry = {'files': dict(), 'bytes': entry_bytes, 'last_used': time.time()}
+            for direction in reads_files:
+                file_name = direction + '.' + os.path.basename(reads_files[direction])
+                self._link_or_copy(reads_files[direction], os.path.join(tmp_entry_dir, file_name))
+                entry['files'][direction] = {'name':   file_name,
+                                             'size':   os.path.getsize(reads_files[direction]),
+                                             'digest': self._sampled_digest(reads_files[direction])
+                                             }
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_entry_dir, entry_dir)
+            manifest[versioned_ref] = entry
+            self._write_manifest(manifest)
+
+
+    def _entry_dir(self, versioned_ref):
+        return os.path.join(self.cache_dir, versioned_ref.replace('/', '_'))
+
+
+    def _remove_entry(self, manifest, versioned_ref):
+        manifest.pop(versioned_ref, None)
+        shutil.rmtree(self._entry_dir(versioned_ref), ignore_errors=True)
+
+
+    def _sampled_digest(self, path):
+        '''
+        md5 of the size plus the first, middle and last digest_sample_bytes of a file
+        '''
+        file_size = os.path.getsize(path)
+        digest = hashlib.md5(str(file_size).encode('utf-8'))
+        with open(path, 'rb') as file_handle:
+            for offset in [0, file_size // 2, file_size - self.digest_sample_bytes]:
+                file_handle.seek(max(0, offset))
+                digest.update(file_handle.read(self.digest_sample_bytes))
+        return digest.hexdigest()
+
+
+    def _link_or_copy(self, src_path, dst_path):
+        try:
+            os.link(src_path, dst_path)
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                raise
+            shutil.copyfile(src_path, dst_path)
+
+
+    def _read_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return dict()
+        try:
+            with open(self.manifest_path, 'r') as manifest_handle:
+                return json.load(manifest_handle)
+        except ValueError:
+            self._log("reads cache manifest unreadable.  Starting over.")
+            for entry_name in os.listdir(self.cache_dir):
+                entry_path = os.path.join(self.cache_dir, entry_name)
+                if os.path.isdir(entry_path):
+                    shutil.rmtree(entry_path, ignore_errors=True)
+            return dict()
+
+
+    def _write_manifest(self, manifest):
+        tmp_manifest_path = self.manifest_path + '.tmp'
+        with open(tmp_manifest_path, 'w') as manifest_handle:
+            json.dump(manifest, manifest_handle, indent=1, sort_keys=True)
+        os.rename(tmp_manifest_path, self.manifest_path)
+
+
+    def _locked(self):
+        return _FileLock(self.lock_path)
+
+
+    def _log(self, message):
+        print('{0:.2f}'.format(time.time()) + ': ' + str(message))
+        sys.stdout.flush()
+
+
+class _FileLock(object):
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._lock_handle = None
+
+
+    def __enter__(self):
+        self._lock_handle = open(self.lock_path, 'a')
+        fcntl.flock(self._lock_handle, fcntl.LOCK_EX)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        fcntl.flock(self._lock_handle, fcntl.LOCK_UN)
+        self._lock_handle.close()
+        return False
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import threading
+
+
+class StagingScheduler(object):
+    '''
+    Admits read libraries for staging only when their estimated scratch footprint fits
+    in the free space of the scratch filesystem, so a long ReadsSet can be downloaded
+    ahead of kaiju without running the disk out of space partway through.
+
+    Each admitted library holds a reservation for the part of its footprint that is not
+    on disk yet.  While a library is being staged that is everything (downloaded reads,
+    subsample replicates and kaiju output); once it is staged the reads are already
+    counted by statvfs and only the kaiju output is still held back.
+
+        scheduler = StagingScheduler(scratch, headroom_bytes)
+        if scheduler.admit(key, name, estimate):
+            ... stage ...
+            scheduler.staged(key, staged_bytes)
+            ... classify ...
+            scheduler.release(key)
+
+    estimate is {'staging_bytes': N, 'output_bytes': N}, or None if it couldn't be worked
+    out, in which case the largest footprint staged so far stands in for it.
+    '''
+
+    def __init__(self, scratch, headroom_bytes=0, wait_secs=60):
+        self.scratch = scratch
+        self.headroom_bytes = headroom_bytes
+        self.wait_secs = wait_secs
+        self.max_staged_bytes = 0
+        self.waiting = False  # admit() is blocked for lack of space
+        self._pending = dict()
+        self._output_bytes = dict()
+        self._closed = False
+        self._cond = threading.Condition()
+
+
+    def free_bytes(self):
+        scratch_stat = os.statvfs(self.scratch)
+        return scratch_stat.f_bavail * scratch_stat.f_frsize
+
+
+    def admit(self, key, name, estimate):
+        '''
+        Blocks until the library fits (or nothing else is admitted).  Returns False if the
+        scheduler was closed while waiting.
+        '''
+        if estimate is None:
+            staging_bytes = self.max_staged_bytes
+            output_bytes = 0
+        else:
+            staging_bytes = estimate['staging_bytes']
+            output_bytes = estimate['output_bytes']
+        needed_bytes = staging_bytes + output_bytes + self.headroom_bytes
+
+        with self._cond:
+            while not self._closed:
+                available_bytes = self.free_bytes() - sum(self._pending.values())
+                if available_bytes >= needed_bytes:
+                    break
+                if not self._pending:
+                    self._log("WARNING: "+name+" needs an estimated "+self._gb(needed_bytes)+" of scratch but only "+self._gb(available_bytes)+" is free.  Staging it anyway.")
+                    break
+                self._log("waiting for scratch space to stage "+name+" (needs "+self._gb(needed_bytes)+", "+self._gb(available_bytes)+" available)")
+                self.waiting = True
+                self._cond.wait(self.wait_secs)
+                self.waiting = False
+            if self._closed:
+                return False
+
+            self._pending[key] = staging_bytes + output_bytes
+            self._output_bytes[key] = output_bytes
+            return True
+
+
+    def staged(self, key, staged_bytes):
+        '''
+        The library's reads are on disk (staged_bytes at their peak); only its kaiju output is still to come
+        '''
+        with self._cond:
+            self.max_staged_bytes = max(self.max_staged_bytes, staged_bytes)
+            self._pending[key] = self._output_bytes[key]
+            self._cond.notify_all()
+
+
+    def release(self, key):
+        with self._cond:
+            self._pending.pop(key, None)
+            self._output_bytes.pop(key, None)
+            self._cond.notify_all()
+
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+    def _gb(self, n_bytes):
+        return '{0:.2f}'.format(float(n_bytes) / (1024**3)) + ' GB'
+
+
+    def _log(self, message):
+        print('{0:.2f}'.format(time.time()) + ': ' + str(message))
+        sys.stdout.flush()
@@ -0,0 +1,113 @@
+import sys
+import time
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+
+class TaskGraph(object):
+    '''
+    Runs the steps of a pipeline as soon as the steps they take their inputs from are
+    done, on a pool of worker threads, rather than one after the other.
+
+        graph = TaskGraph(workers)
+        graph.add('classify', classify)
+        graph.add('report', write_report, inputs=['classify'])
+        outputs = graph.run()   # {task name: return value}
+
+    A task's function is called with the return values of its inputs, in order.  Tasks
+    may add more tasks while the graph runs (e.g. one per sample once it is classified);
+    a task waits for inputs that haven't been added yet.  main_thread tasks run in the
+    thread that called run() (matplotlib isn't thread safe).  After a failure no more
+    tasks are started, and the first error is raised once the running ones finish.
+    '''
+
+    def __init__(self, workers):
+        self.workers = max(1, int(workers))
+        self._tasks = dict()
+        self._pending = []  # task names, in the order added
+        self._running = set()
+        self._outputs = dict()
+        self._errors = []
+        self._cond = threading.Condition()
+
+
+    def add(self, name, func, inputs=None, main_thread=False):
+        with self._cond:
+            if name in self._tasks:
+                raise ValueError ("task '"+name+"' is already in the task graph")
+            self._tasks[name] = {'func':        func,
+                                 'inputs':      list(inputs or []),
+                                 'main_thread': main_thread
+                                 }
+            self._pending.append(name)
+            self._cond.notify_all()
+
+
+    def run(self):
+        pool = ThreadPool(self.workers)
+        main_thread_ready = []
+        try:
+            self._cond.acquire()
+            try:
+                while True:
+                    if not self._errors:
+                        for name in list(self._pending):
+                            if all([input_name in self._outputs for input_name in self._tasks[name]['inputs']]):
+                                self._pending.remove(name)
+                                self._running.add(name)
+                                if self._tasks[name]['main_thread']:
+                                    main_thread_ready.append(name)
+                                else:
+                                    pool.apply_async(self._run_task, (name,))
+                    if self._errors:
+                        for name in main_thread_ready:
+                            self._running.discard(name)
+                        main_thread_ready = []
+                    if len(main_thread_ready) > 0:
+                        self._cond.release()
+                        try:
+                            self._run_task(main_thread_ready.pop(0))
+                        finally:
+                            self._cond.acquire()
+                        continue
+                    if len(self._running) == 0:
+                        if self._errors or len(self._pending) == 0:
+                            break
+                        raise ValueError ("task graph can't finish, tasks waiting on inputs never added: "+", ".join(self._pending))
+                    self._cond.wait()
+            finally:
+                self._cond.release()
+        finally:
+            pool.close()
+            pool.join()
+
+        if len(self._errors) > 0:
+            raise self._errors[0]
+        return dict(self._outputs)
+
+
+    def _run_task(self, name):
+        task = self._tasks[name]
+        start_time = time.time()
+        try:
+            with self._cond:
+                input_values = [self._outputs[input_name] for input_name in task['inputs']]
+            output = task['func'](*input_values)
+        except Exception as e:
+            self._log("Error running task "+name+":\n"+traceback.format_exc())
+            with self._cond:
+                self._errors.append(e)
+                self._running.discard(name)
+                self._cond.notify_all()
+            return
+        self._log("task "+name+" done in "+'{0:.1f}'.format(time.time()-start_time)+"s")
+        with self._cond:
+            self._outputs[name] = output
+            self._running.discard(name)
+            self._cond.notify_all()
+
+
+    def _log(self, message):
+        print('{0:.2f}'.format(time.time()) + ': ' + str(message))
+        sys.stdout.flush()
@@ -0,0 +1,392 @@
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+KAIJU_DB_ROOT = os.path.join(os.path.sep, 'data', 'kaijudb')
+INDEX_DIR_NAME = 'taxonomy_index'
+INDEX_FORMAT_VERSION = 2
+NO_ID = -1
+VIRUSES_ID = 10239
+LEVEL_LIMIT = 100
+
+# columns of ancestors.npy ('species group' holds the nearest species group or subgroup)
+ANCESTOR_RANKS = ['phylum', 'class', 'order', 'family', 'genus', 'species', 'species group']
+SPECIES_GROUP_RANKS = ['species group', 'species subgroup']
+
+
+class TaxonomyIndex(object):
+    '''
+    The taxonomy (nodes.dmp and names.dmp) of a kaiju DB compiled into NumPy arrays,
+    indexed by taxid, and opened memory-mapped, so a job loads it in milliseconds and
+    jobs on the same node share its pages:
+
+        parents.npy    int32, parent taxid (NO_ID where there is no node)
+        ranks.npy      int16, index into meta.json 'ranks' (NO_ID where there is no node)
+        name_offs.npy  int64, scientific name of taxid i is names[name_offs[i]:name_offs[i+1]]
+        names.npy      uint8, utf-8 names blob
+        ancestors.npy  int32, [taxid, i] is the taxid itself or its nearest ancestor at rank
+                       ANCESTOR_RANKS[i] (NO_ID if none), so a rollup to a rank is a gather
+        viral.npy      bool, whether Viruses (10239) is in the lineage of the taxid
+        meta.json      format version, rank names, and size and mtime of the .dmp files
+
+    The index is built once (scripts/build_taxonomy_index.py, run by the module init) into
+    <db_dir>/taxonomy_index.  If it isn't there or is out of date with the .dmp files,
+    load() builds it there, or in scratch if the DB dir is read-only.
+
+        taxonomy = TaxonomyIndex.load(db_dir, scratch)
+        taxonomy.parents[taxid], taxonomy.rank_of(taxid), taxonomy.name(taxid)
+        (genus_ids, genus_cnts, unassigned_cnt) = taxonomy.rollup(taxids, cnts, 'genus')
+    '''
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as meta_handle:
+            self.meta = json.load(meta_handle)
+        self.rank_names = [str(rank_name) for rank_name in self.meta['ranks']]
+        self.parents = np.load(os.path.join(index_dir, 'parents.npy'), mmap_mode='r')
+        self.ranks = np.load(os.path.join(index_dir, 'ranks.npy'), mmap_mode='r')
+        self.name_offs = np.load(os.path.join(index_dir, 'name_offs.npy'), mmap_mode='r')
+        self.names = np.load(os.path.join(index_dir, 'names.npy'), mmap_mode='r')
+        self.ancestors = np.load(os.path.join(index_dir, 'ancestors.npy'), mmap_mode='r')
+        self.viral = np.load(os.path.join(index_dir, 'viral.npy'), mmap_mode='r')
+        self.largest_id = len(self.parents) - 1
+        self.n_bytes = sum([os.path.getsize(os.path.join(index_dir, index_file)) for index_file in os.listdir(index_dir)])
+
+
+    @classmethod
+    def load(cls, db_dir, scratch=None):
+        '''
+        Open the index of the DB in db_dir, building it first if need be
+        '''
+        index_dirs = [os.path.join(db_dir, INDEX_DIR_NAME)]
+        if scratch is not None:
+            index_dirs.append(os.path.join(scratch, INDEX_DIR_NAME, os.path.basename(os.path.normpath(db_dir))))
+
+        for index_dir in index_dirs:
+            if is_current(index_dir, db_dir):
+                return cls(index_dir)
+
+        for index_dir in index_dirs:
+            try:
+                build_taxonomy_index(db_dir, index_dir)
+            except (IOError, OSError) as e:
+                _log("unable to build taxonomy index in "+index_dir+": "+str(e))
+                continue
+            return cls(index_dir)
+        raise ValueError ("unable to build a taxonomy index for kaiju DB "+db_dir+" in "+" or ".join(index_dirs))
+
+
+    def rank_of(self, taxid):
+        rank_id = self.ranks[taxid]
+        if rank_id == NO_ID:
+            return None
+        return self.rank_names[rank_id]
+
+
+    def has_node(self, taxid):
+        return 0 <= taxid <= self.largest_id and self.parents[taxid] != NO_ID
+
+
+    def name(self, taxid):
+        if taxid < 0 or taxid > self.largest_id:
+            return None
+        (name_start, name_end) = (self.name_offs[taxid], self.name_offs[taxid+1])
+        if name_start == name_end:
+            return None
+        name = self.names[name_start:name_end].tobytes()
+        if bytes is str:  # py2
+            return name
+        return name.decode('utf-8')
+
+
+    def ancestors_at(self, taxids, tax_level, species_groups=False):
+        '''
+        The taxid itself or its nearest ancestor at tax_level (NO_ID if none), for each taxid.
+        With species_groups, a 'species group' or 'species subgroup' counts as a species.
+        '''
+        if tax_level not in ANCESTOR_RANKS or tax_level == 'species group':
+            raise ValueError ("no ancestor table for tax level '"+str(tax_level)+"', must be one of: "+", ".join(ANCESTOR_RANKS[:-1]))
+        (taxids, in_index) = self._in_index(taxids)
+        ancestor_ids = np.full(len(taxids), NO_ID, dtype=np.int32)
+        level_ancestor_ids = self.ancestors[taxids[in_index], ANCESTOR_RANKS.index(tax_level)]
+        if species_groups and tax_level == 'species':
+            group_ancestor_ids = self.ancestors[taxids[in_index], ANCESTOR_RANKS.index('species group')]
+            level_ancestor_ids = np.where(level_ancestor_ids != NO_ID, level_ancestor_ids, group_ancestor_ids)
+        ancestor_ids[in_index] = level_ancestor_ids
+        return ancestor_ids
+
+
+    def is_viral(self, taxids):
+        (taxids, in_index) = self._in_index(taxids)
+        viral = np.zeros(len(taxids), dtype=bool)
+        viral[in_index] = self.viral[taxids[in_index]]
+        return viral
+
+
+    def rollup(self, taxids, cnts, tax_level, species_groups=False):
+        '''
+        Sum the read counts of taxids by their ancestor at tax_level:
+            (ancestor ids, their counts, count of reads with no ancestor at tax_level)
+        '''
+        cnts = np.asarray(cnts, dtype=np.int64)
+        ancestor_ids = self.ancestors_at(taxids, tax_level, species_groups)
+        assigned = (ancestor_ids != NO_ID)
+        (level_ids, level_i) = np.unique(ancestor_ids[assigned], return_inverse=True)
+        level_cnts = np.bincount(level_i, weights=cnts[assigned], minlength=len(level_ids)).astype(np.int64)
+        return (level_ids, level_cnts, int(cnts[~assigned].sum()))
+
+
+    def _in_index(self, taxids):
+        taxids = np.asarray(taxids, dtype=np.int64).reshape(-1)
+        return (taxids, (taxids >= 0) & (taxids <= self.largest_id))
+
+
+class TaxonomyRegistry(object):
+    '''
+    The TaxonomyIndex of each kaiju DB opened so far in this process, shared by every
+    request (and thread) of a long running server, so each DB is opened once rather
+    than once per OutputBuilder.
+
+        taxonomy = get_taxonomy(db_type, scratch)   # the module's registry
+        taxonomy_registry_stats()                   # {'hits': ..., 'misses': ..., ...}
+
+    Indexes are opened on first use.  When their total size is over max_bytes, the least
+    recently used are dropped (the one just asked for is always kept); callers still
+    holding one can keep using it.  An index is reopened if the DB's .dmp files change.
+    '''
+
+    def __init__(self, max_bytes=4*1024**3, db_root=KAIJU_DB_ROOT):
+        self.max_bytes = max_bytes
+        self.db_root = db_root
+        self._taxonomies = OrderedDict()  # db_type -> TaxonomyIndex, least recently used first
+        self._load_locks = dict()         # db_type -> lock held while it is being opened
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'reloads': 0}
+
+
+    def get(self, db_type, scratch=None):
+        db_dir = os.path.join(self.db_root, db_type)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(db_type, threading.Lock())
+        with load_lock:  # opening one DB doesn't hold up requests for the others
+            with self._lock:
+                taxonomy = self._taxonomies.get(db_type)
+            if taxonomy is not None and not is_current(taxonomy.index_dir, db_dir):
+                _log("kaiju DB "+db_type+" changed, reopening its taxonomy index")
+                with self._lock:
+                    self._stats['reloads'] += 1
+                taxonomy = None
+            if taxonomy is None:
+                taxonomy = TaxonomyIndex.load(db_dir, scratch)
+                with self._lock:
+                    self._stats['misses'] += 1
+                    self._taxonomies[db_type] = taxonomy
+                    self._evict(keep_db_type=db_type)
+                return taxonomy
+            with self._lock:
+                self._stats['hits'] += 1
+                if db_type in self._taxonomies:  # move to the most recently used end
+                    self._taxonomies[db_type] = self._taxonomies.pop(db_type)
+            return taxonomy
+
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['db_types'] = list(self._taxonomies.keys())
+            stats['bytes'] = sum([taxonomy.n_bytes for taxonomy in self._taxonomies.values()])
+        return stats
+
+
+    def clear(self):
+        with self._lock:
+            self._taxonomies.clear()
+
+
+    def _evict(self, keep_db_type=None):
+        total_bytes = sum([taxonomy.n_bytes for taxonomy in self._taxonomies.values()])
+        for db_type in list(self._taxonomies.keys()):
+            if total_bytes <= self.max_bytes:
+                break
+            if db_type == keep_db_type:
+                continue
+            total_bytes -= self._taxonomies.pop(db_type).n_bytes
+            self._stats['evictions'] += 1
+            _log("taxonomy registry: dropped "+db_type+" to stay under "+'{0:.2f}'.format(float(self.max_bytes) / 1024**3)+" GB")
+
+
+_registry = TaxonomyRegistry()
+
+
+def get_taxonomy(db_type, scratch=None):
+    '''
+    TaxonomyIndex of the kaiju DB /data/kaijudb/<db_type>, from the process wide registry
+    '''
+    return _registry.get(db_type, scratch)
+
+
+def set_taxonomy_registry_max_bytes(max_bytes):
+    _registry.set_max_bytes(max_bytes)
+
+
+def taxonomy_registry_stats():
+    return _registry.stats()
+
+
+def is_current(index_dir, db_dir):
+    '''
+    Whether index_dir holds an index of this format built from the .dmp files now in db_dir
+    '''
+    meta_path = os.path.join(index_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return False
+    try:
+        with open(meta_path, 'r') as meta_handle:
+            meta = json.load(meta_handle)
+    except ValueError:
+        return False
+    return meta.get('version') == INDEX_FORMAT_VERSION and meta.get('sources') == _dmp_stats(db_dir)
+
+
+def build_taxonomy_index(db_dir, index_dir):
+    '''
+    Parse nodes.dmp and names.dmp of the kaiju DB in db_dir into an index in index_dir
+    '''
+    start_time = time.time()
+    nodes_path = os.path.join(db_dir, 'nodes.dmp')
+    names_path = os.path.join(db_dir, 'names.dmp')
+    sources = _dmp_stats(db_dir)
+
+    # nodes
+    node_ids = []
+    par_ids = []
+    rank_ids = []
+    rank_names = []
+    rank_name2id = dict()
+    with open(nodes_path, 'r') as nodes_handle:
+        for nodes_line in nodes_handle:
+            nodes_line_info = nodes_line.split("\t|")
+            rank_name = nodes_line_info[2].strip()
+            if rank_name not in rank_name2id:
+                rank_name2id[rank_name] = len(rank_names)
+                rank_names.append(rank_name)
+            node_ids.append(int(nodes_line_info[0]))
+            par_ids.append(int(nodes_line_info[1]))
+            rank_ids.append(rank_name2id[rank_name])
+
+    # scientific names
+    name_ids = []
+    name_strs = []
+    with open(names_path, 'rb') as names_handle:
+        for names_line in names_handle:
+            names_line_info = names_line.split(b"\t|")
+            if names_line_info[3].strip() != b'scientific name':
+                continue
+            name_ids.append(int(names_line_info[0]))
+            name_strs.append(names_line_info[1].strip())
+
+    largest_id = max(max(node_ids or [0]), max(name_ids or [0]))
+    parents = np.full(largest_id+1, NO_ID, dtype=np.int32)
+    ranks = np.full(largest_id+1, NO_ID, dtype=np.int16)
+    parents[node_ids] = par_ids
+    ranks[node_ids] = rank_ids
+
+    name_lens = np.zeros(largest_id+1, dtype=np.int64)
+    name_lens[name_ids] = [len(name_str) for name_str in name_strs]
+    name_offs = np.zeros(largest_id+2, dtype=np.int64)
+    np.cumsum(name_lens, out=name_offs[1:])
+    names = np.zeros(int(name_offs[-1]), dtype=np.uint8)
+    for (name_id, name_str) in zip(name_ids, name_strs):
+        names[name_offs[name_id]:name_offs[name_id+1]] = np.frombuffer(name_str, dtype=np.uint8)
+
+    (ancestors, viral) = _build_ancestors(parents, ranks, rank_names)
+
+    # write to a temp dir beside index_dir, then move it into place
+    index_parent_dir = os.path.dirname(os.path.normpath(index_dir))
+    if not os.path.exists(index_parent_dir):
+        os.makedirs(index_parent_dir)
+    tmp_index_dir = tempfile.mkdtemp(prefix='.'+os.path.basename(os.path.normpath(index_dir))+'.', dir=index_parent_dir)
+    try:
+        np.save(os.path.join(tmp_index_dir, 'parents.npy'), parents)
+        np.save(os.path.join(tmp_index_dir, 'ranks.npy'), ranks)
+        np.save(os.path.join(tmp_index_dir, 'name_offs.npy'), name_offs)
+        np.save(os.path.join(tmp_index_dir, 'names.npy'), names)
+        np.save(os.path.join(tmp_index_dir, 'ancestors.npy'), ancestors)
+        np.save(os.path.join(tmp_index_dir, 'viral.npy'), viral)
+        with open(os.path.join(tmp_index_dir, 'meta.json'), 'w') as meta_handle:
+            json.dump({'version': INDEX_FORMAT_VERSION,
+                       'ranks':   rank_names,
+                       'sources': sources
+                       }, meta_handle, indent=1, sort_keys=True)
+        os.chmod(tmp_index_dir, 0o755)
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir, ignore_errors=True)
+        os.rename(tmp_index_dir, index_dir)
+    except (IOError, OSError):
+        shutil.rmtree(tmp_index_dir, ignore_errors=True)
+        if is_current(index_dir, db_dir):  # another job built it meanwhile
+            return index_dir
+        raise
+
+    _log("built taxonomy index "+index_dir+" ("+str(len(node_ids))+" nodes) in "+'{0:.1f}'.format(time.time()-start_time)+"s")
+    return index_dir
+
+
+def _build_ancestors(parents, ranks, rank_names):
+    '''
+    Walk up from every node at once, one level per pass, recording the first node seen
+    at each of ANCESTOR_RANKS and whether Viruses was passed
+    '''
+    rank_cols = np.full(len(rank_names)+1, NO_ID, dtype=np.int16)  # last entry is for NO_ID ranks
+    for rank_id,rank_name in enumerate(rank_names):
+        if rank_name in SPECIES_GROUP_RANKS:
+            rank_cols[rank_id] = ANCESTOR_RANKS.index('species group')
+        elif rank_name in ANCESTOR_RANKS:
+            rank_cols[rank_id] = ANCESTOR_RANKS.index(rank_name)
+
+    n_ids = len(parents)
+    ancestors = np.full((n_ids, len(ANCESTOR_RANKS)), NO_ID, dtype=np.int32)
+    viral = np.zeros(n_ids, dtype=bool)
+    walk_ids = np.nonzero(parents != NO_ID)[0]  # taxid each walk started from
+    at_ids = walk_ids.copy()                    # where each walk is now
+    level_lim_i = 0
+    while len(walk_ids) > 0 and level_lim_i < LEVEL_LIMIT:
+        level_lim_i += 1
+        viral[walk_ids[at_ids == VIRUSES_ID]] = True
+        cols = rank_cols[ranks[at_ids]]
+        at_rank = (cols != NO_ID)
+        (rows, cols, found_ids) = (walk_ids[at_rank], cols[at_rank], at_ids[at_rank])
+        first_found = (ancestors[rows, cols] == NO_ID)
+        ancestors[rows[first_found], cols[first_found]] = found_ids[first_found]
+
+        par_ids = parents[at_ids]
+        going_up = (par_ids != at_ids) & (par_ids >= 0) & (par_ids < n_ids)
+        (walk_ids, at_ids) = (walk_ids[going_up], par_ids[going_up])
+    return (ancestors, viral)
+
+
+def _dmp_stats(db_dir):
+    stats = dict()
+    for dmp_file in ['nodes.dmp', 'names.dmp']:
+        dmp_stat = os.stat(os.path.join(db_dir, dmp_file))
+        stats[dmp_file] = [dmp_stat.st_size, int(dmp_stat.st_mtime)]
+    return stats
+
+
+def _log(message):
+    print('{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
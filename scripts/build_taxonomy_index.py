@@ -0,0 +1,24 @@
+'''
+Compile the taxonomy (nodes.dmp and names.dmp) of kaiju DBs into the memory-mapped
+index OutputBuilder loads (see lib/kb_kaiju/Utils/TaxonomyIndex.py).  Run by the
+module init once the DBs are downloaded.
+
+    python scripts/build_taxonomy_index.py /data/kaijudb/refseq [/data/kaijudb/nr ...]
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from kb_kaiju.Utils.TaxonomyIndex import INDEX_DIR_NAME, build_taxonomy_index, is_current  # noqa: E402
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python ' + sys.argv[0] + ' <kaiju db dir> [<kaiju db dir> ...]')
+        sys.exit(1)
+    for db_dir in sys.argv[1:]:
+        index_dir = os.path.join(db_dir, INDEX_DIR_NAME)
+        if is_current(index_dir, db_dir):
+            print(index_dir + ' is up to date')
+            continue
+        build_taxonomy_index(db_dir, index_dir)
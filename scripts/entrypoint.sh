@@ -57,9 +57,12 @@ elif [ "${1}" = "init" ] ; then
   mv nodes.dmp nr_euk/nodes.dmp
   rm kaiju_db_nr_euk_2019-06-25.tgz
 
+  echo "building taxonomy indexes"
+  python /kb/module/scripts/build_taxonomy_index.py /data/kaijudb/refseq /data/kaijudb/progenomes /data/kaijudb/nr /data/kaijudb/nr_euk
+
   cd /data/kaijudb
 
-  if [ -s "/data/kaijudb/refseq/kaiju_db_refseq.fmi" -a -s "/data/kaijudb/progenomes/kaiju_db_progenomes.fmi" -a -s "/data/kaijudb/nr/kaiju_db_nr.fmi" -a -s "/data/kaijudb/nr_euk/kaiju_db_nr_euk.fmi" ] ; then
+  if [ -s "/data/kaijudb/refseq/kaiju_db_refseq.fmi" -a -s "/data/kaijudb/progenomes/kaiju_db_progenomes.fmi" -a -s "/data/kaijudb/nr/kaiju_db_nr.fmi" -a -s "/data/kaijudb/nr_euk/kaiju_db_nr_euk.fmi" -a -s "/data/kaijudb/refseq/taxonomy_index/meta.json" -a -s "/data/kaijudb/progenomes/taxonomy_index/meta.json" -a -s "/data/kaijudb/nr/taxonomy_index/meta.json" -a -s "/data/kaijudb/nr_euk/taxonomy_index/meta.json" ] ; then
     echo "DATA DOWNLOADED SUCCESSFULLY"
     touch /data/__READY__
   else
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''
+Throughput of FastqReader vs. the unbuffered, line-at-a-time FASTQ parsing
+that DataStagingUtils used before it.
+
+    python test/benchmarks/fastq_reader_benchmark.py [n_reads]
+
+Run it with the module's Python 2.7: Python 2 file iteration reads ahead in
+its own buffer, so the old loop is only slow (by ~60x) on Python 3.
+'''
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lib'))
+from kb_kaiju.Utils.FastqReader import FastqReader  # noqa: E402
+
+
+def write_fastq(path, n_reads, read_len=150):
+    bases = 'ACGT'
+    random.seed(1)
+    seq = ''.join(random.choice(bases) for i in range(read_len))
+    qual = 'F' * read_len
+    with open(path, 'w') as out_handle:
+        for read_i in range(n_reads):
+            out_handle.write('@SRR5891520.'+str(read_i)+'.1 HISEQ:1:1101:'+str(read_i)+' 1:N:0:TCGGCA\n')
+            out_handle.write(seq+'\n+\n'+qual+'\n')
+
+
+def legacy_parse(path):
+    n_recs = 0
+    with open(path, 'rb', 0) as input_reads_file_handle:
+        rec_line_i = -1
+        for line in input_reads_file_handle:
+            rec_line_i += 1
+            if rec_line_i == 3:
+                rec_line_i = -1
+            elif rec_line_i == 0:
+                if not line.startswith(b'@'):
+                    raise ValueError("badly formatted rec line")
+                read_id = line.rstrip(b'\n')
+                read_id = re.sub(b"[ \t]+.*$", b"", read_id)
+                read_id = b''.join(read_id.rsplit(b'.', 1))
+                read_id = re.sub(br"[\/\.\_\-\:\;][012lrLRfrFR53]\'*$", b"", read_id)
+                n_recs += 1
+    return n_recs
+
+
+def reader_parse(path):
+    n_recs = 0
+    for (read_id, rec) in FastqReader(path):
+        n_recs += 1
+    return n_recs
+
+
+def main():
+    n_reads = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    fastq_path = os.path.join(tempfile.mkdtemp(), 'bench.fastq')
+    write_fastq(fastq_path, n_reads)
+    size_mb = os.path.getsize(fastq_path) / 1048576.0
+    print('Python '+sys.version.split()[0])
+    print('FASTQ: '+str(n_reads)+' reads, '+'{0:.1f}'.format(size_mb)+' MB')
+
+    for (label, parse) in [('legacy', legacy_parse), ('FastqReader', reader_parse)]:
+        start = time.time()
+        n_recs = parse(fastq_path)
+        elapsed = time.time() - start
+        print('{0:12s} {1:8.2f} s  {2:10.0f} reads/s  {3:7.1f} MB/s'.format(label, elapsed, n_recs / elapsed, size_mb / elapsed))
+
+    os.remove(fastq_path)
+    os.rmdir(os.path.dirname(fastq_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+'''
+Throughput of count_kaiju_classifications() vs. the line-at-a-time parsing of
+kaiju classification files that OutputBuilder used before it, and the peak RSS
+of each (each runs in its own process).
+
+    python test/benchmarks/kaiju_output_reader_benchmark.py [n_lines]
+'''
+import os
+import sys
+import time
+import resource
+import subprocess
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lib'))
+from kb_kaiju.Utils.KaijuOutputReader import count_kaiju_classifications  # noqa: E402
+
+
+N_IDS = 2000000
+
+
+def write_kaiju_output(path, n_lines, lines_per_write=1000000):
+    random_state = np.random.RandomState(1)
+    with open(path, 'wb') as out_handle:
+        for line_i in range(0, n_lines, lines_per_write):
+            n = min(lines_per_write, n_lines - line_i)
+            taxids = random_state.randint(1, N_IDS, size=n)
+            unclassified = (random_state.random_sample(n) < 0.2)
+            lines = []
+            for (read_i, taxid, is_unclassified) in zip(range(line_i, line_i+n), taxids, unclassified):
+                if is_unclassified:
+                    lines.append('U\tSRR5891520.'+str(read_i)+'\t0')
+                else:
+                    lines.append('C\tSRR5891520.'+str(read_i)+'\t'+str(taxid))
+            out_handle.write(('\n'.join(lines)+'\n').encode('utf-8'))
+
+
+def legacy_count(path):
+    species_abundance_cnts = []
+    for node_i in range(N_IDS):
+        species_abundance_cnts.append(0)
+    unclassified_cnt = 0
+    with open(path, 'r') as class_handle:
+        for class_line in class_handle:
+            class_info = class_line.rstrip().split("\t")
+            if class_info[0] == 'U':
+                unclassified_cnt += 1
+                continue
+            species_abundance_cnts[int(class_info[2])] += 1
+    return (species_abundance_cnts, unclassified_cnt)
+
+
+def reader_count(path):
+    return count_kaiju_classifications(path, N_IDS)
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # kB on linux
+
+
+def run_count(label, kaiju_path, n_lines, size_mb):
+    count = {'reader': reader_count, 'legacy': legacy_count}[label]
+    start = time.time()
+    (taxid_cnts, unclassified_cnt) = count(kaiju_path)
+    elapsed = time.time() - start
+    print('{0:8s} {1:8.2f} s  {2:10.0f} lines/s  {3:7.1f} MB/s  peak RSS {4:.0f} MB'.format(
+        label, elapsed, n_lines / elapsed, size_mb / elapsed, max_rss_mb()))
+    np.save(kaiju_path+'.'+label+'.npy', np.append(np.asarray(taxid_cnts, dtype=np.int64), unclassified_cnt))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--write':
+        write_kaiju_output(sys.argv[2], int(sys.argv[3]))
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == '--count':
+        (label, kaiju_path, n_lines) = sys.argv[2:5]
+        run_count(label, kaiju_path, int(n_lines), os.path.getsize(kaiju_path) / 1048576.0)
+        return
+
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    kaiju_path = os.path.join(tempfile.mkdtemp(), 'bench.kaiju')
+    # in child processes, as a child starts off with the peak RSS of its parent
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), '--write', kaiju_path, str(n_lines)])
+    print('kaiju output: '+str(n_lines)+' lines, '+'{0:.1f}'.format(os.path.getsize(kaiju_path) / 1048576.0)+' MB')
+
+    for label in ['reader', 'legacy']:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--count', label, kaiju_path, str(n_lines)])
+    results = [np.load(kaiju_path+'.'+label+'.npy') for label in ['reader', 'legacy']]
+    if not np.array_equal(results[0], results[1]):
+        raise ValueError ("counts differ")
+
+    for path in [kaiju_path, kaiju_path+'.reader.npy', kaiju_path+'.legacy.npy']:
+        os.remove(path)
+    os.rmdir(os.path.dirname(kaiju_path))
+
+
+if __name__ == '__main__':
+    main()
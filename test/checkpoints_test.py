@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_kaiju.Utils.Checkpoints import Checkpoints, checkpoint_key
+
+
+class CheckpointsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoints = Checkpoints(os.path.join(self.tmp_dir, 'checkpoints'))
+        self.input_file = self._write('sample.kaiju', 'C\tr1\t562\n')
+        self.output_file = os.path.join(self.tmp_dir, 'sample-genus.kaijuReport')
+        self.runs = []
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write(self, file_name, content):
+        path = os.path.join(self.tmp_dir, file_name)
+        with open(path, 'w') as out_handle:
+            out_handle.write(content)
+        return path
+
+
+    def _report(self):
+        self.runs.append('report')
+        self._write('sample-genus.kaijuReport', 'report of run '+str(len(self.runs)))
+        return {'report_file': self.output_file}
+
+
+    def _run_report(self, params):
+        return self.checkpoints.run('report sample', self.checkpoints.key(params, [self.input_file]),
+                                    self._report, [self.output_file])
+
+
+    def test_completed_stage_skipped(self):
+        self.assertEqual(self._run_report({'tax_level': 'genus'}), {'report_file': self.output_file})
+        self.assertEqual(self._run_report({'tax_level': 'genus'}), {'report_file': self.output_file})
+        self.assertEqual(self.runs, ['report'])
+
+        # a new Checkpoints on the same dir, as in a re-run of the job
+        self.checkpoints = Checkpoints(self.checkpoints.checkpoint_dir)
+        self.assertEqual(self._run_report({'tax_level': 'genus'}), {'report_file': self.output_file})
+        self.assertEqual(self.runs, ['report'])
+
+
+    def test_params_change_invalidates(self):
+        self._run_report({'tax_level': 'genus'})
+        self._run_report({'tax_level': 'species'})
+        self.assertEqual(self.runs, ['report', 'report'])
+
+
+    def test_input_change_invalidates(self):
+        self._run_report({'tax_level': 'genus'})
+        self._write('sample.kaiju', 'C\tr1\t562\nC\tr2\t561\n')
+        self._run_report({'tax_level': 'genus'})
+        self.assertEqual(self.runs, ['report', 'report'])
+
+        # same size, but touched
+        input_mtime = os.path.getmtime(self.input_file)
+        os.utime(self.input_file, (input_mtime + 10, input_mtime + 10))
+        self._run_report({'tax_level': 'genus'})
+        self.assertEqual(self.runs, ['report', 'report', 'report'])
+
+
+    def test_output_size_change_invalidates(self):
+        self._run_report({'tax_level': 'genus'})
+        self._write('sample-genus.kaijuReport', 'truncated')
+        self._run_report({'tax_level': 'genus'})
+        self.assertEqual(self.runs, ['report', 'report'])
+
+        os.remove(self.output_file)
+        self._run_report({'tax_level': 'genus'})
+        self.assertEqual(self.runs, ['report', 'report', 'report'])
+
+
+    def test_failed_stage_not_recorded(self):
+        def fail():
+            raise ValueError ("boom")
+        key = self.checkpoints.key({'tax_level': 'genus'}, [self.input_file])
+        with self.assertRaises(ValueError):
+            self.checkpoints.run('report sample', key, fail, [self.output_file])
+        self.assertEqual(self.checkpoints.completed('report sample', key), None)
+
+
+    def test_output_files_of_result(self):
+        key = self.checkpoints.key({'tax_level': 'genus'})
+        self.checkpoints.run('report sample', key, self._report, lambda result: [result['report_file']])
+        manifest = self.checkpoints.completed('report sample', key)
+        self.assertEqual(list(manifest['output_files'].keys()), [self.output_file])
+
+
+    def test_unreadable_manifest(self):
+        key = self.checkpoints.key({'tax_level': 'genus'})
+        self.checkpoints.complete('report sample', key)
+        with open(self.checkpoints._manifest_path('report sample'), 'w') as manifest_handle:
+            manifest_handle.write('{"stage": ')
+        self.assertEqual(self.checkpoints.completed('report sample', key), None)
+
+
+    def test_key(self):
+        self.assertEqual(checkpoint_key({'a': 1, 'b': [2, 3]}), checkpoint_key({'b': [2, 3], 'a': 1}))
+        self.assertNotEqual(checkpoint_key({'a': 1}), checkpoint_key({'a': 2}))
+        missing_file = os.path.join(self.tmp_dir, 'missing.kaiju')
+        self.assertNotEqual(checkpoint_key({}, [missing_file]), checkpoint_key({}, [self.input_file]))
+        self.assertEqual(checkpoint_key({}, [missing_file, self.input_file]), checkpoint_key({}, [self.input_file, missing_file]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+import os
+import bz2
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from kb_kaiju.Utils import DataStagingUtils as data_staging_module
+from kb_kaiju.Utils.DataStagingUtils import DataStagingUtils
+
+
+FASTQ = b''.join([('@read'+str(read_i)+'/1\nACGTACGT\n+\nFFFFFFFF\n').encode('utf-8') for read_i in range(20)])
+FASTA = b''.join([('>read'+str(read_i)+'\nACGTACGT\n').encode('utf-8') for read_i in range(20)])
+
+
+class FakeWorkspace(object):
+    '''
+    Workspace client stand-in holding reads library objects by ref
+    '''
+    objects = dict()
+    info_calls = []
+
+    def __init__(self, url, token=None):
+        pass
+
+
+    def get_objects2(self, params):
+        return {'data': [FakeWorkspace.objects[obj['ref']] for obj in params['objects']]}
+
+
+    def get_object_info3(self, params):
+        FakeWorkspace.info_calls.append([obj['ref'] for obj in params['objects']])
+        return {'infos': [FakeWorkspace.objects[obj['ref']]['info'] for obj in params['objects']]}
+
+
+class FakeSetAPI(object):
+    '''
+    ReadsSets by ref, or the error message getting the set fails with
+    '''
+    def __init__(self):
+        self.sets = dict()
+        self.errors = dict()
+
+
+    def get_reads_set_v1(self, params):
+        if params['ref'] in self.errors:
+            raise Exception (self.errors[params['ref']])
+        return {'data': {'items': self.sets[params['ref']]}}
+
+
+class FakeDataFileUtil(object):
+    '''
+    Shock files by id
+    '''
+    def __init__(self):
+        self.shock_files = dict()
+
+
+    def shock_to_file(self, params):
+        with open(params['file_path'], 'wb') as out_handle:
+            out_handle.write(self.shock_files[params['shock_id']])
+        return {'file_path': params['file_path']}
+
+
+class FakeReadsUtils(object):
+    '''
+    download_reads() writing uncompressed FASTQ, as ReadsUtils does
+    '''
+    def __init__(self, scratch):
+        self.scratch = scratch
+        self.downloaded = []
+
+
+    def download_reads(self, params):
+        files = dict()
+        for ref in params['read_libraries']:
+            self.downloaded.append(ref)
+            fwd_path = os.path.join(self.scratch, 'readsutils_'+ref.replace('/', '_')+'.fwd.fastq')
+            with open(fwd_path, 'wb') as fwd_handle:
+                fwd_handle.write(FASTQ)
+            files[ref] = {'files': {'fwd': fwd_path, 'type': 'single'}}
+        return {'files': files}
+
+
+class DataStagingUtilsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.real_workspace = data_staging_module.Workspace
+        data_staging_module.Workspace = FakeWorkspace
+        FakeWorkspace.objects = dict()
+        FakeWorkspace.info_calls = []
+        self.dsu = DataStagingUtils({'scratch':          os.path.join(self.tmp_dir, 'scratch'),
+                                     'workspace-url':    'https://ws.example/services/ws',
+                                     'srv-wiz-url':      'https://ws.example/services/service_wizard',
+                                     'SDK_CALLBACK_URL': 'http://localhost:9999'},
+                                    {'token': 'token'})
+        self.dsu.dataFileUtil_Client = FakeDataFileUtil()
+        self.dsu.readsUtils_Client = FakeReadsUtils(self.dsu.scratch)
+        self.dsu.setAPI_Client = FakeSetAPI()
+
+
+    def tearDown(self):
+        data_staging_module.Workspace = self.real_workspace
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _info(self, ref, name, type_name):
+        (wsid, objid, version) = ref.split('/')
+        return [int(objid), name, type_name, '', int(version), 'u', int(wsid), 'ws', '', 0, {}]
+
+
+    def _add_set(self, set_ref, member_refs):
+        FakeWorkspace.objects[set_ref] = {'info': self._info(set_ref, 'set_'+set_ref.replace('/', '_'), 'KBaseSets.ReadsSet-2.0')}
+        self.dsu.setAPI_Client.sets[set_ref] = [{'ref': ref, 'info': FakeWorkspace.objects[ref]['info']} for ref in member_refs]
+
+
+    def test_expand_input(self):
+        FakeWorkspace.objects['1/1/1'] = {'info': self._info('1/1/1', 'se', 'KBaseFile.SingleEndLibrary-2.2')}
+        FakeWorkspace.objects['1/2/3'] = {'info': self._info('1/2/3', 'pe', 'KBaseFile.PairedEndLibrary-2.0')}
+        FakeWorkspace.objects['1/3/1'] = {'info': self._info('1/3/1', 'pe2', 'KBaseAssembly.PairedEndLibrary-1.0')}
+        self._add_set('1/10/1', ['1/3/1', '1/1/1'])
+        self._add_set('1/11/1', ['1/2/3'])
+        input_refs = ['1/1/1', '1/10/1', '1/2/3', '1/11/1', '1/1/1']
+
+        expanded_input = self.dsu.expand_input(input_refs)
+        self.assertEqual(FakeWorkspace.info_calls, [input_refs])  # one call for all of them
+        self.assertEqual([(item['ref'], item['name'], item['type']) for item in expanded_input],
+                         [('1/1/1', 'se', 'SE'), ('1/3/1', 'pe2', 'PE'), ('1/2/3', 'pe', 'PE')])
+
+
+    def test_expand_input_set_errors(self):
+        FakeWorkspace.objects['1/1/1'] = {'info': self._info('1/1/1', 'se', 'KBaseFile.SingleEndLibrary-2.2')}
+        for set_ref in ['1/10/1', '1/11/1', '1/12/1']:
+            self._add_set(set_ref, ['1/1/1'])
+        self.dsu.setAPI_Client.errors = {'1/11/1': 'no access to 1/11/1', '1/12/1': 'no access to 1/12/1'}
+        with self.assertRaises(ValueError) as context:
+            self.dsu.expand_input(['1/12/1', '1/10/1', '1/11/1'])
+        self.assertIn('Unable to get read library set object from workspace: (1/12/1)', str(context.exception))
+        self.assertIn('no access to 1/12/1', str(context.exception))
+
+        FakeWorkspace.objects['1/4/1'] = {'info': self._info('1/4/1', 'genome', 'KBaseGenomes.Genome-8.2')}
+        with self.assertRaises(ValueError) as context:
+            self.dsu.expand_input(['1/10/1', '1/4/1'])
+        self.assertIn("is of type: 'KBaseGenomes.Genome'", str(context.exception))
+
+
+    def _add_se_library(self, ref, stored_content):
+        shock_id = 'shock_'+ref.replace('/', '_')
+        self.dsu.dataFileUtil_Client.shock_files[shock_id] = stored_content
+        FakeWorkspace.objects[ref] = {'info': [1, 'lib', 'KBaseFile.SingleEndLibrary-2.2', '', 1, 'u', 1, 'ws', '', 0, {}],
+                                      'data': {'lib': {'file': {'id': shock_id}}}}
+
+
+    def _stage(self, ref, subsample_percent=100):
+        return self.dsu.stage_input(input_item={'ref': ref, 'name': 'lib_'+ref.replace('/', '_'), 'type': 'SE'},
+                                    subsample_percent=subsample_percent,
+                                    subsample_replicates=1,
+                                    subsample_seed=1)
+
+
+    def test_stored_compression_kept(self):
+        self._add_se_library('1/1/1', self._gzip(FASTQ))
+        self._add_se_library('1/2/1', bz2.compress(FASTQ))
+        self._add_se_library('1/3/1', FASTQ)
+        for (ref, ext) in [('1/1/1', '.fastq.gz'), ('1/2/1', '.fastq.bz2'), ('1/3/1', '.fastq')]:
+            fwd_file = self._stage(ref)['replicate_input'][0]['fwd_file']
+            self.assertTrue(fwd_file.endswith(ext), fwd_file)
+        self.assertEqual(self.dsu.readsUtils_Client.downloaded, [])
+
+
+    def test_not_fastq_goes_through_readsutils(self):
+        self._add_se_library('1/1/1', FASTA)
+        self._add_se_library('1/2/1', b'PK\x03\x04 zipped')
+        self._add_se_library('1/3/1', b'\x1f\x8b not really gzip')
+        for ref in ['1/1/1', '1/2/1', '1/3/1']:
+            fwd_file = self._stage(ref)['replicate_input'][0]['fwd_file']
+            with open(fwd_file, 'rb') as fwd_handle:
+                self.assertEqual(fwd_handle.read(), FASTQ)
+            self.assertEqual([file_name for file_name in os.listdir(os.path.dirname(fwd_file)) if file_name.endswith('.download')], [])
+        self.assertEqual(self.dsu.readsUtils_Client.downloaded, ['1/1/1', '1/2/1', '1/3/1'])
+
+
+    def test_bad_record_in_stored_fastq(self):
+        # past the first block that starts_as_fastq() looks at
+        bad_fastq = (b'@long/1\n'+b'A'*1000+b'\n+\n'+b'F'*1000+b'\n') * 2200 + b'@bad/1\nACGT\n+\nFF\n'
+        self.assertTrue(len(bad_fastq) > 4*1024*1024)
+        self._add_se_library('1/1/1', bz2.compress(bad_fastq))
+        for subsample_percent in [100, 50]:
+            with self.assertRaises(ValueError) as context:
+                self._stage('1/1/1', subsample_percent)
+            self.assertIn('badly formatted FASTQ record 2201', str(context.exception))
+
+
+    def _gzip(self, content):
+        gz_path = os.path.join(self.tmp_dir, 'content.gz')
+        with gzip.open(gz_path, 'wb') as gz_handle:
+            gz_handle.write(content)
+        with open(gz_path, 'rb') as gz_handle:
+            return gz_handle.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
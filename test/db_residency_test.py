@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_kaiju.Utils.DBResidency import DBResidency, page_cache_residency, drop_from_page_cache
+
+
+class DBResidencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write(self, file_name, n_bytes):
+        path = os.path.join(self.tmp_dir, file_name)
+        with open(path, 'wb') as out_handle:
+            out_handle.write(os.urandom(n_bytes))
+            out_handle.flush()
+            os.fsync(out_handle.fileno())  # clean pages can be dropped from the page cache
+        drop_from_page_cache(path)
+        return path
+
+
+    def _read(self, path):
+        with open(path, 'rb') as in_handle:
+            in_handle.read()
+
+
+    def test_page_cache_residency(self):
+        path = self._write('reads.fastq', 1024*1024 + 100)
+        for window_bytes in [64*1024, 1024**3]:
+            (resident_bytes, file_bytes) = page_cache_residency(path, window_bytes)
+            self.assertEqual(file_bytes, 1024*1024 + 100)
+            self.assertTrue(resident_bytes < file_bytes)
+
+        self._read(path)
+        for window_bytes in [64*1024, 1024**3]:
+            self.assertEqual(page_cache_residency(path, window_bytes), (1024*1024 + 100, 1024*1024 + 100))
+
+        drop_from_page_cache(path)
+        self.assertTrue(page_cache_residency(path)[0] < 1024*1024 + 100)
+        self.assertEqual(page_cache_residency(self._write('empty', 0)), (0, 0))
+
+
+    def test_report_and_prewarm(self):
+        db_files = [self._write(file_name, 256*1024) for file_name in ['kaiju_db_refseq.fmi', 'names.dmp', 'nodes.dmp']]
+        self._write('README', 1024)
+        db_residency = DBResidency(self.tmp_dir)
+        self.assertEqual(db_residency.db_files, db_files)
+        self.assertTrue(all([resident_bytes < file_bytes for (resident_bytes, file_bytes) in db_residency.report().values()]))
+
+        db_residency.prewarm()
+        db_residency._warmer.join(30)
+        self.assertEqual(db_residency.report(), dict([(db_file, (256*1024, 256*1024)) for db_file in db_files]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import bz2
+import shutil
+import tempfile
+import unittest
+
+from kb_kaiju.Utils.FastqReader import FastqReader, DecompressingFifo, MultiStreamBZ2File, normalize_read_id
+
+
+class FastqReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fastq_path = os.path.join(self.tmp_dir, 'reads.fastq')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write(self, content):
+        with open(self.fastq_path, 'wb') as fastq_handle:
+            fastq_handle.write(content)
+
+
+    def test_normalize_read_id(self):
+        for (header, read_id) in [(b'@SRR5891520.1.1 HISEQ:1:1101 1:N:0\n', b'@SRR5891520.11'),
+                                  (b'@SRR5891520.1.2\tx\r\n', b'@SRR5891520.12'),
+                                  (b'@read7/1\n', b'@read7'),
+                                  (b'@read7_R', b'@read7'),
+                                  (b"@read7:3''", b'@read7'),
+                                  (b'@read7-x', b'@read7-x'),
+                                  (b'@read71', b'@read71'),
+                                  (b'@a.b.c', b'@a.bc'),
+                                  (b'@', b'@'),
+                                  (b'', b'')]:
+            self.assertEqual(normalize_read_id(header), read_id, header)
+
+
+    def test_records_across_blocks(self):
+        recs = [('@read'+str(rec_i)+'/1 extra\n'+'ACGT'*(rec_i % 5)+'\n+\n'+'F'*(4*(rec_i % 5))+'\n').encode('utf-8')
+                for rec_i in range(300)]
+        self._write(b''.join(recs))
+        for buf_size in [1, 5, 13, 64, 4096, 4*1024*1024]:
+            reader = FastqReader(self.fastq_path, buf_size)
+            self.assertEqual(list(reader), [(('@read'+str(rec_i)).encode('utf-8'), recs[rec_i]) for rec_i in range(300)])
+            self.assertEqual(reader.n_records, 300)
+
+
+    def test_crlf_and_last_line_without_newline(self):
+        self._write(b'@r1/1\r\nACG\r\n+\r\nFFF\r\n@r2/1\nAC\n+\nFF\n\n')
+        self.assertEqual(list(FastqReader(self.fastq_path, 7)),
+                         [(b'@r1', b'@r1/1\r\nACG\r\n+\r\nFFF\r\n'), (b'@r2', b'@r2/1\nAC\n+\nFF\n')])
+        self._write(b'@r1/1\nACG\n+\nFFF')
+        self.assertEqual(list(FastqReader(self.fastq_path)), [(b'@r1', b'@r1/1\nACG\n+\nFFF\n')])
+
+
+    def test_badly_formatted_records(self):
+        good_rec = b'@r1/1\nACG\n+\nFFF\n'
+        for bad_rec in [b'r2/1\nACG\n+\nFFF\n', b'@r2/1\nACG\n-\nFFF\n',
+                        b'@r2/1\nACG\n+\nFF\n', b'@r2/1\nAC\r\n+\nFFF\n']:
+            self._write(good_rec + bad_rec + good_rec)
+            with self.assertRaises(ValueError) as context:
+                list(FastqReader(self.fastq_path))
+            self.assertIn('badly formatted FASTQ record 2 ', str(context.exception))
+
+        self._write(good_rec + b'@r2/1\nACG\n+\n')
+        with self.assertRaises(ValueError) as context:
+            list(FastqReader(self.fastq_path))
+        self.assertIn('truncated FASTQ record 2 ', str(context.exception))
+
+
+    def test_multi_stream_bzip2(self):
+        # two streams concatenated, as written by pbzip2 or 'cat a.bz2 b.bz2'
+        recs = [('@read'+str(rec_i)+'/1\nACGT\n+\nFFFF\n').encode('utf-8') for rec_i in range(1000)]
+        first_stream = bz2.compress(b''.join(recs[:400]))
+        self._write(first_stream + bz2.compress(b''.join(recs[400:])) + b'\0\0 trailing padding')
+        self.assertEqual([rec for (read_id, rec) in FastqReader(self.fastq_path)], recs)
+
+        # raw reads ending mid-stream, exactly at the end of a stream, and byte by byte
+        for raw_buf_size in [1, 7, len(first_stream), 1024*1024]:
+            bz2_handle = MultiStreamBZ2File(self.fastq_path, raw_buf_size)
+            self.assertEqual(bz2_handle.read(5) + bz2_handle.read(), b''.join(recs))
+            self.assertEqual(bz2_handle.read(), b'')
+            bz2_handle.close()
+
+        fifo = DecompressingFifo(self.fastq_path, os.path.join(self.tmp_dir, 'reads.fifo')).start()
+        try:
+            with open(fifo.fifo_path, 'rb') as fifo_handle:
+                self.assertEqual(fifo_handle.read(), b''.join(recs))
+        finally:
+            fifo.close()
+
+
+    def test_truncated_bzip2(self):
+        recs = b'@read/1\nACGT\n+\nFFFF\n' * 1000
+        self._write(bz2.compress(recs) + bz2.compress(recs)[:-10])
+        with self.assertRaises(EOFError):
+            list(FastqReader(self.fastq_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from kb_kaiju.Utils.KaijuOutputReader import count_kaiju_classifications
+
+
+class KaijuOutputReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classification_file = os.path.join(self.tmp_dir, 'sample.kaiju')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write(self, content):
+        with open(self.classification_file, 'wb') as class_handle:
+            class_handle.write(content)
+
+
+    def _legacy_count(self, n_ids):
+        '''
+        The line at a time parsing OutputBuilder did before
+        '''
+        taxid_cnts = np.zeros(n_ids, dtype=np.int64)
+        unclassified_cnt = 0
+        with open(self.classification_file, 'r') as class_handle:
+            for class_line in class_handle:
+                class_info = class_line.rstrip().split("\t")
+                if class_info[0] == 'U':
+                    unclassified_cnt += 1
+                    continue
+                taxid_cnts[int(class_info[2])] += 1
+        return (taxid_cnts, unclassified_cnt)
+
+
+    def test_block_boundaries(self):
+        random_state = np.random.RandomState(1)
+        lines = []
+        for read_i in range(2000):
+            if random_state.random_sample() < 0.2:
+                lines.append('U\tread.'+str(read_i)+'\t0')
+            elif read_i % 3 == 0:  # kaiju -v
+                lines.append('C\tread.'+str(read_i)+'\t'+str(random_state.randint(1, 5000))+'\t61.0\t2,562,\tWP_1.1,\tMKRL')
+            else:
+                lines.append('C\tread.'+str(read_i)+'\t'+str(random_state.randint(1, 5000)))
+        self._write(('\n'.join(lines)+'\n').encode('utf-8'))
+        (expected_cnts, expected_unclassified_cnt) = self._legacy_count(5000)
+
+        # blocks that split lines everywhere, from inside the flag to inside the taxid
+        for buf_size in [1, 7, 16, 29, 64, 1000, 4*1024*1024]:
+            (taxid_cnts, unclassified_cnt) = count_kaiju_classifications(self.classification_file, 5000, buf_size)
+            self.assertTrue(np.array_equal(taxid_cnts, expected_cnts), 'buf_size '+str(buf_size))
+            self.assertEqual(unclassified_cnt, expected_unclassified_cnt)
+
+
+    def test_last_line_without_newline(self):
+        self._write(b'C\tr1\t562\nU\tr2\t0\nC\tr3\t562')
+        for buf_size in [3, 1024]:
+            (taxid_cnts, unclassified_cnt) = count_kaiju_classifications(self.classification_file, 1000, buf_size)
+            self.assertEqual(taxid_cnts[562], 2)
+            self.assertEqual(unclassified_cnt, 1)
+
+
+    def test_crlf_and_blank_lines(self):
+        self._write(b'C\tr1\t562\r\n\r\nC\tr2\t10\t33.0\t10,\tWP_2.1,\tMK\r\n\nU\tr3\t0\r\n')
+        (taxid_cnts, unclassified_cnt) = count_kaiju_classifications(self.classification_file, 1000, 5)
+        self.assertEqual(taxid_cnts[562], 1)
+        self.assertEqual(taxid_cnts[10], 1)
+        self.assertEqual(int(taxid_cnts.sum()), 2)
+        self.assertEqual(unclassified_cnt, 1)
+
+
+    def test_taxids_beyond_n_ids(self):
+        self._write(b'C\tr1\t5\nC\tr2\t123456\n')
+        (taxid_cnts, unclassified_cnt) = count_kaiju_classifications(self.classification_file, 10)
+        self.assertEqual(len(taxid_cnts), 123457)
+        self.assertEqual(taxid_cnts[5], 1)
+        self.assertEqual(taxid_cnts[123456], 1)
+
+
+    def test_empty_file(self):
+        self._write(b'')
+        (taxid_cnts, unclassified_cnt) = count_kaiju_classifications(self.classification_file, 10)
+        self.assertEqual(int(taxid_cnts.sum()), 0)
+        self.assertEqual(unclassified_cnt, 0)
+
+
+    def test_malformed_lines(self):
+        for bad_line in [b'C\tr2', b'C\tr2\t', b'C\tr2\t56x2', b'C\tr2\t-1', b'C r2 562']:
+            self._write(b'C\tr1\t562\n'+bad_line+b'\nU\tr3\t0\n')
+            with self.assertRaises(ValueError) as context:
+                count_kaiju_classifications(self.classification_file, 1000)
+            self.assertIn("'"+bad_line.decode('utf-8')+"'", str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_kaiju.Utils import TaxonomyIndex
+from kb_kaiju.Utils.TaxonomyIndex import TaxonomyRegistry
+from kb_kaiju.Utils.OutputBuilder import OutputBuilder
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class KaijuReportsTest(unittest.TestCase):
+    '''
+    write_kaijuReports() against kaiju2table output for test/data/kaiju2table/sample.kaiju
+    on the taxonomy in test/data/kaijudb/testdb (sample.<tax level>[.<options>].tsv), and
+    write_krona_text() against kaiju2krona output for it (test/data/kaiju2krona/sample.krona)
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # the DB is copied so its taxonomy index gets built outside of the source tree
+        db_root = os.path.join(self.tmp_dir, 'kaijudb')
+        shutil.copytree(os.path.join(DATA_DIR, 'kaijudb'), db_root)
+        self.real_registry = TaxonomyIndex._registry
+        TaxonomyIndex._registry = TaxonomyRegistry(db_root=db_root)
+
+        self.classification_file = os.path.join(self.tmp_dir, 'sample.kaiju')
+        shutil.copy(os.path.join(DATA_DIR, 'kaiju2table', 'sample.kaiju'), self.classification_file)
+        self.output_builder = OutputBuilder([], self.tmp_dir, None, None)
+
+
+    def tearDown(self):
+        TaxonomyIndex._registry = self.real_registry
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write_reports(self, tax_levels, filter_percent=0, filter_unclassified=0, full_tax_path=0):
+        report_files = dict([(tax_level, os.path.join(self.tmp_dir, 'sample-'+tax_level+'.kaijuReport')) for tax_level in tax_levels])
+        self.output_builder.write_kaijuReports(self.classification_file, report_files, 'testdb',
+                                               filter_percent, filter_unclassified, full_tax_path)
+        return report_files
+
+
+    def assertMatchesKaiju2table(self, report_file, expected_file_name):
+        with open(report_file, 'r') as report_handle:
+            report_lines = report_handle.read().splitlines()
+        with open(os.path.join(DATA_DIR, 'kaiju2table', expected_file_name), 'r') as expected_handle:
+            expected_lines = expected_handle.read().splitlines()
+
+        self.assertEqual(report_lines[0], expected_lines[0])
+        self.assertEqual(len(report_lines), len(expected_lines))
+        for (report_line, expected_line) in zip(report_lines[1:], expected_lines[1:]):
+            # kaiju2table names the file as given to it
+            (report_file_col, report_cols) = report_line.split('\t', 1)
+            self.assertEqual(report_file_col, self.classification_file)
+            self.assertEqual(report_cols, expected_line.split('\t', 1)[1])
+
+
+    def test_tax_levels(self):
+        report_files = self._write_reports(['phylum', 'genus', 'species'])
+        for tax_level in ['phylum', 'genus', 'species']:
+            self.assertMatchesKaiju2table(report_files[tax_level], 'sample.'+tax_level+'.tsv')
+
+
+    def test_filter_percent(self):
+        report_files = self._write_reports(['genus'], filter_percent=25)
+        self.assertMatchesKaiju2table(report_files['genus'], 'sample.genus.m25.tsv')
+
+
+    def test_filter_unclassified(self):
+        report_files = self._write_reports(['genus'], filter_unclassified=1)
+        self.assertMatchesKaiju2table(report_files['genus'], 'sample.genus.u.tsv')
+
+
+    def test_full_tax_path(self):
+        report_files = self._write_reports(['genus'], full_tax_path=1)
+        self.assertMatchesKaiju2table(report_files['genus'], 'sample.genus.p.tsv')
+
+
+    def test_summary_parses_back(self):
+        report_files = self._write_reports(['genus'])
+        (abundance, lineage_order, classified_frac) = self.output_builder._parse_kaiju_summary_file(report_files['genus'], 'genus')
+        self.assertEqual(lineage_order, ['Escherichia', 'Shigella', 'viruses', 'unassigned at genus level'])
+        self.assertAlmostEqual(abundance['Escherichia'], 41.666667)
+        self.assertAlmostEqual(abundance['viruses'], 7.5)
+        self.assertAlmostEqual(abundance['unassigned at genus level'], 10.0)
+        self.assertAlmostEqual(classified_frac, 1.0 - 0.20833333)
+
+
+    def test_krona_text(self):
+        # kaiju2krona leaves out taxids missing from the taxonomy (and, without -u, unclassified reads)
+        with open(self.classification_file, 'a') as classification_handle:
+            classification_handle.write('C\tSRR5891520.121\t77777\n')
+        krona_file = os.path.join(self.tmp_dir, 'sample.krona')
+        self.output_builder.write_krona_text(self.classification_file, krona_file, 'testdb')
+        with open(krona_file, 'r') as krona_handle:
+            krona_lines = krona_handle.read().splitlines()
+        with open(os.path.join(DATA_DIR, 'kaiju2krona', 'sample.krona'), 'r') as expected_handle:
+            expected_lines = expected_handle.read().splitlines()
+        self.assertEqual(sorted(krona_lines), sorted(expected_lines))  # kaiju2krona's order is that of a hash map
+
+
+if __name__ == '__main__':
+    unittest.main()
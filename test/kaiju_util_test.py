@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from kb_kaiju.Utils.KaijuUtil import KaijuUtil
+from kb_kaiju.Utils.ProcScheduler import ProcScheduler
+from kb_kaiju.Utils.StagingScheduler import StagingScheduler
+
+KAIJU_DB_DIR = '/data/kaijudb/refseq'
+
+
+class KaijuUtilTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scratch = os.path.join(self.tmp_dir, 'scratch')
+        self.ku = KaijuUtil({'scratch':          self.scratch,
+                             'workspace-url':    'https://ws.example/services/ws',
+                             'srv-wiz-url':      'https://ws.example/services/service_wizard',
+                             'SDK_CALLBACK_URL': 'http://localhost:9999',
+                             'threads':          1},
+                            {'token': 'token'})
+        self.ku.threads = 4
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write(self, file_name, content='x'):
+        path = os.path.join(self.tmp_dir, file_name)
+        with open(path, 'w') as out_handle:
+            out_handle.write(content)
+        return path
+
+
+    def _item(self, name, reads_type='PE'):
+        item = {'name': name, 'type': reads_type, 'ref': '1/1/1', 'fwd_file': self._write(name+'.fwd.fastq')}
+        if reads_type == 'PE':
+            item['rev_file'] = self._write(name+'.rev.fastq')
+        return item
+
+
+    def _kaiju_options(self):
+        return {'out_folder':       os.path.join(self.tmp_dir, 'out'),
+                'db_type':          'refseq',
+                'seg_filter':       1,
+                'min_match_length': 11,
+                'greedy_run_mode':  0}
+
+
+    def test_kaiju_multi_command(self):
+        self.ku._validate_kaiju_options = lambda options: None  # there's no kaiju db here
+        (item_a, item_b) = (self._item('a'), self._item('b'))
+        options = self._kaiju_options()
+        options['input_items'] = [item_a, item_b]
+        self.assertEqual(self.ku._build_kaiju_command(options),
+                         ['/kb/module/kaiju/bin/kaiju-multi',
+                          '-t', KAIJU_DB_DIR+'/nodes.dmp',
+                          '-f', KAIJU_DB_DIR+'/kaiju_db_refseq.fmi',
+                          '-i', item_a['fwd_file']+','+item_b['fwd_file'],
+                          '-j', item_a['rev_file']+','+item_b['rev_file'],
+                          '-o', options['out_folder']+'/a.kaiju,'+options['out_folder']+'/b.kaiju',
+                          '-x', '-m', '11', '-z', '4', '-v'])
+
+        options = self._kaiju_options()
+        options['input_item'] = self._item('c', 'SE')
+        self.assertEqual(self.ku._build_kaiju_command(options),
+                         ['/kb/module/kaiju/bin/kaiju',
+                          '-t', KAIJU_DB_DIR+'/nodes.dmp',
+                          '-f', KAIJU_DB_DIR+'/kaiju_db_refseq.fmi',
+                          '-i', options['input_item']['fwd_file'],
+                          '-o', options['out_folder']+'/c.kaiju',
+                          '-x', '-m', '11', '-z', '4', '-v'])
+
+
+    def test_kaiju_multi_inputs_not_mixed(self):
+        options = self._kaiju_options()
+        options['KAIJU_DB_PATH'] = self._write('kaiju_db_refseq.fmi')
+        options['KAIJU_DB_NODES'] = self._write('nodes.dmp')
+        options['input_items'] = [self._item('a', 'SE'), self._item('b', 'SE')]
+        self.ku._validate_kaiju_options(options)
+        options['input_items'].append(self._item('c', 'PE'))
+        with self.assertRaises(ValueError) as context:
+            self.ku._validate_kaiju_options(options)
+        self.assertIn("can't mix SE and PE reads in one kaiju-multi run: c is PE", str(context.exception))
+
+
+    def test_batch_split_by_type_and_commas(self):
+        kaiju_runs = []
+        self.ku._run_kaiju = lambda options, input_items, dropOutput=False: kaiju_runs.append([item['name'] for item in input_items])
+        prefetch = {'scheduler': StagingScheduler(self.tmp_dir), 'slots': threading.Semaphore(0)}
+        batch = [(0, {'replicate_input': [self._item('pe1'), self._item('se1', 'SE')]}),
+                 (1, {'replicate_input': [self._item('se,2', 'SE'), self._item('se3', 'SE')]}),
+                 (2, {'replicate_input': [self._item('pe2')]})]
+        self.ku._classify_kaiju_batch(self._kaiju_options(), batch, prefetch)
+        # names (and paths) with commas can't go in kaiju-multi's comma separated lists
+        self.assertEqual(kaiju_runs, [['se,2'], ['se1', 'se3'], ['pe1', 'pe2']])
+
+
+    def _krona_chart_commands(self, combine):
+        commands = []
+        self.ku.proc_scheduler = ProcScheduler(2, lambda command, log_output_file=None: commands.append(command))
+        options = {'input_reads': [self._item('s1'), self._item('s2')],
+                   'out_folder':  self.tmp_dir,
+                   'html_folder': os.path.join(self.tmp_dir, 'html'),
+                   'db_type':     'refseq'}
+        for sample in ['s1', 's2']:
+            self._write(sample+'.krona', '1\tcellular organisms\n')
+        html_files = self.ku._run_krona_charts(options, combine=combine)
+        return (sorted(commands), html_files)
+
+
+    def test_combined_krona_chart(self):
+        (commands, html_files) = self._krona_chart_commands(combine=True)
+        self.assertEqual(commands, [['/usr/local/bin/ktImportText',
+                                     '-o', self.tmp_dir+'/html/kaiju_samples.krona.html',
+                                     self.tmp_dir+'/s1.krona,s1',
+                                     self.tmp_dir+'/s2.krona,s2']])
+        self.assertEqual([(html_file['name'], html_file['local_path']) for html_file in html_files],
+                         [('Krona', 'kaiju_samples.krona.html')])
+
+        (commands, html_files) = self._krona_chart_commands(combine=False)
+        self.assertEqual(commands, [['/usr/local/bin/ktImportText', '-o', self.tmp_dir+'/html/s1.krona.html', self.tmp_dir+'/s1.krona,s1'],
+                                    ['/usr/local/bin/ktImportText', '-o', self.tmp_dir+'/html/s2.krona.html', self.tmp_dir+'/s2.krona,s2']])
+        self.assertEqual([html_file['name'] for html_file in html_files], ['s1 Krona', 's2 Krona'])
+
+
+if __name__ == '__main__':
+    unittest.main()
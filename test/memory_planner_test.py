@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_kaiju.Utils import MemoryPlanner as memory_planner_module
+from kb_kaiju.Utils.MemoryPlanner import MemoryPlanner, memory_available_bytes
+
+GB = 1024**3
+
+
+class MemoryPlannerTest(unittest.TestCase):
+    '''
+    MemoryPlanner against a fake /proc/meminfo and cgroup dir
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cgroup_dir = os.path.join(self.tmp_dir, 'cgroup')
+        os.makedirs(os.path.join(self.cgroup_dir, 'memory'))
+        self.real_paths = (memory_planner_module.MEMINFO_PATH, memory_planner_module.CGROUP_DIR)
+        memory_planner_module.MEMINFO_PATH = os.path.join(self.tmp_dir, 'meminfo')
+        memory_planner_module.CGROUP_DIR = self.cgroup_dir
+        self._write('meminfo', 'MemTotal:       65536000 kB\nMemAvailable:   '+str(20*GB // 1024)+' kB\n')
+
+        # a 3 GB index and 1 MB nodes.dmp: 3 GB + 2 MB + 512 MB + 64 MB per thread
+        self.db_dir = os.path.join(self.tmp_dir, 'kaijudb')
+        os.makedirs(self.db_dir)
+        with open(os.path.join(self.db_dir, 'kaiju_db_refseq.fmi'), 'wb') as fmi_handle:
+            fmi_handle.truncate(3*GB)
+        self._write('kaijudb/nodes.dmp', 'x' * (1024*1024))
+
+
+    def tearDown(self):
+        (memory_planner_module.MEMINFO_PATH, memory_planner_module.CGROUP_DIR) = self.real_paths
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write(self, file_name, content):
+        with open(os.path.join(self.tmp_dir, file_name), 'w') as out_handle:
+            out_handle.write(content)
+
+
+    def _write_cgroup_v2(self, limit, current, inactive_file):
+        self._write('cgroup/memory.max', str(limit)+'\n')
+        self._write('cgroup/memory.current', str(current)+'\n')
+        self._write('cgroup/memory.stat', 'anon 1000\nfile 5000\ninactive_file '+str(inactive_file)+'\n')
+
+
+    def test_mem_available_without_cgroup_limit(self):
+        self.assertEqual(memory_available_bytes(), 20*GB)
+        self._write_cgroup_v2('max', 5*GB, 0)
+        self.assertEqual(memory_available_bytes(), 20*GB)
+
+
+    def test_cgroup_v2_limit(self):
+        # what's left under the limit, counting inactive page cache as free
+        self._write_cgroup_v2(8*GB, 6*GB, 1*GB)
+        self.assertEqual(memory_available_bytes(), 3*GB)
+        self._write_cgroup_v2(64*GB, 6*GB, 0)
+        self.assertEqual(memory_available_bytes(), 20*GB)  # MemAvailable is less
+        self._write_cgroup_v2(4*GB, 6*GB, 0)
+        self.assertEqual(memory_available_bytes(), 0)
+
+
+    def test_cgroup_v1_limit(self):
+        self._write('cgroup/memory/memory.limit_in_bytes', str(10*GB)+'\n')
+        self._write('cgroup/memory/memory.usage_in_bytes', str(4*GB)+'\n')
+        self._write('cgroup/memory/memory.stat', 'cache 10\ntotal_inactive_file '+str(2*GB)+'\n')
+        self.assertEqual(memory_available_bytes(), 8*GB)
+        self._write('cgroup/memory/memory.limit_in_bytes', str(2**63 - 4096)+'\n')  # no limit
+        self.assertEqual(memory_available_bytes(), 20*GB)
+
+
+    def test_predicted_rss(self):
+        planner = MemoryPlanner(self.db_dir, threads=4)
+        self.assertEqual(planner.fmi_bytes(), 3*GB)
+        self.assertEqual(planner.predicted_kaiju_rss_bytes(), 3*GB + 2*1024*1024 + 512*1024*1024 + 4*64*1024*1024)
+
+
+    def test_kaiju_instances(self):
+        planner = MemoryPlanner(self.db_dir, threads=4)  # 3.75 GB each
+        self._write_cgroup_v2(16*GB, 0, 0)
+        self.assertEqual(planner.check_kaiju_fits('refseq'), planner.predicted_kaiju_rss_bytes())
+        self.assertEqual(planner.max_kaiju_instances(), 4)
+        self.assertEqual(planner.kaiju_instances(8), 4)
+        self.assertEqual(planner.kaiju_instances(2), 2)
+        self.assertEqual(planner.kaiju_instances(), 1)
+
+        self._write_cgroup_v2(7*GB, 0, 0)
+        self.assertEqual(planner.kaiju_instances(8), 1)
+
+
+    def test_kaiju_does_not_fit(self):
+        self._write_cgroup_v2(3*GB, 0, 0)
+        with self.assertRaises(ValueError) as context:
+            MemoryPlanner(self.db_dir, threads=4).check_kaiju_fits('refseq')
+        self.assertIn("Not enough memory to run kaiju with the 'refseq' database", str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
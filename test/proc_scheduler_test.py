@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import unittest
+
+from kb_kaiju.Utils.ProcScheduler import ProcScheduler, available_cpus
+
+
+def wait_for(check, timeout=5):
+    # only guards against hanging, the tests don't depend on how long anything takes
+    deadline = time.time() + timeout
+    while not check():
+        if time.time() > deadline:
+            raise AssertionError ("timed out waiting")
+        time.sleep(0.005)
+
+
+class FakeProcs(object):
+    '''
+    run_proc() stand-in that records how many commands, and how many CPUs, run at once.
+    A command is [name, threads].  Commands are held until release_at of them have been
+    running at once, or the gate is opened.
+    '''
+
+    def __init__(self, release_at=0):
+        self.cond = threading.Condition()
+        self.release_at = release_at
+        self.gate_open = False
+        self.running = 0
+        self.max_running = 0
+        self.cpus_in_use = 0
+        self.max_cpus_in_use = 0
+        self.commands = []
+
+
+    def run_proc(self, command, log_output_file=None):
+        (name, threads) = command
+        with self.cond:
+            self.commands.append(name)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.cpus_in_use += threads
+            self.max_cpus_in_use = max(self.max_cpus_in_use, self.cpus_in_use)
+            self.cond.notify_all()
+            deadline = time.time() + 5  # a scheduler that never runs release_at at once fails the asserts
+            while self.max_running < self.release_at and not self.gate_open and time.time() < deadline:
+                self.cond.wait(0.1)
+        try:
+            if name.startswith('fail'):
+                raise ValueError (name)
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cpus_in_use -= threads
+
+
+    def open_gate(self):
+        with self.cond:
+            self.gate_open = True
+            self.cond.notify_all()
+
+
+def job(name, threads=1):
+    return {'name': name, 'threads': threads, 'steps': [[name, threads]], 'log_output_file': None}
+
+
+class ProcSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.procs = FakeProcs()
+        self.scheduler = ProcScheduler(4, self.procs.run_proc)
+
+
+    def test_available_cpus(self):
+        self.assertTrue(available_cpus() >= 1)
+
+
+    def test_jobs_fill_the_budget(self):
+        self.procs.release_at = 4
+        self.scheduler.run([job('krona '+str(job_i)) for job_i in range(8)])
+        self.assertEqual(sorted(self.procs.commands), sorted(['krona '+str(job_i) for job_i in range(8)]))
+        self.assertEqual(self.procs.max_running, 4)
+        self.assertEqual(self.procs.max_cpus_in_use, 4)
+
+
+    def test_multithreaded_jobs_within_budget(self):
+        big_job = {'name': 'big', 'threads': 10, 'steps': [['big', 4]]}  # held at the budget
+        self.scheduler.run([job('kaiju', 3), job('krona 1'), job('krona 2'), big_job])
+        self.assertEqual(len(self.procs.commands), 4)
+        self.assertTrue(self.procs.max_cpus_in_use <= 4)
+        self.assertEqual(self.procs.cpus_in_use, 0)
+        self.assertEqual(self.scheduler._free_cpus, 4)
+
+
+    def test_steps_in_order(self):
+        steps = []
+        self.scheduler.run([{'name':  'chart',
+                             'steps': [lambda: steps.append('build') or ['first', 1],
+                                       lambda: steps.append('then') or ['second', 1]]}])
+        self.assertEqual(steps, ['build', 'then'])
+        self.assertEqual(self.procs.commands, ['first', 'second'])
+
+
+    def test_error_stops_new_jobs(self):
+        scheduler = ProcScheduler(1, self.procs.run_proc)
+        with self.assertRaises(ValueError) as context:
+            scheduler.run([job('fail 1'), job('krona 2'), job('krona 3')])
+        self.assertEqual(str(context.exception), 'fail 1')
+        self.assertEqual(self.procs.commands, ['fail 1'])
+        self.assertEqual(scheduler._free_cpus, 1)
+
+        # the next run isn't affected
+        scheduler.run([job('krona 4')])
+        self.assertEqual(self.procs.commands, ['fail 1', 'krona 4'])
+
+
+    def test_shared_with_acquire(self):
+        # kaiju holding 3 of 4 CPUs leaves one for the charts run alongside it
+        self.procs.release_at = 100  # charts run until the gate opens
+        kaiju_cpus = self.scheduler.acquire(3)
+        self.assertEqual(kaiju_cpus, 3)
+        charts = threading.Thread(target=self.scheduler.run, args=([job('krona '+str(job_i)) for job_i in range(3)],))
+        charts.start()
+        wait_for(lambda: len(self.procs.commands) == 1 and len(self.scheduler._waiting) == 2)
+        self.assertEqual(self.procs.max_running, 1)
+        self.assertEqual(self.procs.max_cpus_in_use, 1)
+        self.assertEqual(self.scheduler._free_cpus, 0)
+        self.procs.open_gate()
+        self.scheduler.release(kaiju_cpus)
+        charts.join()
+        self.assertEqual(len(self.procs.commands), 3)
+        self.assertEqual(self.scheduler.acquire(100), 4)  # capped at the budget
+        self.scheduler.release(4)
+
+
+    def test_acquire_in_order(self):
+        # a stream of single CPU jobs doesn't keep kaiju from getting all its CPUs
+        scheduler = ProcScheduler(2, self.procs.run_proc)
+        held = scheduler.acquire(1)
+        acquired = []
+
+        def kaiju():
+            kaiju_cpus = scheduler.acquire(2)
+            acquired.append(('kaiju', len(self.procs.commands)))
+            scheduler.release(kaiju_cpus)
+
+        kaiju_thread = threading.Thread(target=kaiju)
+        kaiju_thread.start()
+        wait_for(lambda: len(scheduler._waiting) == 1)
+        charts = threading.Thread(target=scheduler.run, args=([job('krona '+str(job_i)) for job_i in range(5)],))
+        charts.start()
+        wait_for(lambda: len(scheduler._waiting) == 3)  # kaiju and the 2 chart workers
+        self.assertEqual(self.procs.commands, [])  # charts queue behind kaiju
+        scheduler.release(held)
+        kaiju_thread.join()
+        charts.join()
+        self.assertEqual(acquired, [('kaiju', 0)])
+        self.assertEqual(len(self.procs.commands), 5)
+
+
+    def test_concurrent_runs(self):
+        runs = [[job('a '+str(job_i)) for job_i in range(4)],
+                [job('b '+str(job_i)) for job_i in range(4)],
+                [job('fail c')]]
+        errors = []
+
+        def run(jobs):
+            try:
+                self.scheduler.run(jobs)
+            except ValueError as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=run, args=(jobs,)) for jobs in runs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, ['fail c'])  # only the run it belongs to fails
+        self.assertEqual(len(self.procs.commands), 9)
+        self.assertTrue(self.procs.max_cpus_in_use <= 4)
+        self.assertEqual(self.scheduler._free_cpus, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from kb_kaiju.Utils import ProcUsage
+from kb_kaiju.Utils.ProcUsage import wait_proc
+
+
+class ProcUsageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.real_wait_exited = ProcUsage.wait_exited
+
+
+    def tearDown(self):
+        ProcUsage.wait_exited = self.real_wait_exited
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _run_dd(self, then=''):
+        # copies 3 MiB and exits right after, or runs the 'then' shell command
+        dd_command = 'dd if=/dev/zero of='+os.path.join(self.tmp_dir, 'dd.out')+' bs=1048576 count=3'
+        with open(os.devnull, 'w') as devnull:
+            if then:
+                p = subprocess.Popen(['sh', '-c', dd_command+'; '+then], stderr=devnull)
+            else:
+                p = subprocess.Popen(dd_command.split(), stderr=devnull)
+            (exit_code, rusage, proc_io) = wait_proc(p)
+        return (exit_code, rusage, proc_io, p)
+
+
+    def _check_dd_usage(self, exit_code, rusage, proc_io, p):
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(p.returncode, 0)
+        self.assertTrue(rusage.ru_maxrss > 0)
+        if os.path.exists('/proc/self/io'):
+            self.assertTrue(proc_io['wchar'] >= 3*1024*1024, proc_io)
+            self.assertTrue(proc_io['rchar'] >= 3*1024*1024, proc_io)
+
+
+    def test_final_io_counters(self):
+        # all of dd's IO happens in its last moments
+        (exit_code, rusage, proc_io, p) = self._run_dd()
+        self._check_dd_usage(exit_code, rusage, proc_io, p)
+
+
+    def test_sampled_io_counters(self):
+        # as where the process can't be waited for without reaping it
+        ProcUsage.wait_exited = lambda pid: False
+        (exit_code, rusage, proc_io, p) = self._run_dd(then='exec sleep 0.5')  # sh gets dd's counters when it reaps it
+        self._check_dd_usage(exit_code, rusage, proc_io, p)
+
+
+    def test_exit_code(self):
+        p = subprocess.Popen(['sh', '-c', 'exit 3'])
+        self.assertEqual(wait_proc(p)[0], 3)
+        p = subprocess.Popen(['sh', '-c', 'kill -9 $$'])
+        self.assertEqual(wait_proc(p)[0], -9)
+        self.assertEqual(p.returncode, -9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+
+from kb_kaiju.Utils import ReadSubsampler as read_subsampler_module
+from kb_kaiju.Utils.ReadSubsampler import ReadSubsampler, UnionReadReplicates
+
+
+def write_fastq(path, read_names, mate):
+    with open(path, 'wb') as fastq_handle:
+        for read_name in read_names:
+            fastq_handle.write(('@'+read_name+'/'+str(mate)+'\nACGT\n+\nFFFF\n').encode('utf-8'))
+
+
+def read_names_of(path):
+    read_names = []
+    with open(path, 'rb') as fastq_handle:
+        for line_i, line in enumerate(fastq_handle):
+            if line_i % 4 == 0:
+                read_names.append(line.decode('utf-8')[1:].rstrip().rsplit('/', 1)[0])
+    return read_names
+
+
+class ReadSubsamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.real_read_id_hash = read_subsampler_module.read_id_hash
+
+
+    def tearDown(self):
+        read_subsampler_module.read_id_hash = self.real_read_id_hash
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _path(self, file_name):
+        return os.path.join(self.tmp_dir, file_name)
+
+
+    def _subsample_single_end(self, subsampler, in_file_name, out_prefix):
+        out_paths = [self._path(out_prefix+'.'+str(lib_i)+'.fq') for lib_i in range(subsampler.subsample_replicates)]
+        subsample_cnts = subsampler.subsample_single_end(self._path(in_file_name), out_paths)
+        return ([read_names_of(out_path) for out_path in out_paths], subsample_cnts)
+
+
+    def _subsample_paired_end(self, subsampler, fwd_file_name, rev_file_name, out_prefix):
+        n_replicates = subsampler.subsample_replicates
+        fwd_out_paths = [self._path(out_prefix+'.fwd.'+str(lib_i)+'.fq') for lib_i in range(n_replicates)]
+        rev_out_paths = [self._path(out_prefix+'.rev.'+str(lib_i)+'.fq') for lib_i in range(n_replicates)]
+        subsample_cnts = subsampler.subsample_paired_end(self._path(fwd_file_name), self._path(rev_file_name),
+                                                         fwd_out_paths, rev_out_paths)
+        return ([read_names_of(out_path) for out_path in fwd_out_paths],
+                [read_names_of(out_path) for out_path in rev_out_paths],
+                subsample_cnts)
+
+
+    def test_replicates_disjoint(self):
+        read_names = ['SRR5891520.'+str(read_i) for read_i in range(5000)]
+        write_fastq(self._path('reads.fq'), read_names, 1)
+        (replicate_names, subsample_cnts) = self._subsample_single_end(ReadSubsampler(20, 4, 1), 'reads.fq', 'out')
+
+        self.assertEqual(subsample_cnts['total_reads'], 5000)
+        self.assertEqual(subsample_cnts['reads_by_set'], [len(names) for names in replicate_names])
+        all_names = []
+        for names in replicate_names:
+            self.assertTrue(800 < len(names) < 1200, str(len(names)))  # ~20% each
+            self.assertEqual(len(set(names)), len(names))
+            all_names.extend(names)
+        self.assertEqual(len(set(all_names)), len(all_names))
+        self.assertTrue(set(all_names) <= set(read_names))
+        # in input order
+        read_i_of = dict([(read_name, read_i) for (read_i, read_name) in enumerate(read_names)])
+        for names in replicate_names:
+            self.assertEqual(names, sorted(names, key=read_i_of.get))
+
+
+    def test_deterministic(self):
+        read_names = ['read'+str(read_i) for read_i in range(2000)]
+        write_fastq(self._path('reads.fq'), read_names, 1)
+        (first_names, first_cnts) = self._subsample_single_end(ReadSubsampler(10, 3, 7), 'reads.fq', 'first')
+        (again_names, again_cnts) = self._subsample_single_end(ReadSubsampler(10, 3, 7), 'reads.fq', 'again')
+        (other_seed_names, other_seed_cnts) = self._subsample_single_end(ReadSubsampler(10, 3, 8), 'reads.fq', 'other')
+        self.assertEqual(first_names, again_names)
+        self.assertEqual(first_cnts, again_cnts)
+        self.assertNotEqual(first_names, other_seed_names)
+
+        # membership depends on the read alone, not on the other reads in the file
+        write_fastq(self._path('half.fq'), read_names[::2], 1)
+        (half_names, half_cnts) = self._subsample_single_end(ReadSubsampler(10, 3, 7), 'half.fq', 'half')
+        in_half = set(read_names[::2])
+        self.assertEqual(half_names, [[name for name in names if name in in_half] for names in first_names])
+
+
+    def test_paired_end_same_as_single_end(self):
+        read_names = ['SRR5891520.'+str(read_i) for read_i in range(3000)]
+        write_fastq(self._path('fwd.fq'), read_names, 1)
+        with gzip.open(self._path('rev.fq.gz'), 'wb') as rev_handle:  # compressed inputs are read as they are
+            for read_name in read_names:
+                rev_handle.write(('@'+read_name+'/2\nACGT\n+\nFFFF\n').encode('utf-8'))
+        shuffled_names = list(read_names)
+        random.Random(1).shuffle(shuffled_names)
+        write_fastq(self._path('rev.shuffled.fq'), shuffled_names[:2500], 2)
+
+        subsampler = ReadSubsampler(25, 2, 3)
+        (se_names, se_cnts) = self._subsample_single_end(subsampler, 'fwd.fq', 'se')
+
+        # mates in the same order: walked in lockstep
+        (fwd_names, rev_names, pe_cnts) = self._subsample_paired_end(subsampler, 'fwd.fq', 'rev.fq.gz', 'synced')
+        self.assertEqual(fwd_names, se_names)
+        self.assertEqual(rev_names, se_names)
+        self.assertEqual(pe_cnts['reads_by_set'], se_cnts['reads_by_set'])
+        self.assertEqual((pe_cnts['unpaired_fwd_reads'], pe_cnts['unpaired_rev_reads']), (0, 0))
+
+        # mates shuffled, some missing: paired through the index
+        (fwd_names, rev_names, pe_cnts) = self._subsample_paired_end(subsampler, 'fwd.fq', 'rev.shuffled.fq', 'indexed')
+        in_rev = set(shuffled_names[:2500])
+        for lib_i in range(2):
+            self.assertEqual(fwd_names[lib_i], [name for name in se_names[lib_i] if name in in_rev])
+            self.assertEqual(sorted(rev_names[lib_i]), sorted(fwd_names[lib_i]))
+        self.assertEqual(pe_cnts['total_rev_reads'], 2500)
+        self.assertEqual(pe_cnts['unpaired_fwd_reads'], sum(se_cnts['reads_by_set']) - sum(pe_cnts['reads_by_set']))
+
+
+    def test_too_many_replicates(self):
+        with self.assertRaises(ValueError):
+            ReadSubsampler(30, 4, 1)
+
+
+    def test_indexed_pairs_with_hash_collisions(self):
+        # readA and readB collide within fwd, readX (rev only) collides with readC,
+        # the only fwd read with its hash, and readY (rev only) with readA and readB
+        weak_hashes = {b'@readA': 1, b'@readB': 1, b'@readC': 2, b'@readD': 3,
+                       b'@readX': 2, b'@readY': 1}
+        read_subsampler_module.read_id_hash = lambda read_id: weak_hashes[read_id]
+
+        write_fastq(self._path('fwd.fq'), ['readA', 'readB', 'readC', 'readD'], 1)
+        write_fastq(self._path('rev.fq'), ['readX', 'readD', 'readA', 'readY'], 2)
+        subsample_cnts = ReadSubsampler(100, 1, 1).subsample_paired_end(self._path('fwd.fq'), self._path('rev.fq'),
+                                                                        [self._path('fwd.out.fq')],
+                                                                        [self._path('rev.out.fq')])
+
+        self.assertEqual(sorted(read_names_of(self._path('fwd.out.fq'))), ['readA', 'readD'])
+        self.assertEqual(sorted(read_names_of(self._path('rev.out.fq'))), ['readA', 'readD'])
+        self.assertEqual(subsample_cnts['reads_by_set'], [2])
+        self.assertEqual(subsample_cnts['unpaired_fwd_reads'], 2)
+        self.assertEqual(subsample_cnts['unpaired_rev_reads'], 2)
+
+
+    def test_union_replicates_of_suffixed_read_names(self):
+        # names that lose more than the mate suffix when normalized twice (read_1/1 -> read_1 -> read)
+        read_names = ['read_'+str(read_i) for read_i in range(1, 400)] + ['SRR5891520.'+str(read_i)+'.1' for read_i in range(1, 400)]
+        write_fastq(self._path('fwd.fq'), read_names, 1)
+        write_fastq(self._path('rev.fq'), read_names, 2)
+        subsampler = ReadSubsampler(30, 3, 7)
+        subsampler.subsample_paired_end(self._path('fwd.fq'), self._path('rev.fq'),
+                                        [self._path('fwd.'+str(lib_i)+'.fq') for lib_i in range(3)],
+                                        [self._path('rev.'+str(lib_i)+'.fq') for lib_i in range(3)])
+        read_replicates = UnionReadReplicates()
+        subsampler.subsample_paired_end(self._path('fwd.fq'), self._path('rev.fq'),
+                                        [self._path('fwd.union.fq')] * 3,
+                                        [self._path('rev.union.fq')] * 3,
+                                        read_replicates)
+        read_replicates.save(self._path('union.replicates.npz'))
+        read_replicates = UnionReadReplicates.load(self._path('union.replicates.npz'))
+
+        union_names = read_names_of(self._path('fwd.union.fq'))
+        expected_lib_is = []
+        for union_name in union_names:
+            expected_lib_is.append([lib_i for lib_i in range(3) if union_name in read_names_of(self._path('fwd.'+str(lib_i)+'.fq'))][0])
+        self.assertEqual(len(set(expected_lib_is)), 3)
+        # kaiju may report the name with or without its /1
+        for kaiju_names in [[(name+'/1').encode('utf-8') for name in union_names],
+                            [name.encode('utf-8') for name in union_names]]:
+            self.assertEqual(list(read_replicates.replicates_of(kaiju_names)), expected_lib_is)
+        self.assertEqual(list(read_replicates.replicates_of([b'read_0', b'read_0/1'])), [UnionReadReplicates.UNKNOWN] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_kaiju.Utils.ReadsCache import ReadsCache
+
+
+class ReadsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ReadsCache(os.path.join(self.tmp_dir, 'cache'), 1024*1024)
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        os.makedirs(self.input_dir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write_reads(self, file_name, content):
+        path = os.path.join(self.tmp_dir, file_name)
+        with open(path, 'wb') as reads_handle:
+            reads_handle.write(content)
+        return path
+
+
+    def test_store_and_fetch(self):
+        fwd_path = self._write_reads('lib.fwd.fq', b'@r1/1\nACGT\n+\nFFFF\n')
+        rev_path = self._write_reads('lib.rev.fq', b'@r1/2\nTTTT\n+\nFFFF\n')
+        self.assertIsNone(self.cache.fetch('1/2/3', self.input_dir, 'lib'))
+        self.cache.store('1/2/3', {'fwd': fwd_path, 'rev': rev_path})
+
+        reads_files = self.cache.fetch('1/2/3', self.input_dir, 'lib')
+        self.assertEqual(sorted(reads_files.keys()), ['fwd', 'rev'])
+        with open(reads_files['rev'], 'rb') as reads_handle:
+            self.assertEqual(reads_handle.read(), b'@r1/2\nTTTT\n+\nFFFF\n')
+
+
+    def test_store_over_leftover_entry_dir(self):
+        # as left by a job that died after creating the entry dir but before writing the manifest
+        leftover_dir = self.cache._entry_dir('1/2/3')
+        os.makedirs(leftover_dir)
+        self._write_reads(os.path.join(leftover_dir, 'fwd.lib.fwd.fq'), b'partial')
+        os.makedirs(leftover_dir + '.tmp')
+
+        fwd_path = self._write_reads('lib.fwd.fq', b'@r1\nACGT\n+\nFFFF\n')
+        self.cache.store('1/2/3', {'fwd': fwd_path})
+
+        reads_files = self.cache.fetch('1/2/3', self.input_dir, 'lib')
+        with open(reads_files['fwd'], 'rb') as reads_handle:
+            self.assertEqual(reads_handle.read(), b'@r1\nACGT\n+\nFFFF\n')
+        self.assertFalse(os.path.exists(leftover_dir + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import unittest
+
+from kb_kaiju.Utils.StagingScheduler import StagingScheduler
+
+GB = 1024**3
+
+
+def wait_for(check, timeout=5):
+    # only guards against hanging, the tests don't depend on how long anything takes
+    deadline = time.time() + timeout
+    while not check():
+        if time.time() > deadline:
+            raise AssertionError ("timed out waiting")
+        time.sleep(0.005)
+
+
+class FakeFreeSpaceScheduler(StagingScheduler):
+    '''
+    StagingScheduler with the scratch free space (statvfs f_bavail) set by the test
+    '''
+
+    def __init__(self, free_bytes, headroom_bytes=0):
+        StagingScheduler.__init__(self, '/no/such/scratch', headroom_bytes)
+        self.free = free_bytes
+        self.free_checks = 0
+
+
+    def free_bytes(self):
+        self.free_checks += 1
+        return self.free
+
+
+class StagingSchedulerTest(unittest.TestCase):
+
+    def _admit_in_thread(self, scheduler, key, estimate):
+        admitted = []
+        admit_thread = threading.Thread(target=lambda: admitted.append(scheduler.admit(key, key, estimate)))
+        admit_thread.daemon = True
+        free_checks = scheduler.free_checks
+        admit_thread.start()
+        self._wait_until_blocked(scheduler, admit_thread, free_checks)
+        return (admit_thread, admitted)
+
+
+    def _wait_until_blocked(self, scheduler, admit_thread, free_checks):
+        # admit() checks the free space holding the scheduler's lock, and only lets go of it to wait
+        wait_for(lambda: scheduler.free_checks > free_checks)
+        with scheduler._cond:
+            self.assertTrue(admit_thread.is_alive())
+
+
+    def test_admit_within_free_space(self):
+        scheduler = FakeFreeSpaceScheduler(10*GB, headroom_bytes=1*GB)
+        self.assertTrue(scheduler.admit('a', 'a', {'staging_bytes': 4*GB, 'output_bytes': 1*GB}))
+        self.assertTrue(scheduler.admit('b', 'b', {'staging_bytes': 3*GB, 'output_bytes': 1*GB}))  # 5 GB not reserved
+        self.assertEqual(sorted(scheduler._pending.values()), [4*GB, 5*GB])
+
+
+    def test_waits_for_space(self):
+        scheduler = FakeFreeSpaceScheduler(10*GB, headroom_bytes=1*GB)
+        self.assertTrue(scheduler.admit('a', 'a', {'staging_bytes': 4*GB, 'output_bytes': 1*GB}))
+        (admit_thread, admitted) = self._admit_in_thread(scheduler, 'b', {'staging_bytes': 5*GB, 'output_bytes': 0})
+
+        # a's reads are now on disk and counted by statvfs; only its output is still reserved
+        scheduler.free = 6*GB
+        free_checks = scheduler.free_checks
+        scheduler.staged('a', 4*GB)
+        self._wait_until_blocked(scheduler, admit_thread, free_checks)
+        self.assertEqual(admitted, [])
+
+        # a's files are removed
+        scheduler.free = 10*GB
+        scheduler.release('a')
+        admit_thread.join(5)
+        self.assertEqual(admitted, [True])
+        self.assertEqual(scheduler._pending, {'b': 5*GB})
+
+
+    def test_too_big_staged_anyway_when_alone(self):
+        scheduler = FakeFreeSpaceScheduler(2*GB)
+        self.assertTrue(scheduler.admit('a', 'a', {'staging_bytes': 5*GB, 'output_bytes': 1*GB}))
+
+
+    def test_unknown_estimate_uses_largest_staged(self):
+        scheduler = FakeFreeSpaceScheduler(10*GB)
+        self.assertTrue(scheduler.admit('a', 'a', None))
+        scheduler.staged('a', 7*GB)
+        scheduler.free = 3*GB
+        (admit_thread, admitted) = self._admit_in_thread(scheduler, 'b', None)  # 7 GB by a's
+        scheduler.free = 10*GB
+        scheduler.release('a')
+        admit_thread.join(5)
+        self.assertEqual(admitted, [True])
+
+
+    def test_close_while_waiting(self):
+        scheduler = FakeFreeSpaceScheduler(1*GB)
+        self.assertTrue(scheduler.admit('a', 'a', {'staging_bytes': 1*GB, 'output_bytes': 0}))
+        (admit_thread, admitted) = self._admit_in_thread(scheduler, 'b', {'staging_bytes': 1*GB, 'output_bytes': 0})
+        scheduler.close()
+        admit_thread.join(5)
+        self.assertEqual(admitted, [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
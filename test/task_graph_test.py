@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import unittest
+
+from kb_kaiju.Utils.TaskGraph import TaskGraph
+
+
+class TaskGraphTest(unittest.TestCase):
+
+    def test_inputs_and_outputs(self):
+        graph = TaskGraph(4)
+        graph.add('sum', lambda a, b: a + b, inputs=['a', 'b'])  # added before its inputs
+        graph.add('a', lambda: 1)
+        graph.add('b', lambda: 2)
+        graph.add('double', lambda total: 2 * total, inputs=['sum'])
+        self.assertEqual(graph.run(), {'a': 1, 'b': 2, 'sum': 3, 'double': 6})
+
+
+    def test_independent_tasks_run_concurrently(self):
+        graph = TaskGraph(3)
+        barrier = threading.Condition()
+        arrived = []
+
+        def wait_for_others(name):
+            deadline = time.time() + 5
+            with barrier:
+                arrived.append(name)
+                barrier.notify_all()
+                while len(arrived) < 3:
+                    if time.time() > deadline:
+                        raise ValueError ("tasks ran one after the other")
+                    barrier.wait(0.1)
+            return name
+
+        for name in ['x', 'y', 'z']:
+            graph.add(name, lambda name=name: wait_for_others(name))
+        self.assertEqual(sorted(graph.run().values()), ['x', 'y', 'z'])
+
+
+    def test_tasks_added_while_running(self):
+        graph = TaskGraph(2)
+
+        def classify():
+            for sample in ['s1', 's2', 's3']:
+                time.sleep(0.01)
+                graph.add('report '+sample, lambda sample=sample: sample+'.report')
+            graph.add('all reports', lambda *reports: list(reports), inputs=['report s1', 'report s2', 'report s3'])
+            return 'classified'
+
+        graph.add('classify', classify)
+        outputs = graph.run()
+        self.assertEqual(outputs['classify'], 'classified')
+        self.assertEqual(outputs['all reports'], ['s1.report', 's2.report', 's3.report'])
+
+
+    def test_main_thread_tasks(self):
+        graph = TaskGraph(2)
+        main_thread = threading.current_thread()
+        graph.add('worker', lambda: threading.current_thread() is main_thread)
+        graph.add('main', lambda worker: threading.current_thread() is main_thread, inputs=['worker'], main_thread=True)
+        self.assertEqual(graph.run(), {'worker': False, 'main': True})
+
+
+    def test_error_stops_dependent_tasks(self):
+        graph = TaskGraph(2)
+        ran = []
+
+        def fail():
+            raise ValueError ("boom")
+
+        graph.add('fail', fail)
+        graph.add('after fail', lambda x: ran.append('after fail'), inputs=['fail'])
+        graph.add('main after fail', lambda x: ran.append('main after fail'), inputs=['fail'], main_thread=True)
+        with self.assertRaises(ValueError) as context:
+            graph.run()
+        self.assertEqual(str(context.exception), 'boom')
+        self.assertEqual(ran, [])
+
+
+    def test_error_waits_for_running_tasks(self):
+        graph = TaskGraph(2)
+        finished = []
+
+        slow_started = threading.Event()
+
+        def slow():
+            # still running when fail() fails, and only finishes after that
+            slow_started.set()
+            deadline = time.time() + 5  # only guards against hanging
+            with graph._cond:
+                while not graph._errors and time.time() < deadline:
+                    graph._cond.wait(0.1)
+            finished.append('slow')
+
+        def fail():
+            slow_started.wait(5)
+            raise KeyError ('boom')
+
+        graph.add('slow', slow)
+        graph.add('fail', fail)
+        graph.add('after slow', lambda x: finished.append('after slow'), inputs=['slow'])
+        with self.assertRaises(KeyError):
+            graph.run()
+        self.assertEqual(finished, ['slow'])
+
+
+    def test_error_in_task_added_while_running(self):
+        graph = TaskGraph(2)
+
+        def fail():
+            raise ValueError ("sample failed")
+
+        graph.add('classify', lambda: graph.add('report', fail))
+        with self.assertRaises(ValueError) as context:
+            graph.run()
+        self.assertEqual(str(context.exception), 'sample failed')
+
+
+    def test_missing_inputs(self):
+        graph = TaskGraph(2)
+        graph.add('a', lambda: 1)
+        graph.add('b', lambda a, c: a, inputs=['a', 'never added'])
+        with self.assertRaises(ValueError) as context:
+            graph.run()
+        self.assertTrue(str(context.exception).endswith('inputs never added: b'))
+
+
+    def test_duplicate_task(self):
+        graph = TaskGraph(2)
+        graph.add('a', lambda: 1)
+        with self.assertRaises(ValueError):
+            graph.add('a', lambda: 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from kb_kaiju.Utils.TaxonomyIndex import TaxonomyIndex, is_current, INDEX_DIR_NAME, NO_ID
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TAX_LEVELS = ['phylum', 'class', 'order', 'family', 'genus', 'species']
+
+
+def baseline_abundance_cnts(db_dir, taxid_cnts, tax_level):
+    '''
+    Read counts by taxon name at tax_level the way OutputBuilder._parse_kaiju_classification_file()
+    used to count them, walking up nodes.dmp from each taxid ('species group' and
+    'species subgroup' count as species)
+    '''
+    names = dict()
+    with open(os.path.join(db_dir, 'names.dmp'), 'r') as names_handle:
+        for names_line in names_handle:
+            names_line_info = names_line.rstrip().split("\t|")
+            if names_line_info[3].strip() == 'scientific name':
+                names[int(names_line_info[0].strip())] = names_line_info[1].strip()
+    nodes = dict()
+    with open(os.path.join(db_dir, 'nodes.dmp'), 'r') as nodes_handle:
+        for nodes_line in nodes_handle:
+            nodes_line_info = nodes_line.rstrip().split("\t|")
+            tax_level_str = nodes_line_info[2].strip()
+            if tax_level_str == 'species group' or tax_level_str == 'species subgroup':
+                tax_level_str = 'species'
+            nodes[int(nodes_line_info[0].strip())] = [int(nodes_line_info[1].strip()), tax_level_str]
+
+    abundance_cnts = dict()
+    for (node_id, species_cnt) in taxid_cnts.items():
+        (this_par_id, this_tax_level) = nodes[node_id]
+        level_lim_i = 0
+        while level_lim_i < 100:
+            level_lim_i += 1
+            if this_tax_level == tax_level:
+                abundance_cnts[names[node_id]] = abundance_cnts.get(names[node_id], 0) + species_cnt
+                break
+            node_id = this_par_id
+            (this_par_id, this_tax_level) = nodes[node_id]
+            if this_par_id == 1:
+                break
+    return abundance_cnts
+
+
+class TaxonomyIndexTest(unittest.TestCase):
+    '''
+    TaxonomyIndex of the test kaiju DB (test/data/kaijudb/testdb)
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_dir = os.path.join(self.tmp_dir, 'testdb')
+        shutil.copytree(os.path.join(DATA_DIR, 'kaijudb', 'testdb'), self.db_dir)
+        self.taxonomy = TaxonomyIndex.load(self.db_dir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_nodes_and_names(self):
+        self.assertEqual(self.taxonomy.index_dir, os.path.join(self.db_dir, INDEX_DIR_NAME))
+        self.assertEqual(self.taxonomy.largest_id, 131567)
+        self.assertEqual(int(self.taxonomy.parents[562]), 561)
+        self.assertEqual(int(self.taxonomy.parents[1]), 1)
+        self.assertEqual(self.taxonomy.rank_of(562), 'species')
+        self.assertEqual(self.taxonomy.rank_of(90000), 'species group')
+        self.assertEqual(self.taxonomy.rank_of(3), None)
+        self.assertTrue(self.taxonomy.has_node(83333))
+        self.assertFalse(self.taxonomy.has_node(3))
+        self.assertFalse(self.taxonomy.has_node(90001))
+        self.assertEqual(self.taxonomy.name(2), 'Bacteria')  # not its synonym
+        self.assertEqual(self.taxonomy.name(83333), 'Escherichia coli K-12')
+        self.assertEqual(self.taxonomy.name(3), None)
+        self.assertEqual(self.taxonomy.name(90001), None)
+
+
+    def test_ancestors_at(self):
+        taxids = [83333, 562, 561, 623, 90000, 543, 2, 10241, 3, 90001]
+        self.assertEqual(list(self.taxonomy.ancestors_at(taxids, 'genus')),
+                         [561, 561, 561, 620, 620, NO_ID, NO_ID, 10241, NO_ID, NO_ID])
+        self.assertEqual(list(self.taxonomy.ancestors_at(taxids, 'species')),
+                         [562, 562, NO_ID, 623, NO_ID, NO_ID, NO_ID, NO_ID, NO_ID, NO_ID])
+        self.assertEqual(list(self.taxonomy.ancestors_at(taxids, 'species', species_groups=True)),
+                         [562, 562, NO_ID, 623, 90000, NO_ID, NO_ID, NO_ID, NO_ID, NO_ID])
+        self.assertEqual(list(self.taxonomy.ancestors_at(taxids, 'phylum')),
+                         [1224, 1224, 1224, 1224, 1224, 1224, NO_ID, NO_ID, NO_ID, NO_ID])
+        with self.assertRaises(ValueError):
+            self.taxonomy.ancestors_at(taxids, 'superkingdom')
+
+
+    def test_is_viral(self):
+        self.assertEqual(list(self.taxonomy.is_viral([10239, 10240, 10241, 562, 2, 1, 3, 90001])),
+                         [True, True, True, False, False, False, False, False])
+
+
+    def test_rollup(self):
+        taxids = np.array([83333, 562, 561, 622, 623, 90000, 543, 2, 10241], dtype=np.uint32)
+        cnts = np.array([1, 2, 4, 8, 16, 32, 64, 128, 256], dtype=np.uint32)
+
+        (level_ids, level_cnts, unassigned_cnt) = self.taxonomy.rollup(taxids, cnts, 'genus')
+        self.assertEqual(list(level_ids), [561, 620, 10241])
+        self.assertEqual(list(level_cnts), [7, 56, 256])
+        self.assertEqual(unassigned_cnt, 64+128)
+
+        (level_ids, level_cnts, unassigned_cnt) = self.taxonomy.rollup(taxids, cnts, 'species')
+        self.assertEqual(list(level_ids), [562, 622, 623])
+        self.assertEqual(list(level_cnts), [3, 8, 16])
+        self.assertEqual(unassigned_cnt, 4+32+64+128+256)
+
+        (level_ids, level_cnts, unassigned_cnt) = self.taxonomy.rollup(taxids, cnts, 'species', species_groups=True)
+        self.assertEqual(list(level_ids), [562, 622, 623, 90000])
+        self.assertEqual(list(level_cnts), [3, 8, 16, 32])
+        self.assertEqual(unassigned_cnt, 4+64+128+256)
+
+
+    def test_rollup_of_nothing_and_unknown_taxids(self):
+        (level_ids, level_cnts, unassigned_cnt) = self.taxonomy.rollup([], [], 'genus')
+        self.assertEqual((len(level_ids), len(level_cnts), unassigned_cnt), (0, 0, 0))
+        (level_ids, level_cnts, unassigned_cnt) = self.taxonomy.rollup([3, 200000, 562], [5, 6, 7], 'genus')
+        self.assertEqual((list(level_ids), list(level_cnts), unassigned_cnt), ([561], [7], 11))
+
+
+    def test_rollup_matches_baseline_parsing(self):
+        # a count on every node of the test DB, so every path up the tree is taken
+        node_ids = [node_id for node_id in range(self.taxonomy.largest_id+1) if self.taxonomy.has_node(node_id)]
+        taxid_cnts = dict([(node_id, node_i+1) for (node_i, node_id) in enumerate(node_ids)])
+        taxids = np.array(sorted(taxid_cnts.keys()), dtype=np.uint32)
+        cnts = np.array([taxid_cnts[taxid] for taxid in taxids], dtype=np.uint32)
+
+        for tax_level in TAX_LEVELS:
+            (level_ids, level_cnts, unassigned_cnt) = self.taxonomy.rollup(taxids, cnts, tax_level, species_groups=True)
+            abundance_cnts = dict([(self.taxonomy.name(level_id), int(level_cnt)) for (level_id, level_cnt) in zip(level_ids, level_cnts)])
+            expected_cnts = baseline_abundance_cnts(self.db_dir, taxid_cnts, tax_level)
+            self.assertTrue(len(expected_cnts) > 0)
+            self.assertEqual(abundance_cnts, expected_cnts, tax_level)
+            self.assertEqual(unassigned_cnt, sum(taxid_cnts.values()) - sum(expected_cnts.values()))
+
+
+    def test_rebuilt_when_dmp_files_change(self):
+        index_dir = self.taxonomy.index_dir
+        self.assertTrue(is_current(index_dir, self.db_dir))
+        reopened = TaxonomyIndex.load(self.db_dir)
+        self.assertTrue(np.array_equal(reopened.parents, self.taxonomy.parents))
+
+        with open(os.path.join(self.db_dir, 'names.dmp'), 'a') as names_handle:
+            names_handle.write("83333\t|\tE. coli K-12\t|\t\t|\tsynonym\t|\n")
+        self.assertFalse(is_current(index_dir, self.db_dir))
+
+        with open(os.path.join(self.db_dir, 'nodes.dmp'), 'a') as nodes_handle:
+            nodes_handle.write("100000\t|\t10241\t|\tspecies\t|\n")
+        with open(os.path.join(self.db_dir, 'names.dmp'), 'a') as names_handle:
+            names_handle.write("100000\t|\tVaccinia virus\t|\t\t|\tscientific name\t|\n")
+        rebuilt = TaxonomyIndex.load(self.db_dir)
+        self.assertTrue(is_current(index_dir, self.db_dir))
+        self.assertTrue(rebuilt.has_node(100000))
+        self.assertEqual(rebuilt.name(100000), 'Vaccinia virus')
+        self.assertTrue(rebuilt.is_viral([100000])[0])
+
+
+    def test_rebuilt_when_only_mtime_changes(self):
+        nodes_path = os.path.join(self.db_dir, 'nodes.dmp')
+        mtime = os.path.getmtime(nodes_path)
+        os.utime(nodes_path, (mtime + 10, mtime + 10))
+        self.assertFalse(is_current(self.taxonomy.index_dir, self.db_dir))
+        TaxonomyIndex.load(self.db_dir)
+        self.assertTrue(is_current(self.taxonomy.index_dir, self.db_dir))
+
+
+    def test_index_in_scratch(self):
+        # an index in scratch is used as is when the DB dir has none
+        scratch = os.path.join(self.tmp_dir, 'scratch')
+        shutil.move(self.taxonomy.index_dir, os.path.join(scratch, INDEX_DIR_NAME, 'testdb'))
+        taxonomy = TaxonomyIndex.load(self.db_dir, scratch)
+        self.assertEqual(taxonomy.index_dir, os.path.join(scratch, INDEX_DIR_NAME, 'testdb'))
+        self.assertFalse(os.path.exists(os.path.join(self.db_dir, INDEX_DIR_NAME)))
+        self.assertEqual(taxonomy.name(562), 'Escherichia coli')
+
+
+if __name__ == '__main__':
+    unittest.main()